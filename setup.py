@@ -41,6 +41,7 @@ setup(name='immagine',
                    'Development Status :: 3 - Alpha',
                    'Topic :: Multimedia :: Graphics :: Viewers',
                    'License :: OSI Approved :: Apache Software License'],
-      package_dir={'immagine': 'src'},
-      packages=['immagine'],
+      package_dir={'immagine': 'src',
+                   'immagine.benchmark': 'src/benchmark'},
+      packages=['immagine', 'immagine.benchmark'],
       scripts=['scripts/immagine'])
@@ -12,4 +12,32 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from .gui import main
+import time
+
+# Used to measure the time the application takes to start.
+start_time = time.time()
+
+
+def main(argv=None):
+    # Arguments are parsed first, so that --help and the batch mode do not
+    # start what only the GUI needs.
+    from .cli import parse_args
+    from .config import Config, setup_logging
+    args = parse_args(argv)
+    setup_logging(args.loglevel)
+    cfg = Config()
+    cfg.load()
+
+    if args.prethumbnail:
+        from . import batch
+        return batch.main(args.paths, cfg, num_jobs=args.jobs)
+
+    # The workers are forked from a server process started before gtk is
+    # imported, so that they do not inherit the state of the GUI.
+    from .forkserver import start_fork_server
+    start_fork_server()
+
+    # The GUI (and gtk) is imported only when needed, so that the modules
+    # which do not need it (e.g. benchmark) can be imported quickly.
+    from .gui import main as gui_main
+    return gui_main(args, cfg)
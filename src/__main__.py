@@ -12,7 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from .gui import main
+import sys
+
+from . import main
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
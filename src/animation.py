@@ -0,0 +1,148 @@
+# Copyright 2017 Matteo Franchin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Playback of animated images (GIF).
+
+Frames are decoded one at a time, when they are first shown, and are kept
+in a cache with a cap on the memory they use. Animations which fit in the
+cache are decoded only once: the following loops are played from the cache.
+For bigger animations only the first frames are cached and the others are
+decoded again at every loop.
+'''
+
+import numpy
+import PIL.Image
+import gobject
+import gtk
+import gtk.gdk
+
+from .image_cache import ImagePyramid, get_pixbuf_nbytes
+from .config import logger
+
+# File extensions of the formats which may contain animations.
+animated_file_extensions = ('.gif',)
+
+
+class AnimationPlayer(object):
+    '''Play an animated image, calling show_frame(pyramid) from the main loop
+    with an ImagePyramid for every frame. The image file is kept open only
+    while the animation is playing.'''
+
+    def __init__(self, image_path, show_frame, max_nbytes=64*1024*1024,
+                 min_delay=20):
+        self.image_path = image_path
+        self.show_frame = show_frame
+        self.max_nbytes = max_nbytes
+        self.min_delay = min_delay
+        self._image = None
+        self._frames = []
+        self._nbytes = 0
+        self._index = 0
+        self._source = None
+        try:
+            self._image = PIL.Image.open(image_path)
+        except Exception as exc:
+            logger.debug('Cannot open animation {}: {}'
+                         .format(image_path, str(exc)))
+        self._animated = getattr(self._image, 'is_animated', False)
+
+    def is_animated(self):
+        '''Whether the image has more than one frame.'''
+        return self._animated
+
+    def is_playing(self):
+        return self._source is not None
+
+    def play(self):
+        '''Start (or resume) the playback.'''
+        if self._source is None and self.is_animated():
+            self._show(self._index)
+
+    def stop(self):
+        '''Stop the playback and close the image file. The file is opened
+        again if the playback is resumed.'''
+        if self._source is not None:
+            gobject.source_remove(self._source)
+            self._source = None
+        if self._image is not None:
+            self._image.close()
+            self._image = None
+
+    def _get_frame(self, index):
+        '''(internal) Return the tuple (pyramid, delay) for the given frame,
+        where delay is in milliseconds, or None if there is no such frame.
+        '''
+        if index < len(self._frames):
+            return self._frames[index]
+
+        # Frames are decoded in sequence: decoding the frames after the ones
+        # in the cache is cheap, as the image is already positioned there.
+        if self._image is None:
+            self._image = PIL.Image.open(self.image_path)
+        try:
+            self._image.seek(index)
+            arr = numpy.asarray(self._image.convert('RGBA'))
+        except EOFError:
+            return None
+        delay = max(self.min_delay, self._image.info.get('duration') or 100)
+        pixbuf = gtk.gdk.pixbuf_new_from_array(arr, gtk.gdk.COLORSPACE_RGB, 8)
+        frame = (ImagePyramid(pixbuf), delay)
+
+        nbytes = get_pixbuf_nbytes(pixbuf)
+        if (index == len(self._frames) and
+            self._nbytes + nbytes <= self.max_nbytes):
+            self._frames.append(frame)
+            self._nbytes += nbytes
+        return frame
+
+    def _show(self, index):
+        '''(internal) Show the given frame and schedule the next one.'''
+        try:
+            frame = self._get_frame(index)
+            if frame is None and index > 0:
+                # Loop back to the first frame.
+                index = 0
+                frame = self._get_frame(index)
+        except Exception as exc:
+            logger.error('Cannot decode frame {} of {}: {}'
+                         .format(index, self.image_path, str(exc)))
+            frame = None
+        if frame is None:
+            return
+
+        self._index = index
+        pyramid, delay = frame
+        self.show_frame(pyramid)
+        self._source = gobject.timeout_add(delay, self._on_timeout)
+
+    def _on_timeout(self):
+        self._source = None
+        self._show(self._index + 1)
+        return False
+
+
+def get_animation_player(image_path, show_frame, config):
+    '''Return an AnimationPlayer for the given image or None if the image is
+    not animated.'''
+    if not image_path.lower().endswith(animated_file_extensions):
+        return None
+    if not config.get('viewer.animations', True, bool):
+        return None
+    max_mbytes = config.get('viewer.animation_cache_size', 64, int)
+    player = AnimationPlayer(image_path, show_frame,
+                             max_nbytes=max_mbytes*1024*1024)
+    if not player.is_animated():
+        player.stop()
+        return None
+    return player
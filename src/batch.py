@@ -0,0 +1,214 @@
+# Copyright 2017 Matteo Franchin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Offline generation of the thumbnails for whole directory trees.
+
+The thumbnails are generated by a pool of processes (one per core, by
+default) and stored in the persistent thumbnail cache, where the browser
+finds them. Thumbnails which are already up to date are skipped: this makes
+it cheap to run the same command again and, since every thumbnail is written
+atomically, an interrupted run is resumed just by running it again.
+'''
+
+import os
+import sys
+import time
+import signal
+import multiprocessing
+from collections import deque
+
+from .file_utils import get_files_in_dir, stat_file
+from .thumbnailers import build_scaled_image, build_directory_thumbnail, \
+  set_resize_backend
+from .thumbnail_cache import get_thumbnail_cache
+from .decode_limits import get_decode_limits
+from .file_types import get_file_sniffer
+from .config import logger
+
+# Thumbnail cache used by the processes of the pool.
+_cache = None
+
+
+def _init_pool_process(cache, decode_limits, resize_backend):
+    global _cache
+    _cache = cache
+    if decode_limits is not None:
+        decode_limits.apply()
+    if resize_backend is not None:
+        set_resize_backend(resize_backend)
+
+    # Interruptions are handled by the parent process.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _make_thumbnails(entry):
+    '''(internal) Generate the missing thumbnails for one FileEntry. Return
+    the tuple (num_generated, num_skipped, num_failed). Image thumbnails
+    keep the aspect ratio of the image and are never bigger than it, so
+    that ThumbnailCache.find can use them.'''
+    num_generated = num_skipped = num_failed = 0
+    for size in _cache.sizes:
+        if _cache.is_fresh(entry.full_path, size, entry.mtime):
+            num_skipped += 1
+            continue
+        if entry.is_dir:
+            arr = build_directory_thumbnail(entry.full_path, size)
+        else:
+            scaled = build_scaled_image(entry.full_path, size)
+            arr = (scaled[0] if scaled is not None else None)
+        if arr is not None and _cache.store(entry.full_path, size, arr,
+                                            entry.mtime):
+            num_generated += 1
+        else:
+            num_failed += 1
+    return (num_generated, num_skipped, num_failed)
+
+
+def walk_tree(root, show_hidden_files=False, follow_links=False,
+              sniffer=None):
+    '''Generate FileEntry objects (see file_utils.py) for all the images and
+    directories inside `root` (included), in breadth first order. Each
+    directory is visited once, even when symlinks form loops. Images are
+    recognised from their content if a FileSniffer is given.'''
+    root_path = os.path.abspath(root)
+    root_entry = stat_file(root_path)
+    if root_entry is None or not root_entry.is_dir:
+        return
+    yield root_entry
+
+    visited = set()
+    dirs_to_visit = deque([root_path])
+    while dirs_to_visit:
+        dir_path = dirs_to_visit.popleft()
+        real_path = os.path.realpath(dir_path)
+        if real_path in visited:
+            continue
+        visited.add(real_path)
+        for entry in get_files_in_dir(dir_path,
+                                      show_hidden_files=show_hidden_files,
+                                      sniffer=sniffer):
+            if entry.is_dir:
+                if not follow_links and os.path.islink(entry.full_path):
+                    continue
+                dirs_to_visit.append(entry.full_path)
+            yield entry
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}h{:02d}m{:02d}s'.format(hours, minutes, seconds)
+
+
+def prethumbnail(paths, cache, num_jobs=None, show_hidden_files=False,
+                 follow_links=False, progress_interval=2.0, out=sys.stderr,
+                 decode_limits=None, resize_backend=None, sniffer=None):
+    '''Generate the thumbnails for all the images and directories inside
+    `paths` and store them in the ThumbnailCache `cache`, decoding images
+    within the given DecodeLimits and scaling them with the given resize
+    backend (see thumbnailers.resize_backends). Images are recognised from
+    their content if the FileSniffer `sniffer` is given. Progress is written
+    to `out` every `progress_interval` seconds. Return a dictionary with the
+    number of entries processed and of thumbnails generated, skipped
+    (already up to date) and failed.'''
+    entries = []
+    for path in paths:
+        entries.extend(walk_tree(path, show_hidden_files=show_hidden_files,
+                                 follow_links=follow_links,
+                                 sniffer=sniffer))
+
+    totals = {'entries': 0, 'generated': 0, 'skipped': 0, 'failed': 0}
+    num_jobs = num_jobs or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(num_jobs, _init_pool_process,
+                                (cache, decode_limits, resize_backend))
+
+    def report(final=False):
+        elapsed = max(1e-6, time.time() - t_start)
+        rate = totals['entries']/elapsed
+        remaining = len(entries) - totals['entries']
+        eta = ('' if final or rate <= 0
+               else ', ETA ' + format_duration(remaining/rate))
+        out.write('{}/{} entries ({:.1%}): {} generated, {} up to date, '
+                  '{} failed, {:.1f} entries/s{}\n'
+                  .format(totals['entries'], len(entries),
+                          totals['entries']/float(max(1, len(entries))),
+                          totals['generated'], totals['skipped'],
+                          totals['failed'], rate, eta))
+        out.flush()
+
+    t_start = last_report = time.time()
+    results = pool.imap_unordered(_make_thumbnails, entries, chunksize=4)
+    try:
+        while True:
+            # Wait with a timeout: this keeps the process responsive to
+            # Ctrl-C and lets us report progress also when things are slow.
+            try:
+                generated, skipped, failed = results.next(progress_interval)
+            except multiprocessing.TimeoutError:
+                pass
+            except StopIteration:
+                break
+            else:
+                totals['entries'] += 1
+                totals['generated'] += generated
+                totals['skipped'] += skipped
+                totals['failed'] += failed
+
+            if time.time() - last_report >= progress_interval:
+                last_report = time.time()
+                report()
+    except KeyboardInterrupt:
+        pool.terminate()
+        pool.join()
+        report(final=True)
+        out.write('Interrupted: run the same command again to resume.\n')
+        raise
+
+    pool.close()
+    pool.join()
+    report(final=True)
+    return totals
+
+
+def main(paths, config, num_jobs=None):
+    '''Entry point for the command line. Return the exit status.'''
+    cache = get_thumbnail_cache(config)
+    if cache is None:
+        logger.error('The thumbnail cache is disabled (thumb.disk_cache)')
+        return 1
+
+    paths = paths or [os.getcwd()]
+    for path in paths:
+        if not os.path.isdir(path):
+            logger.error('Not a directory: {}'.format(path))
+            return 1
+
+    sys.stderr.write('Generating thumbnails of size {} in {}\n'
+                     .format(', '.join('{}x{}'.format(*size)
+                                       for size in cache.sizes),
+                             cache.cache_dir))
+    try:
+        totals = prethumbnail(paths, cache, num_jobs=num_jobs,
+                              show_hidden_files=config.get(
+                                'browser.show_hidden_files', True, bool),
+                              decode_limits=get_decode_limits(config),
+                              resize_backend=config.get(
+                                'thumb.resize_backend', None, basestring),
+                              sniffer=get_file_sniffer(config))
+    except KeyboardInterrupt:
+        return 130
+    if totals['failed'] > 0:
+        logger.warn('{} thumbnails could not be generated (damaged or '
+                    'unsupported files)'.format(totals['failed']))
+    return 0
@@ -0,0 +1,25 @@
+# Copyright 2017 Matteo Franchin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Headless benchmarks for the thumbnail and layout pipeline.
+
+Run with:
+
+  python -m immagine.benchmark --output results.json
+
+No display is needed: the benchmarks only use the parts of the app which
+process files and images. See `python -m immagine.benchmark --help`.
+'''
+
+from .runner import main
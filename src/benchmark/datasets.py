@@ -0,0 +1,89 @@
+# Copyright 2017 Matteo Franchin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Generation of synthetic image trees for the benchmarks.'''
+
+import os
+
+import numpy
+import PIL.Image
+
+# Image modes used when saving each format.
+_format_modes = {'jpg': 'RGB', 'png': 'RGBA', 'tif': 'RGB', 'gif': 'P',
+                 'bmp': 'RGB'}
+
+
+def make_image(size, seed=0):
+    '''Return a PIL RGB image with the given size. The image contains smooth
+    gradients plus some noise, so that it compresses like a photograph
+    rather than like a flat color.'''
+    width, height = size
+    rng = numpy.random.RandomState(seed)
+    x = numpy.linspace(0.0, 1.0, width)[numpy.newaxis, :]
+    y = numpy.linspace(0.0, 1.0, height)[:, numpy.newaxis]
+    phase = rng.uniform(0.0, 6.28, 3)
+    channels = [127.5*(1.0 + numpy.sin(6.0*x*(c + 1) + 4.0*y + phase[c]))
+                for c in range(3)]
+    arr = numpy.dstack(channels)
+    arr += rng.normal(0.0, 12.0, arr.shape)
+    arr = numpy.clip(arr, 0, 255).astype(numpy.uint8)
+    return PIL.Image.fromarray(arr, 'RGB')
+
+
+def save_image(image, path, fmt):
+    '''Save the RGB image in the given format ('jpg', 'png', ...).'''
+    mode = _format_modes.get(fmt, 'RGB')
+    if mode == 'P':
+        image = image.convert('P', palette=PIL.Image.ADAPTIVE)
+    elif mode != image.mode:
+        image = image.convert(mode)
+    image.save(path)
+
+
+def generate_tree(root, formats=('jpg', 'png'), sizes=((1600, 1200),),
+                  images_per_dir=20, depth=1, fanout=3):
+    '''Create a tree of synthetic images inside `root`. Each directory
+    contains `images_per_dir` images and, down to the given `depth`,
+    `fanout` subdirectories. Formats and sizes are used in turn. Return a
+    dictionary with the list of image paths and directory paths created.
+    '''
+    images = []
+    dirs = []
+    cache = {}
+
+    def populate(dir_path, level):
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        dirs.append(dir_path)
+        for i in range(images_per_dir):
+            n = len(images)
+            fmt = formats[n % len(formats)]
+            size = tuple(sizes[(n // len(formats)) % len(sizes)])
+
+            # Generating images is slow: only a few distinct ones are made.
+            key = (size, n % 4)
+            image = cache.get(key)
+            if image is None:
+                cache[key] = image = make_image(size, seed=n % 4)
+
+            path = os.path.join(dir_path, 'img_{:05d}.{}'.format(n, fmt))
+            save_image(image, path, fmt)
+            images.append(path)
+
+        if level < depth:
+            for i in range(fanout):
+                populate(os.path.join(dir_path, 'dir_{}'.format(i)), level + 1)
+
+    populate(root, 0)
+    return {'images': images, 'dirs': dirs}
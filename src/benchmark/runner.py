@@ -0,0 +1,421 @@
+# Copyright 2017 Matteo Franchin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Benchmarks for the thumbnail and layout pipeline and their command line
+interface.
+
+Each benchmark calls one function many times (once per image or once per
+directory of a synthetic tree) and records the duration of every call. The
+results report the throughput, the latency percentiles and the peak memory
+(RSS) of the process and of its children. Every benchmark runs in its own
+child process, as the peak memory of a process never decreases and would
+otherwise be inherited by the benchmarks following the heaviest one. Results
+can be saved as JSON and compared against the results of a previous run.
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import threading
+import multiprocessing
+from collections import OrderedDict
+
+import numpy
+
+from ..version import version
+from ..file_utils import FileList, list_dir, categorize_files, pick_files
+from ..thumbnailers import build_image_thumbnail, build_directory_thumbnail, \
+  open_image, to_rgb, fit_size, resize_backends
+from ..layout import lay_out_images
+from ..orchestrator import Orchestrator
+from ..stats import percentile
+from .datasets import generate_tree
+
+
+def get_peak_rss():
+    '''Return the peak resident memory (in KiB) of this process and of its
+    (terminated) children, as a tuple (self_kib, children_kib).'''
+    # ru_maxrss is in KiB on Linux, but in bytes on macOS.
+    scale = (1.0/1024 if sys.platform == 'darwin' else 1.0)
+    return tuple(int(resource.getrusage(who).ru_maxrss*scale)
+                 for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+
+
+def summarize(latencies, total_time):
+    '''Return a dictionary summarizing a benchmark from the latencies of
+    the single operations and the total time (all in seconds).'''
+    lat = sorted(latencies)
+    rss_self, rss_children = get_peak_rss()
+    result = OrderedDict()
+    result['count'] = len(lat)
+    result['total_s'] = total_time
+    result['throughput_per_s'] = (len(lat)/total_time if total_time > 0
+                                  else 0.0)
+    for p in (50, 90, 99):
+        result['p{}_ms'.format(p)] = 1000.0*percentile(lat, p)
+    result['max_ms'] = 1000.0*(lat[-1] if lat else 0.0)
+    result['peak_rss_kib'] = rss_self
+    result['children_peak_rss_kib'] = rss_children
+    return result
+
+
+def time_calls(fn, args_list, repeat=1):
+    '''Call fn(*args) for all the args in `args_list`, `repeat` times. Return
+    the list of latencies and the total time.'''
+    latencies = []
+    t_start = time.time()
+    for _ in range(repeat):
+        for args in args_list:
+            t0 = time.time()
+            fn(*args)
+            latencies.append(time.time() - t0)
+    return (latencies, time.time() - t_start)
+
+
+def bench_categorize_files(tree, opts):
+    args = [(list_dir(d),) for d in tree['dirs']]
+    return time_calls(lambda names: categorize_files(
+                        names, sort_type=FileList.SORT_BY_FILE_NAME),
+                      args, opts.repeat)
+
+
+def bench_pick_files(tree, opts):
+    return time_calls(lambda d: list(pick_files(d)),
+                      [(d,) for d in tree['dirs']], opts.repeat)
+
+
+def bench_build_image_thumbnail(tree, opts):
+    size = tuple(opts.thumbnail_size)
+    return time_calls(build_image_thumbnail,
+                      [(path, size) for path in tree['images']], opts.repeat)
+
+
+def bench_build_directory_thumbnail(tree, opts):
+    size = tuple(opts.thumbnail_size)
+    return time_calls(build_directory_thumbnail,
+                      [(d, size) for d in tree['dirs']], opts.repeat)
+
+
+def get_psnr(arr, reference):
+    '''Return the peak signal-to-noise ratio (in dB) of the image `arr`
+    with respect to `reference` (both numpy arrays with the same shape).'''
+    diff = arr.astype(numpy.float64) - reference.astype(numpy.float64)
+    mse = numpy.mean(diff*diff)
+    return (100.0 if mse == 0 else 10.0*numpy.log10(255.0**2/mse))
+
+
+def make_resize_benchmark(backend):
+    '''Return a benchmark for the given resize backend (see
+    thumbnailers.resize_backends). Images are decoded before the timing
+    starts. Quality is reported as the mean PSNR against the one-step
+    Lanczos filter of PIL.'''
+    def bench_resize(tree, opts):
+        resize = resize_backends[backend]
+        latencies = []
+        psnrs = []
+        total_time = 0.0
+        for path in tree['images']:
+            image = open_image(path, load=True)
+            if image is None:
+                continue
+            image = to_rgb(image)
+            size = fit_size(image.size, opts.thumbnail_size)
+            if size[0] >= image.size[0] or size[1] >= image.size[1]:
+                continue
+            calls, t = time_calls(resize, [(image, size)], opts.repeat)
+            latencies.extend(calls)
+            total_time += t
+            reference = numpy.asarray(resize_backends['pil'](image, size))
+            psnrs.append(get_psnr(numpy.asarray(resize(image, size)),
+                                  reference))
+        extra = {'psnr_db': sum(psnrs)/len(psnrs) if psnrs else 0.0}
+        return (latencies, total_time, extra)
+    return bench_resize
+
+
+def bench_lay_out_images(tree, opts):
+    # Listing the directory is part of what the browser does when entering a
+    # directory, so it is included in the measurement.
+    def lay_out(dir_path):
+        file_list = FileList(dir_path, sort_type=FileList.SORT_BY_FILE_NAME)
+        return list(lay_out_images(file_list, max_width=opts.max_width,
+                                   max_size=tuple(opts.thumbnail_size)))
+    return time_calls(lay_out, [(d,) for d in tree['dirs']], opts.repeat)
+
+
+def bench_orchestrator(tree, opts):
+    '''Request thumbnails for all the images and subdirectories in the tree
+    to an Orchestrator and wait for all of them. The latency is measured from
+    the request to the arrival of the thumbnail. Note that the orchestrator
+    serves the most recent requests first.'''
+    paths = tree['images'] + tree['dirs'][1:]
+    size = tuple(opts.thumbnail_size)
+    latencies = []
+    t_start = time.time()
+    for _ in range(opts.repeat):
+        orchestrator = Orchestrator(soft_limit=len(paths) + 1,
+                                    hard_limit=len(paths) + 2)
+        requested = {}
+        received = {}
+        all_received = threading.Event()
+
+        def on_thumbnail(file_name, size, state, data):
+            received[file_name] = time.time()
+            if len(received) == len(paths):
+                all_received.set()
+
+        orchestrator.set_callback('thumbnail_available', on_thumbnail)
+        for path in paths:
+            requested[path] = time.time()
+            orchestrator.request_thumbnail(path, size)
+
+        all_received.wait(opts.timeout)
+        orchestrator.cmd_queue.put(('STOP',))
+        orchestrator.worker.join(opts.timeout)
+        if len(received) < len(paths):
+            sys.stderr.write('Orchestrator timed out: got {} of {} thumbnails'
+                             '\n'.format(len(received), len(paths)))
+        latencies.extend(received[path] - requested[path]
+                         for path in received)
+    return (latencies, time.time() - t_start)
+
+
+def bench_startup_imports(tree, opts):
+    '''Time a fresh interpreter importing the GUI module. This is the part of
+    the cold start which precedes the creation of the main window.'''
+    package = __name__.split('.')[0]
+    python_path = os.pathsep.join(p or os.getcwd() for p in sys.path)
+    env = dict(os.environ, PYTHONPATH=python_path)
+    cmd = [sys.executable, '-c', 'import {}.gui'.format(package)]
+    latencies = []
+    t_start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(opts.repeat):
+            t0 = time.time()
+            if subprocess.call(cmd, env=env, stdout=devnull,
+                               stderr=devnull) != 0:
+                sys.stderr.write('Cannot import the GUI: skipping\n')
+                break
+            latencies.append(time.time() - t0)
+    return (latencies, time.time() - t_start)
+
+
+# Benchmarks in the order they are run.
+benchmarks = OrderedDict(
+  [('categorize_files', bench_categorize_files),
+   ('pick_files', bench_pick_files),
+   ('build_image_thumbnail', bench_build_image_thumbnail),
+   ('build_directory_thumbnail', bench_build_directory_thumbnail)] +
+  [('resize_' + backend, make_resize_benchmark(backend))
+   for backend in resize_backends] +
+  [('lay_out_images', bench_lay_out_images),
+   ('orchestrator', bench_orchestrator),
+   ('startup_imports', bench_startup_imports)])
+
+
+def _run_benchmark(name, tree, opts, conn):
+    '''(internal) Body of the child process running one benchmark: send
+    its summary through the Connection `conn`.'''
+    # Benchmarks return the latencies, the total time and, optionally,
+    # a dictionary of other results.
+    out = benchmarks[name](tree, opts)
+    result = summarize(out[0], out[1])
+    if len(out) > 2:
+        result.update(out[2])
+    conn.send(result)
+    conn.close()
+
+
+def run_benchmark(name, tree, opts):
+    '''Run the benchmark with the given name in a child process and return
+    its summary. The peak memory reported is then the one of the benchmark
+    (plus the memory of this process when the child is forked).'''
+    conn, child_conn = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_run_benchmark,
+                                      args=(name, tree, opts, child_conn))
+    process.start()
+    child_conn.close()
+    try:
+        return conn.recv()
+    except EOFError:
+        raise RuntimeError('Benchmark {} failed'.format(name))
+    finally:
+        conn.close()
+        process.join()
+
+
+def run_benchmarks(tree, opts, names=None):
+    '''Run the benchmarks with the given names (all if None) on the tree
+    returned by generate_tree(). Return an OrderedDict of summaries.'''
+    results = OrderedDict()
+    for name in (names or benchmarks.keys()):
+        sys.stderr.write('Running {}...\n'.format(name))
+        results[name] = run_benchmark(name, tree, opts)
+    return results
+
+
+def compare_results(results, baseline, threshold=0.1):
+    '''Print a comparison of `results` against `baseline` (both as returned
+    by run_benchmarks). Return the names of the benchmarks whose throughput
+    or median latency got worse by more than `threshold` (a fraction).'''
+    regressions = []
+    line = '{:<28} {:>12} {:>12} {:>8}   {:>10} {:>10} {:>8}'
+    print(line.format('benchmark', 'old ops/s', 'new ops/s', 'ratio',
+                      'old p50', 'new p50', 'ratio'))
+    for name, new in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        tp_ratio = (new['throughput_per_s']/old['throughput_per_s']
+                    if old['throughput_per_s'] > 0 else 0.0)
+        p50_ratio = (new['p50_ms']/old['p50_ms'] if old['p50_ms'] > 0
+                     else 0.0)
+        regressed = (tp_ratio < 1.0 - threshold or
+                     p50_ratio > 1.0 + threshold)
+        if regressed:
+            regressions.append(name)
+        print(line.format(name + (' *' if regressed else ''),
+                          '{:.1f}'.format(old['throughput_per_s']),
+                          '{:.1f}'.format(new['throughput_per_s']),
+                          '{:.2f}'.format(tp_ratio),
+                          '{:.2f}'.format(old['p50_ms']),
+                          '{:.2f}'.format(new['p50_ms']),
+                          '{:.2f}'.format(p50_ratio)))
+    return regressions
+
+
+def print_results(results):
+    line = '{:<28} {:>7} {:>10} {:>9} {:>9} {:>9} {:>9} {:>10} {:>8}'
+    print(line.format('benchmark', 'count', 'ops/s', 'p50 ms', 'p90 ms',
+                      'p99 ms', 'max ms', 'rss KiB', 'psnr dB'))
+    for name, r in results.items():
+        psnr = r.get('psnr_db')
+        print(line.format(name, r['count'],
+                          '{:.1f}'.format(r['throughput_per_s']),
+                          '{:.2f}'.format(r['p50_ms']),
+                          '{:.2f}'.format(r['p90_ms']),
+                          '{:.2f}'.format(r['p99_ms']),
+                          '{:.2f}'.format(r['max_ms']),
+                          r['peak_rss_kib'],
+                          '-' if psnr is None else '{:.1f}'.format(psnr)))
+
+
+def parse_size(s):
+    width, height = s.lower().split('x')
+    return (int(width), int(height))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+      prog='python -m immagine.benchmark',
+      description='Headless benchmarks for the thumbnail and layout pipeline.')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='Save the results as JSON to FILE.')
+    parser.add_argument('-c', '--compare', metavar='FILE',
+                        help='Compare the results with the JSON in FILE. The '
+                             'exit status is 1 if there are regressions.')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative change reported as a regression by '
+                             '--compare (default: 0.1).')
+    parser.add_argument('-b', '--benchmark', dest='names', action='append',
+                        choices=list(benchmarks.keys()),
+                        help='Run only this benchmark (can be repeated).')
+    parser.add_argument('--tree', metavar='DIR',
+                        help='Use the images in DIR rather than generating '
+                             'a synthetic tree.')
+    parser.add_argument('--keep', metavar='DIR',
+                        help='Generate the synthetic tree in DIR and keep it.')
+    parser.add_argument('--formats', default='jpg,png,gif,tif,bmp',
+                        help='Comma separated image formats to generate.')
+    parser.add_argument('--sizes', default='1600x1200,640x480,4000x3000',
+                        help='Comma separated image sizes to generate.')
+    parser.add_argument('--images-per-dir', type=int, default=20)
+    parser.add_argument('--depth', type=int, default=1,
+                        help='Depth of the directory tree.')
+    parser.add_argument('--fanout', type=int, default=3,
+                        help='Subdirectories in each directory.')
+    parser.add_argument('--thumbnail-size', type=parse_size,
+                        default=(200, 150))
+    parser.add_argument('--max-width', type=int, default=1200,
+                        help='Width of the album used by lay_out_images.')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Times each benchmark is repeated.')
+    parser.add_argument('--timeout', type=float, default=600.0,
+                        help='Timeout in seconds for the orchestrator run.')
+    opts = parser.parse_args(args)
+
+    params = OrderedDict()
+    if opts.tree is not None:
+        root = os.path.realpath(opts.tree)
+        tree = {'images': [], 'dirs': []}
+        for dir_path, dir_names, file_names in os.walk(root):
+            tree['dirs'].append(dir_path)
+            entries = categorize_files([os.path.join(dir_path, name)
+                                        for name in file_names])
+            tree['images'].extend(e.full_path for e in entries)
+        params['tree'] = root
+        cleanup = False
+    else:
+        root = opts.keep or tempfile.mkdtemp(prefix='immagine-bench-')
+        formats = tuple(opts.formats.split(','))
+        sizes = tuple(parse_size(s) for s in opts.sizes.split(','))
+        params['formats'] = formats
+        params['sizes'] = sizes
+        params['images_per_dir'] = opts.images_per_dir
+        params['depth'] = opts.depth
+        params['fanout'] = opts.fanout
+        sys.stderr.write('Generating synthetic tree in {}...\n'.format(root))
+        tree = generate_tree(root, formats=formats, sizes=sizes,
+                             images_per_dir=opts.images_per_dir,
+                             depth=opts.depth, fanout=opts.fanout)
+        cleanup = (opts.keep is None)
+    params['num_images'] = len(tree['images'])
+    params['num_dirs'] = len(tree['dirs'])
+    params['thumbnail_size'] = opts.thumbnail_size
+    params['max_width'] = opts.max_width
+    params['repeat'] = opts.repeat
+
+    try:
+        results = run_benchmarks(tree, opts, opts.names)
+    finally:
+        if cleanup:
+            shutil.rmtree(root, ignore_errors=True)
+
+    print_results(results)
+    if opts.output is not None:
+        report = OrderedDict()
+        report['version'] = version
+        report['python'] = platform.python_version()
+        report['platform'] = platform.platform()
+        report['cpu_count'] = multiprocessing.cpu_count()
+        report['timestamp'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        report['params'] = params
+        report['results'] = results
+        with open(opts.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if opts.compare is not None:
+        with open(opts.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline['results'],
+                                      opts.threshold)
+        if regressions:
+            sys.exit(1)
@@ -122,6 +122,11 @@ class BrowserTab(BaseTab):
     def go_to_directory(self, directory):
         self._image_browser.go_to_directory(directory)
 
+    def get_cached_thumbnail(self, file_name):
+        '''Return the pixel data of the thumbnail for the given file, if it is
+        available in the thumbnail cache, or None.'''
+        return self._image_browser.get_cached_thumbnail(file_name)
+
     def update_album(self):
         '''Regenerate the album after a change of configuration.'''
         self._image_browser.update_album()
@@ -0,0 +1,73 @@
+# Copyright 2017 Matteo Franchin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Command line of the application.
+
+This module does not import gtk nor the image libraries, so that the
+arguments are parsed before deciding what to start (see main in
+__init__.py).
+'''
+
+import argparse
+
+from .config import version
+
+
+def parse_args(argv=None):
+    '''Parse the command line arguments (sys.argv[1:] if `argv` is None)
+    and return them as an argparse.Namespace.'''
+    dsc = ('Immagine {} - image viewer with focus on the browsing experience'
+           .format(version))
+    parser = argparse.ArgumentParser(description=dsc)
+    parser.add_argument('paths', metavar='PATH', type=str, nargs='*',
+                        help=('Path to file or directory. All paths to files '
+                              'are handled by opening a viewer tab. Only one '
+                              'directory path should be provided and is used '
+                              'as the initial browsing directory.'))
+    parser.add_argument('-l', '--log', metavar='LEVEL', dest='loglevel',
+                        choices=['DEBUG', 'WARN', 'ERROR', 'SILENT'],
+                        default=None,
+                        help='Log level. One of: DEBUG, WARN, ERROR, SILENT.')
+    parser.add_argument('--stats', metavar='SECONDS', dest='stats_interval',
+                        type=float, default=None,
+                        help=('Log statistics about thumbnail requests (queue '
+                              'depth, latencies, cache hit rate, ...) every '
+                              'SECONDS seconds.'))
+    parser.add_argument('--stats-file', metavar='FILE', default=None,
+                        help=('Periodically dump the statistics about '
+                              'thumbnail requests as JSON to FILE.'))
+    parser.add_argument('--prethumbnail', action='store_true',
+                        help=('Generate the thumbnails for all the images and '
+                              'directories inside the given directories '
+                              '(default: the current directory) and store '
+                              'them in the thumbnail cache, then exit. No '
+                              'window is opened. Thumbnails which are up to '
+                              'date are skipped, so an interrupted run can '
+                              'be resumed by running it again.'))
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=None,
+                        help=('Number of processes used by --prethumbnail '
+                              '(default: one per core).'))
+    parser.add_argument('--profile', action='store_true',
+                        help=('Record the duration of drawing and layout in '
+                              'the GUI thread, report frames slower than '
+                              'the frame budget and log a summary on exit.'))
+    parser.add_argument('--frame-budget', metavar='MS', type=float,
+                        default=1000.0/60,
+                        help=('Frame budget in milliseconds used by '
+                              '--profile (default: 16.7).'))
+    parser.add_argument('--profile-output', metavar='FILE', default=None,
+                        help=('Profile the GUI thread with cProfile and save '
+                              'the data to FILE on exit (implies --profile).'))
+
+    return parser.parse_args(argv)
@@ -0,0 +1,107 @@
+# Copyright 2017 Matteo Franchin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Limits on the resources used to decode images.
+
+Images may be huge (scans of tens of thousands of pixels per side) or
+crafted to expand to gigabytes of pixels when decoded (decompression bombs).
+The limits defined here are enforced by the thumbnailers (see
+thumbnailers.py) and by the worker processes, whose memory is capped.
+'''
+
+from .config import logger, SCALAR
+
+
+class DecodeLimitError(ValueError):
+    '''Raised when an image exceeds the decoding limits.'''
+
+
+# Pillow refuses to decode images with more pixels than this (see
+# PIL.Image.MAX_IMAGE_PIXELS), to protect against decompression bombs.
+PIL_MAX_IMAGE_PIXELS = 178956970
+
+
+class DecodeLimits(object):
+    '''Decoding limits. `max_pixels` is the number of pixels above which
+    images are not decoded at all. Images with more than `stream_pixels`
+    pixels are decoded in bands and scaled down incrementally, when their
+    format allows it. Images with more than `max_full_pixels` pixels are
+    decoded only if they are reduced while decoding (in bands or, for JPEG
+    images, at a lower resolution), as their pixels would otherwise be all
+    in memory at the same time. `memory_limit` is the maximum memory (in MiB) a
+    worker process can allocate. A value of 0 or None disables a limit.
+
+    The memory limit is off by default: it caps the address space of the
+    worker, which also counts memory which is reserved but never used (e.g.
+    by the allocators of numpy or of the thread stacks), and could make
+    ordinary images fail to decode.'''
+
+    def __init__(self, max_pixels=1000000000, stream_pixels=64000000,
+                 max_full_pixels=PIL_MAX_IMAGE_PIXELS, memory_limit=None):
+        self.max_pixels = max_pixels
+        self.stream_pixels = stream_pixels
+        self.max_full_pixels = max_full_pixels
+        self.memory_limit = memory_limit
+
+    def check(self, image_size):
+        '''Raise DecodeLimitError if an image with the given size should not
+        be decoded.'''
+        width, height = image_size
+        if self.max_pixels and width*height > self.max_pixels:
+            raise DecodeLimitError('Image too big ({}x{} pixels, limit is {})'
+                                   .format(width, height, self.max_pixels))
+
+    def check_full(self, image_size):
+        '''Raise DecodeLimitError if an image with the given size should not
+        be decoded all at once, without being reduced while decoding.'''
+        width, height = image_size
+        if self.max_full_pixels and width*height > self.max_full_pixels:
+            raise DecodeLimitError('Image too big to be decoded at once '
+                                   '({}x{} pixels, limit is {})'
+                                   .format(width, height,
+                                           self.max_full_pixels))
+
+    def apply(self):
+        '''Apply the limits to the current process. This is meant to be
+        called in the worker processes.'''
+        import PIL.Image
+        from . import thumbnailers
+
+        # The pixel limits are checked by the thumbnailers, which let the
+        # images reduced while decoding go past PIL's own limit. Raise it,
+        # so that it does not get in the way.
+        PIL.Image.MAX_IMAGE_PIXELS = self.max_pixels or None
+        thumbnailers.set_decode_limits(self)
+
+        if self.memory_limit:
+            try:
+                import resource
+                limit = int(self.memory_limit*1024*1024)
+                _, hard = resource.getrlimit(resource.RLIMIT_AS)
+                if hard != resource.RLIM_INFINITY:
+                    limit = min(limit, hard)
+                resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+            except (ImportError, ValueError, OSError) as exc:
+                logger.warn('Cannot limit the memory of the worker process: {}'
+                            .format(str(exc)))
+
+
+def get_decode_limits(config):
+    '''Return the DecodeLimits configured in `config`.'''
+    return DecodeLimits(
+      max_pixels=config.get('thumb.max_pixels', 1000000000, SCALAR),
+      stream_pixels=config.get('thumb.stream_pixels', 64000000, SCALAR),
+      max_full_pixels=config.get('thumb.max_full_pixels',
+                                 PIL_MAX_IMAGE_PIXELS, SCALAR),
+      memory_limit=config.get('thumb.worker_memory_mb', 0, SCALAR))
@@ -0,0 +1,161 @@
+# Copyright 2017 Matteo Franchin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Detection of changes in a directory, via inotify or via polling.
+
+Watchers do not call back: they expose a file descriptor (inotify) or a
+check() method (polling) so that the GUI can integrate them in its main loop.
+'''
+
+import os
+import sys
+import errno
+import struct
+import ctypes
+import ctypes.util
+
+from .config import logger
+from .file_utils import get_mtime
+
+# Flags and event masks from <sys/inotify.h>.
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+_event_header = struct.Struct('iIII')
+
+_libc = None
+
+def _get_libc():
+    '''Return the C library if it provides inotify, None otherwise.'''
+    global _libc
+    if _libc is None:
+        _libc = False
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            if (hasattr(libc, 'inotify_init1') and
+                hasattr(libc, 'inotify_add_watch')):
+                _libc = libc
+        except (OSError, TypeError):
+            pass
+    return _libc or None
+
+
+class InotifyWatcher(object):
+    '''Watch the entries of a directory using Linux inotify.'''
+
+    mask = (IN_ATTRIB | IN_CLOSE_WRITE | IN_CREATE | IN_DELETE |
+            IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF |
+            IN_ONLYDIR)
+
+    def __init__(self, dir_path):
+        libc = _get_libc()
+        if libc is None:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.dir_path = dir_path
+        self._fd = fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        path = dir_path
+        if not isinstance(path, bytes):
+            path = path.encode(sys.getfilesystemencoding())
+        wd = libc.inotify_add_watch(fd, path, self.mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(err, 'inotify_add_watch failed for ' + dir_path)
+
+    def fileno(self):
+        return self._fd
+
+    def read_changes(self):
+        '''Read the pending events. Return the set of names of the directory
+        entries which changed, or None when the changes cannot be tracked
+        individually (events were lost or the directory itself was moved or
+        deleted) and the whole directory should be listed again.
+        '''
+        names = set()
+        while True:
+            try:
+                buf = os.read(self._fd, 65536)
+            except OSError as exc:
+                if exc.errno in (errno.EAGAIN, errno.EINTR):
+                    return names
+                raise
+            if not buf:
+                return names
+
+            pos = 0
+            while pos + _event_header.size <= len(buf):
+                wd, mask, cookie, length = \
+                  _event_header.unpack_from(buf, pos)
+                pos += _event_header.size
+                name = buf[pos:pos + length].rstrip(b'\0')
+                pos += length
+                if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF | IN_MOVE_SELF |
+                           IN_IGNORED):
+                    return None
+                if name:
+                    names.add(name if isinstance(name, str)
+                              else os.fsdecode(name))
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class PollingWatcher(object):
+    '''Fallback watcher which polls the modification time of the directory.
+    This detects entries being added, removed or renamed, but not files being
+    modified in place.
+    '''
+
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+        self._mtime = get_mtime(dir_path)
+
+    def fileno(self):
+        return None
+
+    def check(self):
+        '''Return whether the directory changed since the last call.'''
+        mtime = get_mtime(self.dir_path)
+        changed = (mtime != self._mtime)
+        self._mtime = mtime
+        return changed
+
+    def close(self):
+        pass
+
+
+def create_watcher(dir_path):
+    '''Return an InotifyWatcher for the given directory, or a PollingWatcher
+    if inotify is not available.'''
+    try:
+        return InotifyWatcher(dir_path)
+    except OSError as exc:
+        logger.debug('Falling back to polling for {}: {}'
+                     .format(dir_path, exc))
+        return PollingWatcher(dir_path)
@@ -0,0 +1,184 @@
+# Copyright 2017 Matteo Franchin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Classification of files from their content, rather than their name.
+
+Files are classified by reading their first bytes (see formats.py), so that
+images without a known extension are shown and files which are not images
+are rejected without being opened with PIL. The reads for a directory are
+done in parallel, which hides the latency of network file systems. Results
+are kept in a persistent index, one JSON file per directory, so that only
+new or modified files are read when a directory is listed again.
+'''
+
+import os
+import json
+import hashlib
+from threading import Lock
+from multiprocessing.pool import ThreadPool
+
+from .formats import get_format, get_format_from_file
+from .file_utils import get_cache_dir, write_file_atomically
+from .config import logger
+
+
+class FileTypeIndex(object):
+    '''Persistent index of the formats of the files. For each directory, the
+    index maps file names to tuples (size, mtime, format_name), where
+    format_name is None for files which are not images. An entry is valid as
+    long as the size and the modification time of the file do not change.
+    '''
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+
+    def get_index_path(self, dir_path):
+        '''Return the path of the index file for the given directory.'''
+        full_path = os.path.realpath(dir_path)
+        if not isinstance(full_path, bytes):
+            full_path = full_path.encode('utf-8')
+        name = hashlib.md5(full_path).hexdigest() + '.json'
+        return os.path.join(self.index_dir, name)
+
+    def load(self, dir_path):
+        '''Return the index of the given directory, as a dictionary, or an
+        empty dictionary if there is no index for it.'''
+        index_path = self.get_index_path(dir_path)
+        try:
+            with open(index_path) as f:
+                items = json.load(f).items()
+        except IOError:
+            return {}
+        except (ValueError, AttributeError) as exc:
+            logger.debug('Ignoring damaged index {}: {}'
+                         .format(index_path, str(exc)))
+            return {}
+
+        index = {}
+        for name, value in items:
+            if not isinstance(name, str):
+                name = name.encode('utf-8')
+            index[name] = tuple(value)
+        return index
+
+    def store(self, dir_path, index):
+        '''Store the index of the given directory. The file is written
+        atomically.'''
+        try:
+            write_file_atomically(self.get_index_path(dir_path),
+                                  lambda f: json.dump(index, f))
+        except Exception as exc:
+            logger.error('Cannot store the file index for {}: {}'
+                         .format(dir_path, str(exc)))
+            return False
+        return True
+
+
+class FileSniffer(object):
+    '''Classify files from their magic bytes, reading them with a pool of
+    `num_threads` threads and caching the results in the FileTypeIndex
+    `index` (if not None).'''
+
+    def __init__(self, index=None, num_threads=8):
+        self.index = index
+        self.num_threads = num_threads
+        self._pool = None
+        self._pool_lock = Lock()
+
+    def _map(self, fn, items):
+        '''(internal) Apply `fn` to all the items, in parallel.'''
+        if self.num_threads <= 1 or len(items) <= 1:
+            return [fn(item) for item in items]
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.num_threads)
+        return self._pool.map(fn, items)
+
+    def classify(self, entries, complete=False):
+        '''Return a list with the ImageFormat of each of the given FileEntry
+        objects (None for the files which are not images). `complete` tells
+        whether `entries` contains all the files of their directories, in
+        which case the entries of the other files are dropped from the index.
+        '''
+        by_dir = {}
+        for i, entry in enumerate(entries):
+            dir_path, name = os.path.split(entry.full_path)
+            by_dir.setdefault(dir_path, []).append((i, name, entry))
+
+        formats = [None]*len(entries)
+        for dir_path, items in by_dir.items():
+            index = (self.index.load(dir_path) if self.index is not None
+                     else {})
+            num_indexed = len(index)
+            to_sniff = []
+            for i, name, entry in items:
+                indexed = index.get(name)
+                if (indexed is not None and
+                    tuple(indexed[:2]) == (entry.size, entry.mtime)):
+                    fmt = (get_format(indexed[2]) if indexed[2] else None)
+                    if fmt is None or fmt.is_available():
+                        formats[i] = fmt
+                        continue
+                to_sniff.append((i, name, entry))
+
+            sniffed = self._map(get_format_from_file,
+                                [entry.full_path for _, _, entry in to_sniff])
+            for (i, name, entry), fmt in zip(to_sniff, sniffed):
+                formats[i] = fmt
+                index[name] = (entry.size, entry.mtime,
+                               fmt.name if fmt is not None else None)
+
+            if complete:
+                names = set(name for _, name, _ in items)
+                index = dict((name, value) for name, value in index.items()
+                             if name in names)
+            if self.index is not None and (to_sniff or
+                                           len(index) != num_indexed):
+                self.index.store(dir_path, index)
+        return formats
+
+    def filter(self, entries, complete=False):
+        '''Return a tuple (accepted, num_rejected) where accepted is the list
+        of the given FileEntry objects which are either directories or images
+        and num_rejected is the number of the other entries. See classify for
+        the meaning of `complete`.'''
+        files = [entry for entry in entries if not entry.is_dir]
+        formats = self.classify(files, complete=complete)
+        rejected = set(entry.full_path
+                       for entry, fmt in zip(files, formats) if fmt is None)
+        return ([entry for entry in entries
+                 if entry.full_path not in rejected], len(rejected))
+
+
+def get_default_index_dir():
+    return get_cache_dir('file_types')
+
+
+_file_sniffer = None
+
+def get_file_sniffer(config):
+    '''Return the FileSniffer configured in `config` or None if files are
+    classified from their extension only.'''
+    global _file_sniffer
+    if not config.get('browser.sniff_file_types', False, bool):
+        return None
+    if _file_sniffer is None:
+        index = None
+        if config.get('browser.file_type_index', True, bool):
+            index_dir = (config.get('browser.file_type_index_dir', None,
+                                    basestring) or get_default_index_dir())
+            index = FileTypeIndex(os.path.expanduser(index_dir))
+        num_threads = config.get('browser.sniff_threads', 8, int)
+        _file_sniffer = FileSniffer(index, num_threads=num_threads)
+    return _file_sniffer
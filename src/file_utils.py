@@ -15,16 +15,41 @@
 '''Generic utility for file sorting.'''
 
 import os
-from collections import deque
+import re
+import stat
+import tempfile
+import threading
+from collections import deque, namedtuple
+
+from .formats import get_image_extensions
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+# Information gathered for each directory entry while listing a directory.
+# This is collected with at most one stat() call per entry and is then reused
+# for filtering and sorting, so that no further syscalls are needed.
+FileEntry = namedtuple('FileEntry', ('is_dir', 'full_path', 'size', 'mtime'))
+
+# Splits file names into text and number chunks, for natural sorting.
+_digits_re = re.compile(r'(\d+)')
 
 
 class FileListItem(object):
-    def __init__(self, index, is_dir, dir_path, name):
+    def __init__(self, index, is_dir, dir_path, name, size=0, mtime=0.0):
         self.index = index
         self.is_dir = is_dir
         self.dir_path = dir_path
         self.name = name
         self.full_path = os.path.join(dir_path, name)
+        self.size = size
+        self.mtime = mtime
 
 
 class FileList(object):
@@ -32,39 +57,298 @@ class FileList(object):
      SORT_BY_MOD_DATE,
      SORT_BY_FILE_EXT,
      SORT_BY_FILE_SIZE,
-     SORT_BY_IS_DIR) = range(5)
+     SORT_BY_IS_DIR,
+     SORT_BY_NATURAL_NAME) = range(6)
 
     @classmethod
     def build_key_generator(cls, sort_types, case_sensitive=False):
+        '''Return a function mapping a FileEntry (or a FileListItem) to its
+        sort key. The key is computed from the information cached in the entry
+        and does not access the file system.
+        '''
         adj = ((lambda x: x) if case_sensitive else (lambda x: x.lower()))
 
         gns = []
         for sort_type in sort_types:
             if sort_type == cls.SORT_BY_FILE_NAME:
-                gn = lambda is_dir, fn: adj(os.path.split(fn)[-1])
+                gn = lambda e: adj(os.path.split(e.full_path)[-1])
+            elif sort_type == cls.SORT_BY_NATURAL_NAME:
+                gn = lambda e: natural_key(adj(os.path.split(e.full_path)[-1]))
             elif sort_type == cls.SORT_BY_FILE_EXT:
-                gn = lambda is_dir, fn: adj(os.path.splitext(fn)[-1])
+                gn = lambda e: adj(os.path.splitext(e.full_path)[-1])
             elif sort_type == cls.SORT_BY_MOD_DATE:
-                gn = lambda is_dir, fn: os.path.getmtime(fn)
+                gn = lambda e: e.mtime
             elif sort_type == cls.SORT_BY_FILE_SIZE:
-                gn = lambda is_dir, fn: os.path.getsize(fn)
+                gn = lambda e: e.size
             elif sort_type == cls.SORT_BY_IS_DIR:
-                gn = lambda is_dir, fn: (0 if is_dir else 1)
+                gn = lambda e: (0 if e.is_dir else 1)
             else:
                 continue
             gns.append(gn)
 
-        def key_generator(item):
-            return tuple(gn(*item) for gn in gns)
+        def key_generator(entry):
+            return tuple(gn(entry) for gn in gns)
         return key_generator
 
-    def __init__(self, dir_path, **kwargs):
+    @classmethod
+    def get_sort_types(cls, sort_type):
+        '''Map a single sort type to the tuple of sort types actually used,
+        from the one with the highest precedence to the one with the lowest.
+        '''
+        # For now we only provide one sort type. Later we may want to let the
+        # user choose a tuple of sort types. Infrastructure for this is
+        # already in place. Here we map the single sort order to a tuple
+        # which makes sense.
+        if sort_type in (cls.SORT_BY_FILE_NAME, cls.SORT_BY_NATURAL_NAME):
+            return (sort_type,)
+        return (sort_type, cls.SORT_BY_FILE_NAME)
+
+    def __init__(self, dir_path, sort_type=None, reversed_sort=False,
+                 show_hidden_files=True, file_extensions=None, sniffer=None,
+                 recursive=False, num_walk_threads=4, **kwargs):
+        '''Create the list of the files in `dir_path`. If `recursive` is
+        true, the list contains all the images in the directory tree rooted
+        at `dir_path` (but not the directories). The tree is walked in the
+        background by `num_walk_threads` threads: the list starts empty and
+        grows every time update_walk is called.'''
         self.callbacks = []
         self.full_path = dir_path = os.path.realpath(dir_path)
-        self.file_items = items = []
-        for i, args in enumerate(get_files_in_dir(dir_path, **kwargs)):
-            is_dir, name = args
-            items.append(FileListItem(i, is_dir, dir_path, name))
+        self.show_hidden_files = show_hidden_files
+        self.file_extensions = file_extensions or image_file_extensions
+        self.sniffer = sniffer
+        self.recursive = recursive
+        self.num_walk_threads = num_walk_threads
+        self.dir_mtime = get_mtime(dir_path)
+
+        # Whether the list contains all the files (see update_walk).
+        self.complete = not recursive
+        self._walker = None
+
+        # Paths found by a walk which replaces a previous one (see refresh),
+        # or None.
+        self._walk_seen = None
+        if recursive:
+            self._walker = self._start_walk()
+            entries = []
+        else:
+            entries = scan_dir(dir_path, show_hidden_files=show_hidden_files,
+                               file_extensions=self.file_extensions,
+                               sniffer=sniffer, **kwargs)
+
+        # Items in the order they were listed. Sort keys are computed once per
+        # item and sort type and are stored in lists aligned with this one.
+        self._listed_items = \
+          [FileListItem(i, entry.is_dir, dir_path, entry.full_path,
+                        entry.size, entry.mtime)
+           for i, entry in enumerate(entries)]
+        self._sort_keys = {}
+        self.file_items = list(self._listed_items)
+        self.sort_type = None
+        self.reversed_sort = False
+        self.sort(sort_type, reversed_sort)
+
+    def sort(self, sort_type, reversed_sort=False):
+        '''Sort the items with the given sort type and order, updating their
+        index. This does not access the file system: sort keys are computed
+        from the data gathered while listing the directory and are cached, so
+        that toggling the order or going back to a previous sort type only
+        costs a sort of the cached keys. Return whether the sort settings
+        changed.
+        '''
+        if sort_type == self.sort_type and reversed_sort == self.reversed_sort:
+            return False
+
+        self.sort_type = sort_type
+        self.reversed_sort = reversed_sort
+        self._sort()
+        return True
+
+    def _sort(self):
+        '''(internal) Sort the items using the current sort settings.'''
+        sort_type = self.sort_type
+        reversed_sort = self.reversed_sort
+        listed = self._listed_items
+        order = range(len(listed))
+        if sort_type is not None:
+            keys = self._sort_keys.get(sort_type)
+            if keys is None:
+                key = self.build_key_generator(self.get_sort_types(sort_type))
+                self._sort_keys[sort_type] = keys = [key(i) for i in listed]
+            order = sorted(order, key=keys.__getitem__, reverse=reversed_sort)
+        elif reversed_sort:
+            order = reversed(order)
+
+        self.file_items = items = [listed[i] for i in order]
+        for i, item in enumerate(items):
+            item.index = i
+
+    def _start_walk(self):
+        '''(internal) Return a TreeWalker walking the tree of this list.'''
+        return TreeWalker(self.full_path, num_threads=self.num_walk_threads,
+                          show_hidden_files=self.show_hidden_files,
+                          file_extensions=self.file_extensions,
+                          sniffer=self.sniffer)
+
+    def is_walking(self):
+        '''Whether the tree of a recursive list is still being walked.'''
+        return self._walker is not None
+
+    def update_walk(self):
+        '''Add to a recursive list the files found by the tree walk since the
+        last call. The list is sorted again and the registered callbacks are
+        called with the added items (see refresh). Return whether the walk is
+        still in progress. This should be called periodically from the thread
+        which uses the list, until it returns False.'''
+        walker = self._walker
+        if walker is None:
+            return False
+
+        # Check for completion first, so that no entry is left behind.
+        walking = not walker.is_done()
+        entries = walker.take_entries()
+        seen = self._walk_seen
+        added = []
+        removed = []
+        modified = []
+        if seen is None:
+            added = [FileListItem(None, False, self.full_path,
+                                  entry.full_path, entry.size, entry.mtime)
+                     for entry in entries]
+        else:
+            # The walk replaces a previous one: update the existing items and
+            # remove those which were not found, once the walk is over.
+            by_path = dict((item.full_path, item)
+                           for item in self._listed_items)
+            for entry in entries:
+                seen.add(entry.full_path)
+                item = by_path.get(entry.full_path)
+                if item is None:
+                    added.append(FileListItem(None, False, self.full_path,
+                                              entry.full_path, entry.size,
+                                              entry.mtime))
+                elif (entry.size, entry.mtime) != (item.size, item.mtime):
+                    item.size = entry.size
+                    item.mtime = entry.mtime
+                    modified.append(item)
+            if not walking:
+                removed = [item for item in self._listed_items
+                           if item.full_path not in seen]
+
+        if not walking:
+            self._walker = None
+            self._walk_seen = None
+            self.complete = True
+        self._apply_changes(added, removed, modified)
+        return walking
+
+    def stop_walk(self):
+        '''Stop the walk of the tree of a recursive list. The list is left
+        incomplete.'''
+        if self._walker is not None:
+            self._walker.cancel()
+            self._walker = None
+        self._walk_seen = None
+
+    def _filter(self, entries):
+        '''(internal) Return the given FileEntry objects which belong to this
+        list. None entries are ignored. The files are classified with a
+        single call to the sniffer, if any.'''
+        entries = [entry for entry in entries
+                   if entry is not None and
+                   not (self.recursive and entry.is_dir) and
+                   (self.show_hidden_files or not is_hidden(entry.full_path))]
+        if self.sniffer is not None:
+            return self.sniffer.filter(entries)[0]
+        return [entry for entry in entries
+                if entry.is_dir or
+                os.path.splitext(entry.full_path)[1].lower()
+                in self.file_extensions]
+
+    def refresh(self, names=None):
+        '''Bring the list up to date with the content of the directory.
+        `names` are the names of the directory entries which may have
+        changed: only these are stat()-ed again. If `names` is None, the whole
+        directory is listed again and compared with the list.
+
+        Items for removed entries are dropped, new items are created for new
+        entries and the size and modification time of existing items are
+        updated. The list is then sorted again and the registered callbacks
+        are called as callback(file_list, changed_items) where changed_items
+        is the list of added, removed and modified items. Return this list.
+
+        For recursive lists, a None `names` starts a new walk of the tree and
+        an empty list is returned: the changes are applied and reported by
+        update_walk, which must then be called as after creating the list.
+        '''
+        self.dir_mtime = get_mtime(self.full_path)
+        if names is None and self.recursive:
+            # Walk the tree again in the background. The changes are applied
+            # by update_walk.
+            self.stop_walk()
+            self._walker = self._start_walk()
+            self._walk_seen = set()
+            self.complete = False
+            return []
+
+        by_path = dict((item.full_path, item) for item in self._listed_items)
+        if names is None:
+            entries = scan_dir(self.full_path,
+                               show_hidden_files=self.show_hidden_files,
+                               file_extensions=self.file_extensions,
+                               sniffer=self.sniffer)
+            new_entries = dict((entry.full_path, entry) for entry in entries)
+            changes = [(path, new_entries.get(path))
+                       for path in set(by_path).union(new_entries)]
+        else:
+            paths = [os.path.join(self.full_path, name) for name in names]
+            accepted = dict((entry.full_path, entry) for entry in
+                            self._filter([stat_file(path) for path in paths]))
+            changes = [(path, accepted.get(path)) for path in paths]
+
+        added = []
+        removed = set()
+        modified = []
+        for path, entry in changes:
+            item = by_path.get(path)
+            if item is not None:
+                if entry is not None and entry.is_dir == item.is_dir:
+                    if (entry.size, entry.mtime) != (item.size, item.mtime):
+                        item.size = entry.size
+                        item.mtime = entry.mtime
+                        modified.append(item)
+                    continue
+                removed.add(item)
+            if entry is not None:
+                added.append(FileListItem(None, entry.is_dir, self.full_path,
+                                          path, entry.size, entry.mtime))
+        return self._apply_changes(added, removed, modified)
+
+    def _apply_changes(self, added, removed, modified):
+        '''(internal) Add and remove the given items, sort the list again and
+        call the callbacks (see refresh). `modified` are items whose size and
+        modification time were updated. Return the changed items.'''
+        changed_items = added + list(removed) + modified
+        if len(changed_items) == 0:
+            return changed_items
+
+        # Update the listed items and their cached sort keys incrementally.
+        listed = self._listed_items
+        removed = set(removed)
+        kept = [i for i, item in enumerate(listed) if item not in removed]
+        self._listed_items = [listed[i] for i in kept] + added
+        new_index = dict((item, i)
+                         for i, item in enumerate(self._listed_items))
+        for sort_type, keys in self._sort_keys.items():
+            key = self.build_key_generator(self.get_sort_types(sort_type))
+            keys = [keys[i] for i in kept] + [key(item) for item in added]
+            for item in modified:
+                keys[new_index[item]] = key(item)
+            self._sort_keys[sort_type] = keys
+        self._sort()
+
+        for callback in self.callbacks:
+            callback(self, changed_items)
+        return changed_items
 
     def __iter__(self):
         return iter(self.file_items)
@@ -79,8 +363,99 @@ class FileList(object):
         self.callbacks.append(update_callback)
 
 
-image_file_extensions = \
-  ('.jpeg', '.jpg', '.png', '.tif', '.xpm', '.bmp', '.gif')
+# Extensions of the image files, for the formats which can be decoded.
+image_file_extensions = get_image_extensions()
+
+class TreeWalker(object):
+    '''Walk a directory tree with a pool of `num_threads` threads, collecting
+    the FileEntry objects of the files (directories are not collected).
+    Results are streamed: take_entries returns the entries found since its
+    last call, while the walk continues in the background. Each directory is
+    visited once, even when symlinks form loops (see pick_files). Symlinks
+    to directories are followed only if `follow_links` is true. The other
+    keyword arguments are passed to scan_dir.
+    '''
+
+    def __init__(self, root, num_threads=4, follow_links=False, **kwargs):
+        self.root = root
+        self.follow_links = follow_links
+        self.kwargs = kwargs
+        self._cond = threading.Condition()
+        self._dirs_to_visit = deque([root])
+        self._visited = set([os.path.realpath(root)])
+        self._num_busy = 0
+        self._entries = []
+        self._cancelled = False
+        self._threads = [threading.Thread(target=self._thread_main,
+                                          name='tree-walker')
+                         for _ in range(max(1, num_threads))]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _thread_main(self):
+        cond = self._cond
+        while True:
+            with cond:
+                while (not self._dirs_to_visit and self._num_busy > 0 and
+                       not self._cancelled):
+                    cond.wait()
+                if self._cancelled or not self._dirs_to_visit:
+                    cond.notify_all()
+                    return
+                dir_path = self._dirs_to_visit.popleft()
+                self._num_busy += 1
+
+            files = []
+            subdirs = []
+            try:
+                for entry in scan_dir(dir_path,
+                                      check_cancelled=self._is_cancelled,
+                                      **self.kwargs):
+                    path = entry.full_path
+                    if not entry.is_dir:
+                        files.append(entry)
+                    elif self.follow_links or not os.path.islink(path):
+                        subdirs.append(path)
+            finally:
+                with cond:
+                    self._entries.extend(files)
+                    for path in subdirs:
+                        real_path = os.path.realpath(path)
+                        if real_path not in self._visited:
+                            self._visited.add(real_path)
+                            self._dirs_to_visit.append(path)
+                    self._num_busy -= 1
+                    cond.notify_all()
+
+    def _is_cancelled(self):
+        return self._cancelled
+
+    def is_done(self):
+        '''Whether the walk finished or was cancelled.'''
+        with self._cond:
+            return (self._cancelled or
+                    (not self._dirs_to_visit and self._num_busy == 0))
+
+    def take_entries(self):
+        '''Return the entries found since the last call.'''
+        with self._cond:
+            entries = self._entries
+            self._entries = []
+        return entries
+
+    def cancel(self):
+        '''Stop the walk. The threads exit after the directory they are
+        listing.'''
+        with self._cond:
+            self._cancelled = True
+            self._cond.notify_all()
+
+    def join(self):
+        '''Wait for the walk to finish.'''
+        for thread in self._threads:
+            thread.join()
+
 
 def list_dir(directory_path, check_cancelled=None):
     '''Return the files in the directory or an empty list if the directory
@@ -96,14 +471,123 @@ def list_dir(directory_path, check_cancelled=None):
         return []
     return [os.path.join(directory_path, entry) for entry in entries]
 
-def get_files_in_dir(directory_path, check_cancelled=None, **kwargs):
-    '''Return tuples (isdir, full_path) where isdir is a boolean indicating
-    whether the item is a directory and full_path is the path to it.
-    The following keyword arguments can be used:
+def get_mtime(full_path):
+    '''Return the modification time of the given path or None if the path
+    cannot be accessed.'''
+    try:
+        return os.stat(full_path).st_mtime
+    except OSError:
+        return None
+
+def get_cache_dir(name):
+    '''Return the directory where the cache `name` is stored, following the
+    XDG base directory specification.'''
+    base = os.getenv('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(base, 'immagine', name)
+
+def write_file_atomically(path, write, mode='w', mtime=None):
+    '''Write the file `path` atomically: a temporary file is opened in the
+    same directory (created if missing) with the given mode, passed to the
+    function `write` and then renamed to `path`. If `mtime` is given, it is
+    set as the modification time of the file before the rename.'''
+    dir_path = os.path.dirname(path)
+    if not os.path.isdir(dir_path):
+        os.makedirs(dir_path)
+    fd, tmp_path = tempfile.mkstemp(suffix=os.path.splitext(path)[1],
+                                    dir=dir_path)
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        if mtime is not None:
+            os.utime(tmp_path, (mtime, mtime))
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+def stat_file(full_path):
+    '''Return a FileEntry for the given path or None if the path cannot be
+    accessed (e.g. it does not exist or is a broken symlink). Only one stat()
+    call is done.
+    '''
+    try:
+        st = os.stat(full_path)
+    except OSError:
+        return None
+    return FileEntry(stat.S_ISDIR(st.st_mode), full_path,
+                     st.st_size, st.st_mtime)
+
+def scan_dir(directory_path, file_extensions=None, show_hidden_files=True,
+             check_cancelled=None, out=None, sniffer=None):
+    '''Return a list of FileEntry objects for the directories and for the
+    files with matching extension contained in `directory_path`.
+
+    When scandir is available the entry type is taken from the directory
+    entry itself, so files with the wrong extension are rejected without
+    any stat() call. The remaining entries are stat()-ed exactly once.
+    Otherwise, this falls back to listdir() plus one stat() per entry.
+    See get_files_in_dir for the meaning of the keyword arguments.
+    '''
+    if scandir is None:
+        return categorize_files(list_dir(directory_path, check_cancelled),
+                                file_extensions=file_extensions,
+                                show_hidden_files=show_hidden_files, out=out,
+                                sniffer=sniffer, complete=True)
+
+    if check_cancelled is not None and check_cancelled():
+        return []
+
+    exts = file_extensions or image_file_extensions
+    entries = []
+    num_skipped = 0
+    try:
+        dir_entries = scandir(directory_path)
+        for dir_entry in dir_entries:
+            if not show_hidden_files and dir_entry.name.startswith('.'):
+                continue
+
+            try:
+                isdir = dir_entry.is_dir()
+                if not isdir and sniffer is None:
+                    ext = os.path.splitext(dir_entry.name)[1]
+                    if ext.lower() not in exts:
+                        num_skipped += 1
+                        continue
+                elif not isdir and not dir_entry.is_file():
+                    num_skipped += 1
+                    continue
+                st = dir_entry.stat()
+            except OSError:
+                num_skipped += 1
+                continue
+
+            entries.append(FileEntry(isdir, dir_entry.path,
+                                     st.st_size, st.st_mtime))
+    except OSError:
+        pass
+
+    if sniffer is not None:
+        entries, num_rejected = sniffer.filter(entries, complete=True)
+        num_skipped += num_rejected
+
+    if out is not None:
+        out['num_skipped'] = num_skipped
+    return entries
+
+def get_files_in_dir(directory_path, check_cancelled=None, sort_type=None,
+                     reversed_sort=False, **kwargs):
+    '''Return a list of FileEntry objects, namedtuples (is_dir, full_path,
+    size, mtime) where is_dir is a boolean indicating whether the item is a
+    directory and full_path is the path to it. The following keyword
+    arguments can be used:
 
     `file_extensions`: list of extensions of files to consider. Files with
       different extension are ignored.
 
+    `sniffer`: FileSniffer object (see file_types.py). If provided, files
+      are classified from their content, rather than from their extension.
+      `file_extensions` is then ignored.
+
     `sort_type`: how the files are sorted. Can be FileList.SORT_BY_FILE_NAME
       or another value of the same enumeration.
 
@@ -112,57 +596,67 @@ def get_files_in_dir(directory_path, check_cancelled=None, **kwargs):
 
     `out`: dict-like object. Of provided, this is populated with extra
       statistics from the search. The following fields are written:
-      out['num_skipped'] number of files ignored due to their extension.
+      out['num_skipped'] number of files ignored due to their extension
+      (or content).
     '''
-    return categorize_files(list_dir(directory_path, check_cancelled), **kwargs)
+    entries = scan_dir(directory_path, check_cancelled=check_cancelled,
+                       **kwargs)
+    return sort_files(entries, sort_type, reversed_sort)
 
 def is_hidden(full_path):
     '''Whether the given file is hidden.'''
     return os.path.split(full_path)[-1].startswith('.')
 
 def categorize_files(file_list, file_extensions=None, sort_type=None,
-                     reversed_sort=False, show_hidden_files=True, out=None):
+                     reversed_sort=False, show_hidden_files=True, out=None,
+                     sniffer=None, complete=False):
     '''Similar to get_files_in_dir, but uses the files in the list given as
     first argument, rather than obtaining the file list from a directory path.
+    `complete` tells whether the list contains all the files of their
+    directories (see FileSniffer.classify).
     '''
 
     exts = file_extensions or image_file_extensions
-    isdir_file_tuples = []
+    entries = []
     num_skipped = 0
     for full_path in file_list:
         if not show_hidden_files and is_hidden(full_path):
             continue
 
-        if not os.path.exists(full_path):
+        entry = stat_file(full_path)
+        if entry is None:
             num_skipped += 1
             continue
 
-        isdir = os.path.isdir(full_path)
-        if not isdir:
+        if not entry.is_dir and sniffer is None:
             ext = os.path.splitext(full_path)[1]
             if ext.lower() not in exts:
                 num_skipped += 1
                 continue
-        isdir_file_tuples.append((isdir, full_path))
+        entries.append(entry)
+
+    if sniffer is not None:
+        entries, num_rejected = sniffer.filter(entries, complete=complete)
+        num_skipped += num_rejected
 
     # Return extra output if required.
     if out is not None:
         out['num_skipped'] = num_skipped
+    return sort_files(entries, sort_type, reversed_sort)
 
-    # For now we only provide one sort type. Later we may want to provide a
-    # tuple of sort types from the one which has the higher precedence to the
-    # one which has the lowest precedence. Infrastructure for this is already
-    # in place. Here we map the single sort order to a tuple which makes
-    # sense.
-    if sort_type is not None:
-        if sort_type == FileList.SORT_BY_FILE_NAME:
-            sort_types = (sort_type,)
-        else:
-            sort_types = (sort_type, FileList.SORT_BY_FILE_NAME)
+def natural_key(name):
+    '''Return a key to sort strings in "natural" order, where embedded numbers
+    are compared by value (so that 'IMG_2.jpg' comes before 'IMG_10.jpg').
+    '''
+    return tuple(((0, int(chunk), chunk) if chunk.isdigit() else (1, 0, chunk))
+                 for chunk in _digits_re.split(name) if chunk)
 
-        key = FileList.build_key_generator(sort_types)
-        isdir_file_tuples.sort(key=key, reverse=reversed_sort)
-    return isdir_file_tuples
+def sort_files(entries, sort_type=None, reversed_sort=False):
+    '''Sort in place and return the given list of FileEntry objects.'''
+    if sort_type is not None:
+        key = FileList.build_key_generator(FileList.get_sort_types(sort_type))
+        entries.sort(key=key, reverse=reversed_sort)
+    return entries
 
 def sparse_iterator(items, num_steps):
     '''Sparse iteration over `items`. Every element of the list `items` is
@@ -224,8 +718,8 @@ def pick_files(path, num_picks=4, follow_links=False,
         out = {}
         entries = get_files_in_dir(p, out=out, **kwargs)
         n = out['num_skipped']
-        files = [name for is_dir, name in entries if not is_dir]
-        dirs = [name for is_dir, name in entries if is_dir]
+        files = [e.full_path for e in entries if not e.is_dir]
+        dirs = [e.full_path for e in entries if e.is_dir]
 
         # Update the score for this directory.
         score += (10 * n + dig_stability) // (len(files) + dig_stability)
@@ -0,0 +1,237 @@
+# Copyright 2017 Matteo Franchin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Server process from which the worker processes are forked.
+
+The server is forked at startup, before gtk is imported, and imports the
+modules needed to make thumbnails (PIL with all its format plugins, numpy,
+...). Workers forked from it start in a few milliseconds, with the modules
+already imported and without the memory and the state of the GUI process.
+
+Each worker talks to the GUI process through a socket connection. The
+connection is wrapped in objects with the same interface as the queues
+used by the Worker class (see orchestrator.py).
+'''
+
+import os
+import sys
+import time
+import errno
+import select
+import signal
+import threading
+import importlib
+from multiprocessing import Pipe
+from multiprocessing.connection import Listener, Client
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+# Time given to a newly forked worker to connect back, in seconds.
+SPAWN_TIMEOUT = 10.0
+
+# Marker telling the sender thread of a ConnectionQueue to exit.
+_STOP_SENDING = object()
+
+
+class ConnectionQueue(object):
+    '''Queue-like object sending and receiving objects over a Connection.
+    If `threaded_put` is true, put() never blocks: the objects are sent by a
+    separate thread, like multiprocessing.Queue does.'''
+
+    def __init__(self, conn, threaded_put=False):
+        self._conn = conn
+        self._send_queue = None
+        if threaded_put:
+            self._send_queue = Queue()
+            t = threading.Thread(target=self._send_loop)
+            t.daemon = True
+            t.start()
+
+    def _send_loop(self):
+        while True:
+            obj = self._send_queue.get()
+            if obj is _STOP_SENDING:
+                return
+            try:
+                self._conn.send(obj)
+            except (EOFError, IOError, OSError):
+                # The other end went away. The receiving side notices.
+                return
+
+    def put(self, obj):
+        if self._send_queue is not None:
+            self._send_queue.put(obj)
+        else:
+            self._conn.send(obj)
+
+    def get(self, block=True, timeout=None):
+        '''Return the next object. Raise Empty if none is available within
+        the timeout and EOFError if the other end closed the connection.'''
+        if not block:
+            timeout = 0
+        if timeout is not None and not self._conn.poll(timeout):
+            raise Empty
+        return self._conn.recv()
+
+    def close(self):
+        '''Stop the sender thread (if any) and close the connection. The
+        objects not yet sent are dropped.'''
+        if self._send_queue is not None:
+            self._send_queue.put(_STOP_SENDING)
+        self._conn.close()
+
+
+class RemoteWorker(object):
+    '''Handle for a worker forked by the ForkServer. This provides part of
+    the interface of multiprocessing.Process.'''
+
+    def __init__(self, pid):
+        self.pid = pid
+
+    def is_alive(self):
+        try:
+            os.kill(self.pid, 0)
+        except OSError as exc:
+            return exc.errno == errno.EPERM
+        return True
+
+    def terminate(self):
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def join(self, timeout=None):
+        deadline = (None if timeout is None else time.time() + timeout)
+        while self.is_alive():
+            if deadline is not None and time.time() >= deadline:
+                return
+            time.sleep(0.01)
+
+
+def _run_worker(conn, module_name, class_name, kwargs):
+    '''(internal) Body of a worker process forked by the server.'''
+    worker_class = getattr(importlib.import_module(module_name), class_name)
+    queue = ConnectionQueue(conn)
+    worker = worker_class(queue, queue, **kwargs)
+    try:
+        worker.run()
+    except (EOFError, IOError, OSError):
+        # The GUI process exited.
+        pass
+
+
+def _serve(conn, preload):
+    '''(internal) Main loop of the fork server.'''
+    # Children are reaped automatically. Interruptions (Ctrl-C) are dealt
+    # with by the GUI process.
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    for module_name in preload:
+        try:
+            importlib.import_module(module_name)
+        except Exception as exc:
+            sys.stderr.write('Fork server cannot import {}: {}\n'
+                             .format(module_name, str(exc)))
+    pil_image = sys.modules.get('PIL.Image')
+    if pil_image is not None:
+        # Import all the format plugins now, rather than in every worker.
+        pil_image.init()
+
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, IOError):
+            return
+        if msg[0] != 'SPAWN':
+            return
+        address, authkey, module_name, class_name, kwargs = msg[1:]
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                conn.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                _run_worker(Client(address, authkey=authkey),
+                            module_name, class_name, kwargs)
+            except:
+                status = 1
+                import traceback
+                traceback.print_exc()
+            finally:
+                os._exit(status)
+        conn.send(pid)
+
+
+class ForkServer(object):
+    def __init__(self, preload=()):
+        self._lock = threading.Lock()
+        self._conn, child_conn = Pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            status = 0
+            try:
+                self._conn.close()
+                _serve(child_conn, preload)
+            except:
+                status = 1
+            finally:
+                os._exit(status)
+        child_conn.close()
+
+    def spawn(self, worker_class, **kwargs):
+        '''Fork a new worker process running worker_class(cmd_queue,
+        out_queue, **kwargs).run(). Return the tuple (worker, cmd_queue,
+        out_queue) where worker is a RemoteWorker and the two queues are
+        used to communicate with the worker. `kwargs` must be picklable.'''
+        authkey = os.urandom(16)
+        listener = Listener(family='AF_UNIX', authkey=authkey)
+        try:
+            with self._lock:
+                self._conn.send(('SPAWN', listener.address, authkey,
+                                 worker_class.__module__,
+                                 worker_class.__name__, kwargs))
+                pid = self._conn.recv()
+            # Do not wait forever for a worker which died before connecting.
+            sock = listener._listener._socket
+            ready, _, _ = select.select([sock], [], [], SPAWN_TIMEOUT)
+            if not ready:
+                RemoteWorker(pid).terminate()
+                raise IOError('Worker {} did not connect within {} s'
+                              .format(pid, SPAWN_TIMEOUT))
+            conn = listener.accept()
+        finally:
+            listener.close()
+        return (RemoteWorker(pid), ConnectionQueue(conn, threaded_put=True),
+                ConnectionQueue(conn))
+
+
+_fork_server = None
+
+def start_fork_server():
+    '''Start the fork server. This should be called early, before gtk and
+    other modules which are not needed by the workers are imported.'''
+    global _fork_server
+    if _fork_server is None and hasattr(os, 'fork'):
+        package = __name__.rsplit('.', 1)[0]
+        _fork_server = \
+          ForkServer(preload=('numpy', 'PIL.Image', package + '.thumbnailers'))
+    return _fork_server
+
+def get_fork_server():
+    '''Return the fork server or None if it was not started.'''
+    return _fork_server
@@ -0,0 +1,185 @@
+# Copyright 2017 Matteo Franchin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Registry of the image formats which can be shown.
+
+Each format declares its file extensions, the magic bytes identifying its
+files, how expensive its files are to decode and, if PIL cannot open its
+files directly, the function opening them. The list of the files shown in
+the browser is derived from this registry.
+
+Openers are given by name and imported only when used, so that the GUI
+process can list the formats without importing their decoders.
+'''
+
+import os
+import pkgutil
+import importlib
+from collections import OrderedDict
+
+# Cost classes: how expensive it is to make a thumbnail for a format.
+(COST_PREVIEW,  # A small embedded preview is decoded.
+ COST_DECODE,   # The image is decoded (possibly at reduced resolution).
+ COST_HEAVY) = range(3)  # Decoding is slow (e.g. HEVC).
+
+
+class ImageFormat(object):
+    '''An image format. `magic` is a sequence of (offset, bytes) tuples: a
+    file matches if the bytes at any of the offsets match. `opener` is the
+    name of a function, relative to this package, taking a file path and
+    returning a tuple (image, transpose) where image is a PIL image and
+    transpose is the PIL transposition (e.g. PIL.Image.ROTATE_90) to apply
+    to it (None if no transposition is needed). The default is to open the
+    file with PIL. `size_getter`, if given, is the name of a function
+    returning the size of the image (as shown) from the file path, which is
+    used instead of the opener when only the size is needed. `requires` is a
+    module which must be available for the format to be supported.'''
+
+    def __init__(self, name, extensions, magic=(), cost=COST_DECODE,
+                 opener=None, size_getter=None, requires=None):
+        self.name = name
+        self.extensions = tuple(ext.lower() for ext in extensions)
+        self.magic = tuple(magic)
+        self.cost = cost
+        self.opener = opener
+        self.size_getter = size_getter
+        self.requires = requires
+        self._available = None
+        self._functions = {}
+
+    def is_available(self):
+        '''Whether the modules needed to decode the format are installed.'''
+        if self._available is None:
+            try:
+                self._available = (self.requires is None or
+                                   pkgutil.find_loader(self.requires)
+                                   is not None)
+            except ImportError:
+                self._available = False
+        return self._available
+
+    def match_magic(self, header):
+        '''Whether the given bytes (the beginning of a file) identify a file
+        of this format.'''
+        return any(header[offset:offset + len(magic)] == magic
+                   for offset, magic in self.magic)
+
+    def _get_function(self, name):
+        '''(internal) Import and return the function with the given name,
+        relative to this package, or return None if name is None.'''
+        if name is not None and name not in self._functions:
+            module_name, fn_name = name.rsplit('.', 1)
+            package = __name__.rsplit('.', 1)[0]
+            module = importlib.import_module('.' + module_name, package)
+            self._functions[name] = getattr(module, fn_name)
+        return self._functions.get(name)
+
+    def get_opener(self):
+        '''Return the opener function (see above) or None if the files can
+        be opened directly with PIL.'''
+        return self._get_function(self.opener)
+
+    def get_size_getter(self):
+        '''Return the size getter function (see above) or None.'''
+        return self._get_function(self.size_getter)
+
+
+# Registered formats, by name.
+_formats = OrderedDict()
+
+# Map file extensions to formats. Updated by register_format.
+_formats_by_ext = {}
+
+def register_format(image_format):
+    '''Register an ImageFormat. Formats registered later take precedence
+    for the extensions they share with other formats.'''
+    _formats[image_format.name] = image_format
+    for ext in image_format.extensions:
+        _formats_by_ext[ext] = image_format
+
+def get_format(name):
+    '''Return the registered ImageFormat with the given name or None.'''
+    return _formats.get(name)
+
+def get_formats(available_only=True):
+    '''Return the registered formats.'''
+    return [fmt for fmt in _formats.values()
+            if not available_only or fmt.is_available()]
+
+def get_image_extensions():
+    '''Return the extensions of the files of all the available formats.'''
+    return tuple(ext for fmt in get_formats() for ext in fmt.extensions)
+
+def get_format_from_path(path):
+    '''Return the ImageFormat for the given file, from its extension, or
+    None if the extension is not known.'''
+    dot = path.rfind('.')
+    return (_formats_by_ext.get(path[dot:].lower()) if dot >= 0 else None)
+
+# Number of bytes which must be read from a file to check its magic bytes.
+magic_size = 32
+
+def get_format_from_header(header):
+    '''Return the available ImageFormat whose magic bytes match the given
+    bytes (the beginning of a file) or None.'''
+    for fmt in reversed(get_formats()):
+        if fmt.match_magic(header):
+            return fmt
+    return None
+
+def read_header(path):
+    '''Return the first magic_size bytes of the given file or None if the
+    file cannot be read. Only one read is done and the call does not block on
+    FIFOs and similar special files.'''
+    try:
+        fd = os.open(path, os.O_RDONLY | getattr(os, 'O_NONBLOCK', 0))
+    except OSError:
+        return None
+    try:
+        return os.read(fd, magic_size)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+
+def get_format_from_file(path):
+    '''Return the ImageFormat of the given file, from its magic bytes, or
+    None if the file is not an image of an available format.'''
+    header = read_header(path)
+    return (get_format_from_header(header) if header else None)
+
+
+_tiff_magic = ((0, b'II*\x00'), (0, b'MM\x00*'))
+
+for _fmt in \
+  (ImageFormat('jpeg', ('.jpeg', '.jpg', '.jpe'), ((0, b'\xff\xd8\xff'),)),
+   ImageFormat('png', ('.png',), ((0, b'\x89PNG\r\n\x1a\n'),)),
+   ImageFormat('gif', ('.gif',), ((0, b'GIF87a'), (0, b'GIF89a'))),
+   ImageFormat('tiff', ('.tif', '.tiff'), _tiff_magic),
+   ImageFormat('bmp', ('.bmp',), ((0, b'BM'),)),
+   ImageFormat('xpm', ('.xpm',), ((0, b'/* XPM */'),)),
+   ImageFormat('webp', ('.webp',), ((8, b'WEBP'),), requires='PIL._webp'),
+   ImageFormat('heif', ('.heic', '.heif'),
+               tuple((4, b'ftyp' + brand) for brand in
+                     (b'heic', b'heix', b'hevc', b'heim', b'heis', b'mif1',
+                      b'msf1')),
+               cost=COST_HEAVY, opener='heif.open_heif_image',
+               size_getter='heif.get_heif_size', requires='pillow_heif'),
+   ImageFormat('raw', ('.cr2', '.cr3', '.nef', '.nrw', '.arw', '.dng',
+                       '.orf', '.rw2', '.raf', '.pef', '.srw'),
+               ((0, b'FUJIFILMCCD-RAW'), (0, b'IIRO'), (0, b'IIRS'),
+                (0, b'MMOR'), (0, b'IIU\x00'), (8, b'CR\x02'),
+                (4, b'ftypcrx ')),
+               cost=COST_PREVIEW, opener='raw_preview.open_raw_preview')):
+    register_format(_fmt)
@@ -18,7 +18,6 @@
 
 import os
 import sys
-import argparse
 import logging
 
 import pygtk
@@ -26,12 +25,17 @@ pygtk.require('2.0')
 import gtk
 import gobject
 
-from .browser_tab import BrowserTab
-from .viewer_tab import ViewerTab
 from .toolbar_window import ToolbarWindow
 from . import file_utils
 from .file_utils import FileList
-from .config import Config, setup_logging, logger, version, SCALAR2
+from .config import Config, logger, version, SCALAR2
+from .orchestrator import prespawn_orchestrator, \
+  get_browser_orchestrator_kwargs
+from .stats import StatsReporter
+from .profiling import get_profiler
+
+# Note that the tabs (and thus PIL, numpy, cairo, ...) are imported only
+# when the first tab is created, after the main window is shown.
 
 def create_action_tuple(name=None, stock_id=None, label=None, accel=None,
                         tooltip=None, fn=None):
@@ -58,6 +62,7 @@ class ApplicationMainWindow(gtk.Window):
         self.fullscreen_widget = None
         self.fullscreen_toolbar = ToolbarWindow()
         self.open_dialog = None
+        self.browser_tab = None
         self._config = config or Config()
 
         self.sort_type = FileList.SORT_BY_MOD_DATE
@@ -86,6 +91,9 @@ class ApplicationMainWindow(gtk.Window):
         hide_toggle = ui_manager.get_widget('/MenuBar/ViewMenu/ShowHidden')
         cfg.override('browser.show_hidden_files',
                      lambda *args: hide_toggle.get_active())
+        flatten_toggle = ui_manager.get_widget('/MenuBar/ViewMenu/Flatten')
+        cfg.override('browser.flatten',
+                     lambda *args: flatten_toggle.get_active())
         reverse_toggle = \
           ui_manager.get_widget('/MenuBar/ViewMenu/ReverseSortOrder')
         cfg.override('browser.reversed_sort',
@@ -101,12 +109,6 @@ class ApplicationMainWindow(gtk.Window):
         nb.set_scrollable(True)
         nb.set_tab_pos(gtk.POS_TOP)
 
-        # One a browsing tab for the given directory and one viewer tab for
-        # each given image.
-        self.browser_tab = self.open_tab(start_path)
-        for image_path in image_paths:
-            self.open_tab(image_path)
-
         # Place menu and notebook in a VBox. Add this to the window.
         self.window_content = vbox = gtk.VBox()
         vbox.pack_start(bar, expand=False)
@@ -120,6 +122,27 @@ class ApplicationMainWindow(gtk.Window):
         self.connect("motion_notify_event", self.on_motion_notify_event)
 
         self.show_all()
+        get_profiler().mark_startup('window_shown')
+
+        # The tabs are created once the window is on the screen, as listing
+        # the start directory and probing its images may take a while.
+        self._map_handler = self.connect('map-event', self.on_first_map,
+                                         start_path, image_paths)
+
+    def on_first_map(self, window, event, start_path, image_paths):
+        self.disconnect(self._map_handler)
+        get_profiler().mark_startup('window_mapped')
+        gobject.idle_add(self._open_initial_tabs, start_path, image_paths)
+        return False
+
+    def _open_initial_tabs(self, start_path, image_paths):
+        '''(internal) Open a browsing tab for the given directory and one
+        viewer tab for each given image.'''
+        self.browser_tab = self.open_tab(start_path)
+        for image_path in image_paths:
+            self.open_tab(image_path)
+        get_profiler().mark_startup('tabs_ready', last=True)
+        return False
 
     def _screen_size_getter(self, parent=None, attr_name=None):
         screen = self.get_screen()
@@ -218,8 +241,10 @@ class ApplicationMainWindow(gtk.Window):
                 <menuitem action='CloseTab'/>
                 <menuitem action='Fullscreen'/>
                 <menuitem action='ShowHidden'/>
+                <menuitem action='Flatten'/>
                 <menu action='SortFilesBy'>
                   <menuitem action='SortFilesByName'/>
+                  <menuitem action='SortFilesByNaturalName'/>
                   <menuitem action='SortFilesByModDate'/>
                   <menuitem action='SortFilesByExt'/>
                   <menuitem action='SortFilesBySize'/>
@@ -262,6 +287,11 @@ class ApplicationMainWindow(gtk.Window):
           (toggle(name='ShowHidden', label='_Show hidden files',
                   accel='<control>H', tooltip='Show hidden files',
                   fn=self.update_album_handler, value=False),
+           toggle(name='Flatten', label='_Include subdirectories',
+                  accel='<control>T',
+                  tooltip='Show the images in all the subdirectories '
+                          'together, without the subdirectories',
+                  fn=self.update_album_handler, value=False),
            toggle(name='ReverseSortOrder', label='_Reverse sort order',
                   accel='<control>R', tooltip='Reverse the sort order',
                   fn=self.update_album_handler, value=False))
@@ -271,6 +301,10 @@ class ApplicationMainWindow(gtk.Window):
           (radio(name='SortFilesByName', label='Name',
                  accel='<control>N', tooltip='Sort by file name',
                  value=FileList.SORT_BY_FILE_NAME),
+           radio(name='SortFilesByNaturalName', label='Name (natural order)',
+                 accel='<control>I',
+                 tooltip='Sort by file name, comparing numbers by value',
+                 value=FileList.SORT_BY_NATURAL_NAME),
            radio(name='SortFilesByModDate', label='Modification date',
                  accel='<control>D',
                  tooltip='Sort first by modification date, then name',
@@ -307,6 +341,7 @@ class ApplicationMainWindow(gtk.Window):
         if not os.path.isdir(path):
             return None
 
+        from .browser_tab import BrowserTab
         bt = BrowserTab(path, config=self._config)
         bt.set_callback('toggle_fullscreen', self.fullscreen_action)
         bt.set_callback('directory_changed', self.on_directory_changed)
@@ -321,6 +356,7 @@ class ApplicationMainWindow(gtk.Window):
 
     def open_viewer_tab(self, path, **kwargs):
         '''Create a new ViewerTab to view the image at the given path.'''
+        from .viewer_tab import ViewerTab
         vt = ViewerTab(path, config=self._config, **kwargs)
         vt.set_callback('close_tab', self.on_close_tab)
         vt.set_callback('toggle_fullscreen', self.fullscreen_action)
@@ -361,19 +397,24 @@ class ApplicationMainWindow(gtk.Window):
 
     def on_key_press_event(self, main_window, event):
         tab = self.get_current_tab()
-        return tab.on_key_press_event(event)
+        return (tab is not None and tab.on_key_press_event(event))
 
     def on_directory_changed(self, new_directory):
         self.set_title(new_directory + ' - ' + self.application_name)
 
     def on_image_clicked(self, file_list, file_item):
         if not file_item.is_dir:
+            # Seed the viewer with the thumbnail, which is shown (upscaled)
+            # while the image is being decoded.
+            thumbnail = \
+              self.browser_tab.get_cached_thumbnail(file_item.full_path)
             self.open_viewer_tab(file_item.full_path,
                                  file_list=file_list,
-                                 file_index=file_item.index)
+                                 file_index=file_item.index,
+                                 thumbnail=thumbnail)
 
     def on_close_tab(self, viewer):
-        if isinstance(viewer, ViewerTab):
+        if viewer is not None and viewer is not self.browser_tab:
             n = self.notebook.page_num(viewer)
             self.notebook.remove_page(n)
             self.on_tab_changed()
@@ -408,41 +449,28 @@ class ApplicationMainWindow(gtk.Window):
         choice = (fc.get_filename() if response == gtk.RESPONSE_OK else None)
         fc.hide()
 
-        if choice is not None:
+        if choice is not None and self.browser_tab is not None:
             self.browser_tab.go_to_directory(choice)
 
     def on_save_config(self, *args):
         self._config.save()
 
     def update_album_handler(self, *args):
-        self.browser_tab.update_album()
+        if self.browser_tab is not None:
+            self.browser_tab.update_album()
 
     def on_radio_change(self, first_radio, active_radio):
         new_sort_type = active_radio.get_current_value()
         if new_sort_type != self.sort_type:
             self.sort_type = new_sort_type
-            self.browser_tab.update_album()
-
+            if self.browser_tab is not None:
+                self.browser_tab.update_album()
 
-def main(args=None):
-    dsc = ('Immagine {} - image viewer with focus on the browsing experience'
-           .format(version))
-    parser = argparse.ArgumentParser(description=dsc)
-    parser.add_argument('paths', metavar='PATH', type=str, nargs='*',
-                        help=('Path to file or directory. All paths to files '
-                              'are handled by opening a viewer tab. Only one '
-                              'directory path should be provided and is used '
-                              'as the initial browsing directory.'))
-    parser.add_argument('-l', '--log', metavar='LEVEL', dest='loglevel',
-                        choices=['DEBUG', 'WARN', 'ERROR', 'SILENT'],
-                        default=None,
-                        help='Log level. One of: DEBUG, WARN, ERROR, SILENT.')
 
-    args = parser.parse_args()
-
-    setup_logging(args.loglevel)
-    cfg = Config()
-    cfg.load()
+def main(args, cfg):
+    '''Run the GUI with the given command line arguments (see cli.py) and
+    configuration.'''
+    get_profiler().mark_startup('imports')
 
     img_paths = []
     dir_path = None
@@ -466,7 +494,28 @@ def main(args=None):
 
     dir_path = os.path.realpath(dir_path)
 
+    reporter = None
+    if args.stats_interval is not None or args.stats_file is not None:
+        reporter = StatsReporter(log=(args.stats_interval is not None),
+                                 json_path=args.stats_file)
+        interval = max(0.1, args.stats_interval or 5.0)
+        gobject.timeout_add(int(interval*1000), reporter.report)
+
+    profiler = get_profiler()
+    if args.profile or args.profile_output is not None:
+        profiler.enable(frame_budget=args.frame_budget/1000.0,
+                        use_cprofile=(args.profile_output is not None))
+
     gtk.gdk.threads_init()
+
+    # Start the thumbnail worker now: it loads the image libraries while the
+    # main window is being built.
+    prespawn_orchestrator('browser', **get_browser_orchestrator_kwargs(cfg))
+
     with gtk.gdk.lock:
         ApplicationMainWindow(dir_path, img_paths, config=cfg)
         gtk.main()
+
+    profiler.finish(args.profile_output)
+    if reporter is not None:
+        reporter.report()
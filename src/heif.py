@@ -0,0 +1,91 @@
+# Copyright 2017 Matteo Franchin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Support for HEIF/HEIC images.
+
+Images are decoded with pillow_heif. Their size is read by walking the boxes
+of the file, so that the GUI process can lay out thumbnails without loading
+the HEVC decoder.
+'''
+
+import struct
+
+# Boxes containing other boxes, on the path to the image properties. The
+# value is the number of bytes preceding the child boxes.
+_container_boxes = {b'meta': 4, b'iprp': 0, b'ipco': 0}
+
+# Limits protecting against damaged files.
+MAX_BOXES = 4096
+
+
+def _read_boxes(f, start, end, found, depth=0):
+    '''(internal) Walk the boxes between the offsets `start` and `end` (None
+    for the end of the file), appending the ispe and irot boxes to `found` as
+    (type, payload) tuples.'''
+    pos = start
+    while (end is None or pos + 8 <= end) and len(found) < MAX_BOXES:
+        f.seek(pos)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack('>I4s', header)
+        header_size = 8
+        if size == 1:
+            data = f.read(8)
+            if len(data) < 8:
+                return
+            size, = struct.unpack('>Q', data)
+            header_size = 16
+        elif size == 0:
+            if end is None:
+                return
+            size = end - pos
+        if size < header_size:
+            return
+
+        if box_type in _container_boxes and depth < 4:
+            _read_boxes(f, pos + header_size + _container_boxes[box_type],
+                        pos + size, found, depth + 1)
+        elif box_type == b'ispe':
+            found.append((box_type, f.read(12)))
+        elif box_type == b'irot':
+            found.append((box_type, f.read(1)))
+        pos += size
+
+
+def get_heif_size(path):
+    '''Return the size of the given HEIF image, rotated as it is shown. The
+    size of the primary image is taken to be the biggest of the sizes in the
+    file (the others are thumbnails and tiles).'''
+    found = []
+    with open(path, 'rb') as f:
+        _read_boxes(f, 0, None, found)
+    sizes = [struct.unpack('>4xII', payload) for box_type, payload in found
+             if box_type == b'ispe' and len(payload) == 12]
+    if not sizes:
+        raise IOError('Cannot find the size of {}'.format(path))
+    width, height = max(sizes, key=lambda size: size[0]*size[1])
+    rotations = [ord(payload[:1]) & 3 for box_type, payload in found
+                 if box_type == b'irot' and payload]
+    if rotations and rotations[0] % 2 == 1:
+        return (height, width)
+    return (width, height)
+
+
+def open_heif_image(path):
+    '''Opener for HEIF images (see formats.py).'''
+    import PIL.Image
+    import pillow_heif
+    pillow_heif.register_heif_opener()
+    return (PIL.Image.open(path), None)
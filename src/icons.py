@@ -14,8 +14,6 @@
 
 import sys
 
-import numpy
-import gtk
 import cairo
 import pango
 import pangocairo
@@ -35,12 +33,14 @@ class Icon(object):
         pass
 
     def get_out_data(self):
+        import numpy
         data = self.surface.get_data()
         data = numpy.array(data)
         data = numpy.fliplr(data.reshape(-1, 4))
         data = data.reshape(self.height, self.width, -1)
         data = data[:, :, 1:]
         if self.out_format == FORMAT_PIXBUF:
+            import gtk
             return gtk.gdk.pixbuf_new_from_array(data,
                                                  gtk.gdk.COLORSPACE_RGB, 8)
         return data
@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import os
+from collections import OrderedDict
 
 import gobject
 import gtk
@@ -20,11 +21,15 @@ import gtk.gdk
 
 from . import layout
 from . import icons
+from . import dir_watcher
 from .thumbnailers import build_empty_thumbnail
-from .orchestrator import Orchestrator, THUMBNAIL_DONE
+from .orchestrator import get_orchestrator, \
+  get_browser_orchestrator_kwargs, THUMBNAIL_DONE
+from .file_types import get_file_sniffer
 from .backcaller import BackCaller
-from .file_utils import FileList
+from .file_utils import FileList, get_mtime
 from .config import logger, INT2, COLOR
+from .profiling import profiled
 
 
 class Location(object):
@@ -57,6 +62,22 @@ class ImageBrowser(gtk.DrawingArea, BackCaller):
         self.previous_locations = []
         self.next_locations = []
 
+        # Objects used to watch the browsed directory for changes. Changes are
+        # accumulated in _pending_changes (a set of names, or None when the
+        # whole directory should be listed again) and applied in batches.
+        self._watcher = None
+        self._watcher_source = None
+        self._pending_changes = set()
+        self._apply_changes_source = None
+
+        # Timeout source adding to the album the files found by the walk of
+        # the directory tree, when the subdirectories are flattened.
+        self._walk_source = None
+
+        # Recently visited directories: maps paths to (file_list, album)
+        # tuples, from the least to the most recently used.
+        self._directory_cache = OrderedDict()
+
         # Adjustment objects to control the scrolling.
         self._hadjustment = hadjustment
         self._vadjustment = vadjustment
@@ -66,10 +87,17 @@ class ImageBrowser(gtk.DrawingArea, BackCaller):
         self._hadj_valchanged_handler = None
         self._vadj_valchanged_handler = None
 
-        self.orchestrator = Orchestrator()
+        self.orchestrator = \
+          get_orchestrator('browser',
+                           **get_browser_orchestrator_kwargs(config))
         self.orchestrator.set_callback('thumbnail_available',
                                        self.on_thumbnail_available)
 
+        # Thumbnails scaled to the size they are shown with. Maps the tuples
+        # (request_id, size) to pixbufs, from the least to the most recently
+        # used.
+        self._scaled_pixbufs = OrderedDict()
+
         self.last_tooltip_shown = None
         self.props.has_tooltip = True
 
@@ -84,6 +112,13 @@ class ImageBrowser(gtk.DrawingArea, BackCaller):
         self.connect('configure-event', self.on_size_change)
         self.connect('button-press-event', self.on_button_press_event)
         self.connect('query-tooltip', self.on_query_tooltip)
+        self.connect('destroy', self.on_destroy)
+
+    def on_destroy(self, widget):
+        '''Stop watching the directory and walking its tree, as the sources
+        and threads doing this would outlive the widget.'''
+        self._stop_walk()
+        self._unwatch_directory()
 
     def _thumb_final_size_getter(self, parent=None, attr_name=None):
         cfg = self._config
@@ -112,25 +147,194 @@ class ImageBrowser(gtk.DrawingArea, BackCaller):
     hadjustment = property(_get_hadjustment, _set_hadjustment)
     vadjustment = property(_get_vadjustment, _set_vadjustment)
 
+    @profiled('ImageBrowser._lay_out_album')
     def _lay_out_album(self, width=None):
         if width is None:
             width, _ = self.window.get_size()
 
-        # Create the file list based on the current configuration.
+        # Create the file list based on the current configuration. The
+        # directory is listed again only when needed: a change of sort order
+        # just re-sorts the current list using its cached sort keys.
         cfg = self._config
-        self.file_list = file_list = \
-          FileList(
-            self.location.path,
-            show_hidden_files=cfg.get('browser.show_hidden_files', True),
-            reversed_sort=cfg.get('browser.reversed_sort', False),
-            sort_type=cfg.get('browser.sort_type', FileList.SORT_BY_MOD_DATE)
-          )
+        show_hidden_files = cfg.get('browser.show_hidden_files', True)
+        reversed_sort = cfg.get('browser.reversed_sort', False)
+        sort_type = cfg.get('browser.sort_type', FileList.SORT_BY_MOD_DATE)
+        flatten = cfg.get('browser.flatten', False, bool)
+        file_list = self.file_list
+        max_size = cfg.get('thumb.final_size')
+        if file_list is None:
+            # We just changed directory: we may have been here recently.
+            state = self._restore_directory_state(self.location.path)
+            if (state is not None and
+                state[0].show_hidden_files == show_hidden_files and
+                not flatten):
+                self.file_list, self.album = file_list, _ = state
+                self._watch_directory(file_list)
+
+        if (file_list is None or file_list.full_path != self.location.path or
+            file_list.show_hidden_files != show_hidden_files or
+            file_list.recursive != flatten):
+            self._stop_walk()
+            self.file_list = file_list = \
+              FileList(self.location.path,
+                       show_hidden_files=show_hidden_files,
+                       reversed_sort=reversed_sort,
+                       sort_type=sort_type,
+                       sniffer=get_file_sniffer(cfg),
+                       recursive=flatten,
+                       num_walk_threads=cfg.get('browser.walk_threads', 4,
+                                                int))
+            self._watch_directory(file_list)
+            if file_list.is_walking():
+                interval = cfg.get('browser.walk_update_interval', 250, int)
+                self._walk_source = \
+                  gobject.timeout_add(interval, self._on_walk_update,
+                                      file_list)
+        elif self.album is not None:
+            # Same directory: permute the existing thumbnails and re-pack the
+            # rows, without probing the images again. Nothing needs to be
+            # done if neither the order nor the layout parameters changed.
+            album = self.album
+            if (file_list.sort(sort_type, reversed_sort) or
+                album.max_width != width or
+                tuple(album.max_size) != tuple(max_size)):
+                album.lay_out(file_list, max_width=width, max_size=max_size)
+            return
 
         self.album = layout.ImageAlbum(file_list,
                                        max_width=width,
-                                       max_size=cfg.get('thumb.final_size'),
+                                       max_size=max_size,
                                        border=cfg.get('thumb.border', (5, 5)))
 
+    def _save_directory_state(self):
+        '''(internal) Save the file list and album for the current directory
+        so that they can be reused if the user comes back to it.
+        '''
+        file_list = self.file_list
+        if file_list is None or self.album is None or file_list.recursive:
+            # Flattened trees are not cached: only the mtime of their top
+            # directory could be checked, which does not tell whether their
+            # subdirectories changed.
+            return
+        cache = self._directory_cache
+        cache.pop(file_list.full_path, None)
+        cache[file_list.full_path] = (file_list, self.album)
+        max_entries = self._config.get('browser.directory_cache_size', 8, int)
+        while len(cache) > max(0, max_entries):
+            cache.popitem(last=False)
+
+    def _restore_directory_state(self, path):
+        '''(internal) Return the tuple (file_list, album) saved for the given
+        directory path or None if nothing was saved or if the directory was
+        modified after it was listed.
+        '''
+        state = self._directory_cache.pop(path, None)
+        if state is None:
+            return None
+        mtime = get_mtime(path)
+        if mtime is None or mtime != state[0].dir_mtime:
+            return None
+        return state
+
+    def _watch_directory(self, file_list):
+        '''(internal) Watch the directory of the given file list so that the
+        album is updated when files are added, removed or modified.
+        '''
+        self._unwatch_directory()
+        if self.on_file_list_changed not in file_list.callbacks:
+            file_list.register_callback(self.on_file_list_changed)
+        if (file_list.recursive or
+            not self._config.get('browser.watch_directory', True, bool)):
+            # Only the top directory would be watched: flattened trees are
+            # not watched at all.
+            return
+
+        self._watcher = watcher = \
+          dir_watcher.create_watcher(file_list.full_path)
+        fd = watcher.fileno()
+        if fd is not None:
+            self._watcher_source = \
+              gobject.io_add_watch(fd, gobject.IO_IN, self._on_watcher_event)
+        else:
+            interval = self._config.get('browser.poll_interval', 2000, int)
+            self._watcher_source = \
+              gobject.timeout_add(interval, self._on_watcher_poll)
+
+    def _unwatch_directory(self):
+        '''(internal) Stop watching the current directory.'''
+        for source in (self._watcher_source, self._apply_changes_source):
+            if source is not None:
+                gobject.source_remove(source)
+        self._watcher_source = None
+        self._apply_changes_source = None
+        self._pending_changes = set()
+        if self._watcher is not None:
+            self._watcher.close()
+            self._watcher = None
+
+    def _on_watcher_event(self, fd, condition):
+        self._queue_directory_changes(self._watcher.read_changes())
+        return True
+
+    def _on_watcher_poll(self):
+        if self._watcher.check():
+            self._queue_directory_changes(None)
+        return True
+
+    def _queue_directory_changes(self, names):
+        '''(internal) Accumulate the changes and apply them after a short
+        delay, so that a burst of events (e.g. many files being copied into
+        the directory) results in a single update of the album.
+        '''
+        if names is None or self._pending_changes is None:
+            self._pending_changes = None
+        else:
+            self._pending_changes.update(names)
+        if self._apply_changes_source is None:
+            delay = self._config.get('browser.update_delay', 250, int)
+            self._apply_changes_source = \
+              gobject.timeout_add(delay, self._apply_directory_changes)
+
+    def _apply_directory_changes(self):
+        names = self._pending_changes
+        self._pending_changes = set()
+        self._apply_changes_source = None
+        if self.file_list is not None:
+            self.file_list.refresh(names)
+        return False
+
+    def _on_walk_update(self, file_list):
+        '''(internal) Add to the album the files found by the walk of the
+        directory tree since the last call.'''
+        if file_list is not self.file_list:
+            return False
+        walking = file_list.update_walk()
+        if not walking:
+            self._walk_source = None
+        return walking
+
+    def _stop_walk(self):
+        '''(internal) Stop walking the tree of the current directory.'''
+        if self._walk_source is not None:
+            gobject.source_remove(self._walk_source)
+            self._walk_source = None
+        if self.file_list is not None:
+            self.file_list.stop_walk()
+
+    def on_file_list_changed(self, file_list, changed_items):
+        '''Called when the file list changes, to patch the album.'''
+        if file_list is not self.file_list or self.album is None:
+            return
+
+        # Thumbnails for modified or removed files are now stale.
+        for item in changed_items:
+            self.orchestrator.forget_thumbnail(item.full_path)
+
+        anchor = self._get_scroll_anchor()
+        self.album.patch(file_list, changed_items)
+        self._update_scrollbars(anchor)
+        self.queue_draw()
+
     def scroll_adjustment(self, hadjustment, vadjustment):
         self._hadjustment = hadjustment
         self._vadjustment = vadjustment
@@ -155,8 +359,27 @@ class ImageBrowser(gtk.DrawingArea, BackCaller):
         self._set_y_location()
         self.queue_draw()
 
-    def _update_scrollbars(self):
-        '''(internal) Update the ranges and positions of the scrollbars.'''
+    def _get_scroll_anchor(self):
+        '''(internal) Return a tuple (file_item, dy) for the thumbnail at the
+        top of the viewport, where dy is the distance of the top of the
+        viewport from the top of the thumbnail. Return None if there is no
+        such thumbnail.
+        '''
+        if self.album is None or self.window is None:
+            return None
+        y = self._get_y_location()
+        width, height = self.window.get_size()
+        rows = self.album.get_rows(y, height)
+        if len(rows) == 0 or rows[0].empty():
+            return None
+        thumbnail = rows[0].images[0]
+        return (thumbnail.get_file_item(), y - thumbnail.pos[1])
+
+    def _update_scrollbars(self, anchor=None):
+        '''(internal) Update the ranges and positions of the scrollbars.
+        If `anchor` is given (see _get_scroll_anchor) the view is scrolled
+        so that the anchor thumbnail is at the top of the viewport.
+        '''
 
         ha = self._hadjustment
         va = self._vadjustment
@@ -192,6 +415,13 @@ class ImageBrowser(gtk.DrawingArea, BackCaller):
         relative_pos = va.value / float(old_album_height)
         new_value = relative_pos * new_album_height
 
+        # When re-sorting we rather keep the top thumbnail in view.
+        if anchor is not None:
+            file_item, dy = anchor
+            thumbnail = self.album.thumbnails.get(file_item)
+            if thumbnail is not None and thumbnail.pos is not None:
+                new_value = thumbnail.pos[1] + min(dy, thumbnail.size[1])
+
         # Set the new view, making sure it is within the interval.
         va.lower = 0.0
         va.upper = new_album_height
@@ -199,6 +429,8 @@ class ImageBrowser(gtk.DrawingArea, BackCaller):
         va.page_increment = 0.9*window_height
         va.step_increment = 0.3*window_height
         va.value = max(0, min(new_value, new_album_height - window_height))
+        if anchor is not None:
+            self._set_y_location()
 
     def get_thumbnail_pixbuf(self, thumbnail):
         '''Get the pixbuf (possibly from the cache) for the given Thumbnail
@@ -207,12 +439,22 @@ class ImageBrowser(gtk.DrawingArea, BackCaller):
 
         file_item = thumbnail.get_file_item()
         if not thumbnail.damaged:
+            # Thumbnails are generated with a few canonical sizes and scaled
+            # here, so that they are reused when zooming.
             tn = self.orchestrator.request_thumbnail(file_item.full_path,
-                                                     thumbnail.size)
+                                                     thumbnail.size,
+                                                     scalable=True)
             if tn.state is THUMBNAIL_DONE:
-                return \
-                    gtk.gdk.pixbuf_new_from_array(tn.data,
-                                                  gtk.gdk.COLORSPACE_RGB, 8)
+                self.orchestrator.stats.record_drawn(tn.request_id)
+                return self._get_scaled_pixbuf(tn, thumbnail.size)
+            if tn.placeholder is not None:
+                # Show the old thumbnail, scaled, until the new one arrives.
+                pixbuf = \
+                  gtk.gdk.pixbuf_new_from_array(tn.placeholder,
+                                                gtk.gdk.COLORSPACE_RGB, 8)
+                return pixbuf.scale_simple(thumbnail.size[0],
+                                           thumbnail.size[1],
+                                           gtk.gdk.INTERP_BILINEAR)
             text = 'Loading...\n' + os.path.basename(file_item.name)
             icon_color = self._config.get_color_triple('thumb.color.loading',
                                                        '#ff0000')
@@ -226,6 +468,34 @@ class ImageBrowser(gtk.DrawingArea, BackCaller):
                                         out_format=icons.FORMAT_PIXBUF)
         return build_empty_thumbnail(thumbnail.size)
 
+    def _get_scaled_pixbuf(self, tn, size):
+        '''(internal) Return a pixbuf for the data of the given orchestrator
+        thumbnail, scaled to the given size.'''
+        key = (tn.request_id, tuple(size))
+        scaled_pixbufs = self._scaled_pixbufs
+        pixbuf = scaled_pixbufs.pop(key, None)
+        if pixbuf is None:
+            pixbuf = gtk.gdk.pixbuf_new_from_array(tn.data,
+                                                   gtk.gdk.COLORSPACE_RGB, 8)
+            if (pixbuf.get_width(), pixbuf.get_height()) == tuple(size):
+                return pixbuf
+            pixbuf = pixbuf.scale_simple(size[0], size[1],
+                                         gtk.gdk.INTERP_BILINEAR)
+        scaled_pixbufs[key] = pixbuf
+        max_entries = self._config.get('browser.scaled_cache_size', 256, int)
+        while len(scaled_pixbufs) > max(0, max_entries):
+            scaled_pixbufs.popitem(last=False)
+        return pixbuf
+
+    def get_cached_thumbnail(self, file_name):
+        '''Return the pixel data of the thumbnail cached for the given file
+        (possibly with a different size than currently displayed) or None if
+        no thumbnail is available.'''
+        tn = self.orchestrator.thumbnails.get(file_name)
+        if tn is None:
+            return None
+        return (tn.data if tn.state == THUMBNAIL_DONE else tn.placeholder)
+
     def on_thumbnail_available(self, *args):
         '''Called by the orchestrator when thumbnails become available.'''
 
@@ -233,6 +503,7 @@ class ImageBrowser(gtk.DrawingArea, BackCaller):
         with gtk.gdk.lock:
             self.queue_draw()
 
+    @profiled('ImageBrowser.on_expose_event', frame=True)
     def on_expose_event(self, draw_area, event):
         '''Function responsible for the rendering of the widget.'''
 
@@ -358,7 +629,11 @@ class ImageBrowser(gtk.DrawingArea, BackCaller):
         if not isinstance(location, Location):
             location = Location(location)
 
+        self._stop_walk()
+        self._save_directory_state()
         self.location = location
+        self.file_list = None
+        self.album = None
         self._vadjustment.value = self._get_y_location()
         self._lay_out_album()
         self._update_scrollbars()
@@ -366,9 +641,11 @@ class ImageBrowser(gtk.DrawingArea, BackCaller):
         self.queue_draw()
 
     def update_album(self):
-        '''Redraw the browser view.'''
+        '''Redraw the browser view, keeping in view the thumbnail which is
+        currently at the top.'''
+        anchor = self._get_scroll_anchor()
         self._lay_out_album()
-        self._update_scrollbars()
+        self._update_scrollbars(anchor)
         self.queue_draw()
 
     def zoom(self, new_exp, relative=True):
@@ -0,0 +1,233 @@
+# Copyright 2017 Matteo Franchin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Cache of decoded images shared by all the viewer tabs.
+
+Images are decoded once and kept as a mipmap pyramid: level 0 is the full
+resolution pixbuf (or a downscaled preview of it) and each following level
+halves the size of the previous one. Levels are built lazily and a scaled
+image is always obtained from the smallest level which is not smaller than
+the requested size.
+
+Images are decoded with gdk-pixbuf, except for the formats it cannot read
+(e.g. RAW files, see formats.py), which are decoded with PIL.
+'''
+
+import os
+from collections import OrderedDict
+
+import numpy
+import gtk
+import gtk.gdk
+
+from . import icons
+from .formats import get_format_from_path
+from .thumbnailers import open_scalable_image, get_image_size, to_rgb
+from .config import logger
+
+
+def get_pixbuf_nbytes(pixbuf):
+    '''Return the memory used by the pixel data of the given pixbuf.'''
+    return pixbuf.get_rowstride() * pixbuf.get_height()
+
+
+class ImagePyramid(object):
+    '''Mipmap pyramid for an image. `size` is the size of the original image,
+    which may be bigger than the first level when the pyramid was built from
+    a downscaled version of the image (a preview).'''
+
+    def __init__(self, pixbuf, full_size=None):
+        self.levels = [pixbuf]
+        self.size = full_size or (pixbuf.get_width(), pixbuf.get_height())
+
+    def is_complete(self):
+        '''Whether the pyramid contains the image at full resolution.'''
+        return self.covers(*self.size)
+
+    def covers(self, width, height):
+        '''Whether the pyramid can provide the image with the given size
+        without upscaling (up to a small tolerance for rounding errors).'''
+        level = self.levels[0]
+        return (1.01*level.get_width() + 1 >= min(width, self.size[0]) and
+                1.01*level.get_height() + 1 >= min(height, self.size[1]))
+
+    def get_nbytes(self):
+        return sum(get_pixbuf_nbytes(level) for level in self.levels)
+
+    def get_level(self, width, height):
+        '''Return the smallest level which is at least as big as the given
+        size, building the missing levels as necessary.
+        '''
+        idx = 0
+        level = self.levels[0]
+        while True:
+            half_width = level.get_width() // 2
+            half_height = level.get_height() // 2
+            if (half_width < max(1, width) or half_height < max(1, height)):
+                return level
+            idx += 1
+            if idx == len(self.levels):
+                self.levels.append(level.scale_simple(half_width, half_height,
+                                                      gtk.gdk.INTERP_BILINEAR))
+            level = self.levels[idx]
+
+    def get_scaled(self, width, height, interp=gtk.gdk.INTERP_BILINEAR):
+        '''Return the image scaled to the given size.'''
+        level = self.get_level(width, height)
+        if (level.get_width(), level.get_height()) == (width, height):
+            return level
+        return level.scale_simple(width, height, interp)
+
+
+class ImageCache(object):
+    '''Least-recently-used cache of ImagePyramid objects with a cap on the
+    total memory they use.'''
+
+    # Formats whose decoder can produce a reduced resolution image much
+    # faster than the full resolution one (JPEG uses DCT scaling).
+    draft_formats = ('jpeg',)
+
+    def __init__(self, max_nbytes=256*1024*1024, damaged_color=(0.6, 0, 0)):
+        self.max_nbytes = max_nbytes
+        self.damaged_color = damaged_color
+        self._pyramids = OrderedDict()
+
+    def _get_file_info(self, image_path):
+        '''(internal) Return the format and the size of the image, as given
+        by gtk.gdk.pixbuf_get_file_info, or None if the image cannot be
+        decoded by gdk-pixbuf.'''
+        fmt = get_format_from_path(image_path)
+        if fmt is not None and fmt.opener is not None:
+            return None
+        return gtk.gdk.pixbuf_get_file_info(image_path)
+
+    def get(self, image_path, min_size=None):
+        '''Return the ImagePyramid for the given image, decoding it only if
+        it is not in the cache already. A cached preview is returned only if
+        it provides at least `min_size` pixels, otherwise the image is decoded
+        at full resolution. If `min_size` is None, the full resolution image
+        is required.'''
+        pyramid = self._pyramids.pop(image_path, None)
+        if (pyramid is not None and
+            not pyramid.covers(*(min_size or pyramid.size))):
+            pyramid = None
+        if pyramid is None:
+            pyramid = self._decode(image_path, min_size)
+        self._pyramids[image_path] = pyramid
+        return pyramid
+
+    def _decode(self, image_path, min_size=None):
+        '''(internal) Decode the image. If `min_size` is given and the image
+        format supports it, decode it only at the resolution needed to
+        provide `min_size` pixels. If the image cannot be decoded, return a
+        pyramid for an icon telling that the image is damaged.'''
+        if min_size is not None and min(min_size) < 1:
+            min_size = None
+        try:
+            info = self._get_file_info(image_path)
+            if info is None:
+                return self._decode_with_pil(image_path, min_size)
+
+            fmt, width, height = info
+            if (min_size is not None and fmt['name'] in self.draft_formats and
+                (min_size[0] < width or min_size[1] < height)):
+                logger.debug('Decoding {} at reduced size {}'
+                             .format(image_path, min_size))
+                pixbuf = gtk.gdk.pixbuf_new_from_file_at_size(image_path,
+                                                              *min_size)
+                return ImagePyramid(pixbuf, (width, height))
+
+            logger.debug('Decoding {}'.format(image_path))
+            return ImagePyramid(gtk.gdk.pixbuf_new_from_file(image_path))
+        except Exception as exc:
+            logger.error('Cannot decode {}: {}'.format(image_path, str(exc)))
+            text = os.path.basename(image_path) + '\n(Damaged)'
+            pixbuf = icons.generate_text_icon(text, min_size or (400, 300),
+                                              color=self.damaged_color,
+                                              out_format=icons.FORMAT_PIXBUF)
+            return ImagePyramid(pixbuf)
+
+    def _decode_with_pil(self, image_path, min_size=None):
+        '''(internal) Decode the image with PIL (see _decode).'''
+        logger.debug('Decoding {} with PIL'.format(image_path))
+        full_size = get_image_size(image_path)
+        image = open_scalable_image(image_path, min_size)
+        arr = numpy.array(to_rgb(image))
+        pixbuf = gtk.gdk.pixbuf_new_from_array(arr, gtk.gdk.COLORSPACE_RGB, 8)
+        return ImagePyramid(pixbuf, full_size)
+
+    def get_size(self, image_path):
+        '''Return the size of the given image. This reads only the header of
+        the file, unless the image is in the cache.'''
+        pyramid = self._pyramids.get(image_path)
+        if pyramid is not None:
+            return pyramid.size
+        try:
+            info = self._get_file_info(image_path)
+            if info is not None:
+                return info[1:]
+            return get_image_size(image_path)
+        except Exception:
+            return self.get(image_path).size
+
+    def can_decode_fast(self, image_path):
+        '''Whether the given image can be decoded quickly at reduced
+        resolution.'''
+        info = self._get_file_info(image_path)
+        return info is not None and info[0]['name'] in self.draft_formats
+
+    def contains(self, image_path, min_size=None):
+        '''Whether get() would return the given image without decoding it.'''
+        pyramid = self._pyramids.get(image_path)
+        return (pyramid is not None and
+                pyramid.covers(*(min_size or pyramid.size)))
+
+    def put(self, image_path, pyramid):
+        '''Put the given pyramid in the cache, unless the cache already has a
+        bigger version of the same image.'''
+        old_pyramid = self._pyramids.pop(image_path, None)
+        if (old_pyramid is not None and
+            old_pyramid.levels[0].get_width() >
+              pyramid.levels[0].get_width()):
+            pyramid = old_pyramid
+        self._pyramids[image_path] = pyramid
+
+    def trim(self):
+        '''Remove the least recently used images until the memory used by the
+        cache is within the limit. The most recently used image is always
+        kept. This should be called after the pyramids obtained from the
+        cache have been used, as they may have grown new levels.'''
+        pyramids = self._pyramids
+        nbytes = sum(p.get_nbytes() for p in pyramids.itervalues())
+        while len(pyramids) > 1 and nbytes > self.max_nbytes:
+            _, pyramid = pyramids.popitem(last=False)
+            nbytes -= pyramid.get_nbytes()
+
+    def forget(self, image_path):
+        '''Remove the given image from the cache.'''
+        self._pyramids.pop(image_path, None)
+
+
+_image_cache = None
+
+def get_image_cache(config):
+    '''Return the ImageCache shared by all the viewer tabs.'''
+    global _image_cache
+    if _image_cache is None:
+        max_mbytes = config.get('viewer.cache_size', 256, int)
+        damaged_color = config.get_color_triple('thumb.color.damaged',
+                                                '#a00000')
+        _image_cache = ImageCache(max_nbytes=max_mbytes*1024*1024,
+                                  damaged_color=damaged_color)
+    return _image_cache
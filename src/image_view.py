@@ -0,0 +1,244 @@
+# Copyright 2017 Matteo Franchin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Widget showing a (possibly huge) image at an arbitrary zoom level.
+
+The zoomed image is never allocated as a whole. It is split in square tiles
+which are generated only when visible and are kept in a bounded cache.
+Missing tiles are first drawn quickly from a coarse level of the image
+pyramid and then replaced by properly scaled tiles, which are generated
+when the main loop is idle.
+'''
+
+import time
+from collections import OrderedDict
+
+import gobject
+import gtk
+import gtk.gdk
+
+from .profiling import profiled
+
+TILE_SIZE = 256
+
+
+class TiledImageView(gtk.DrawingArea):
+    __gsignals__ = \
+      {'set-scroll-adjustment': (gobject.SIGNAL_RUN_LAST,
+                                 gobject.TYPE_NONE,
+                                 (gtk.Adjustment, gtk.Adjustment))}
+
+    def __init__(self, max_tiles=128, tile_size=TILE_SIZE):
+        gtk.DrawingArea.__init__(self)
+        self.pyramid = None
+        self.virtual_size = (1, 1)
+        self.tile_size = tile_size
+        self._hadjustment = None
+        self._vadjustment = None
+
+        # Tile cache, from the least to the most recently used. Tiles are
+        # indexed by (virtual_size, tile_x, tile_y).
+        self._tiles = OrderedDict()
+        self._max_tiles = max_tiles
+        self._min_tiles = 0
+
+        # Tiles waiting to be generated (keys of an OrderedDict, used as an
+        # ordered set) and id of the idle callback generating them.
+        self._pending_tiles = OrderedDict()
+        self._idle_source = None
+
+        # Whether tiles are generated as soon as they are needed, rather than
+        # drawn coarse first (see set_frame).
+        self._immediate_tiles = False
+
+        self.connect('expose_event', self.on_expose_event)
+        self.connect('set-scroll-adjustment', TiledImageView.scroll_adjustment)
+        self.connect('size-allocate', self.on_size_allocate)
+
+    def set_image(self, pyramid, size=None):
+        '''Show the image in the given ImagePyramid with the given size.'''
+        self.pyramid = pyramid
+        self._tiles.clear()
+        self._pending_tiles.clear()
+        self._immediate_tiles = False
+        self.set_virtual_size(*(size or pyramid.size))
+
+    def set_frame(self, pyramid):
+        '''Replace the image with another one with the same size (e.g. the
+        next frame of an animation), keeping zoom and scroll position. The
+        tiles are generated straight away, as drawing them coarse first
+        would make the animation flicker.'''
+        self.pyramid = pyramid
+        self._tiles.clear()
+        self._pending_tiles.clear()
+        self._immediate_tiles = True
+        self.queue_draw()
+
+    def set_virtual_size(self, width, height):
+        '''Zoom the image so that it has the given size.'''
+        self.virtual_size = (max(1, width), max(1, height))
+        self._pending_tiles.clear()
+        self._update_adjustments()
+        self.queue_draw()
+
+    def scroll_adjustment(self, hadjustment, vadjustment):
+        self._hadjustment = hadjustment
+        self._vadjustment = vadjustment
+        for adjustment in (hadjustment, vadjustment):
+            if isinstance(adjustment, gtk.Adjustment):
+                adjustment.connect('value-changed',
+                                   lambda *args: self.queue_draw())
+        self._update_adjustments()
+
+    def on_size_allocate(self, widget, allocation):
+        self._update_adjustments()
+
+    def _update_adjustments(self):
+        '''(internal) Update the scrollbars after a change of zoom or of
+        allocation, keeping the same point of the image at the center.'''
+        allocation = self.get_allocation()
+        for adj, virtual, page in \
+          ((self._hadjustment, self.virtual_size[0], allocation.width),
+           (self._vadjustment, self.virtual_size[1], allocation.height)):
+            if not isinstance(adj, gtk.Adjustment):
+                continue
+            old_upper = max(1.0, adj.upper)
+            center = (adj.value + 0.5*adj.page_size) / old_upper
+            adj.lower = 0.0
+            adj.upper = float(virtual)
+            adj.page_size = float(min(page, virtual))
+            adj.page_increment = 0.9*page
+            adj.step_increment = 0.1*page
+            adj.set_value(max(0.0, min(center*virtual - 0.5*page,
+                                       virtual - adj.page_size)))
+
+    def _get_origin(self):
+        '''(internal) Return the position in the zoomed image of the top-left
+        corner of the widget. Images smaller than the widget are centered.'''
+        allocation = self.get_allocation()
+        origin = []
+        for adj, virtual, page in \
+          ((self._hadjustment, self.virtual_size[0], allocation.width),
+           (self._vadjustment, self.virtual_size[1], allocation.height)):
+            if virtual < page or adj is None:
+                origin.append(-((page - virtual) // 2))
+            else:
+                origin.append(int(adj.value))
+        return tuple(origin)
+
+    def _build_tile(self, tx, ty, coarse=False):
+        '''(internal) Return the pixbuf for the given tile. If `coarse` is
+        true, return a quick approximation of it.'''
+        vw, vh = self.virtual_size
+        ts = self.tile_size
+        x0, y0 = (tx*ts, ty*ts)
+        width, height = (min(ts, vw - x0), min(ts, vh - y0))
+        if coarse:
+            level = self.pyramid.get_level(vw // 4, vh // 4)
+            interp = gtk.gdk.INTERP_NEAREST
+        else:
+            level = self.pyramid.get_level(vw, vh)
+            interp = gtk.gdk.INTERP_BILINEAR
+        tile = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, level.get_has_alpha(),
+                              8, width, height)
+        level.scale(tile, 0, 0, width, height, -x0, -y0,
+                    vw/float(level.get_width()),
+                    vh/float(level.get_height()), interp)
+        return tile
+
+    def _get_tile(self, tx, ty):
+        '''(internal) Return the pixbuf for the given tile, from the cache if
+        possible. Otherwise return a coarse version of the tile and schedule
+        the generation of the proper one.'''
+        key = (self.virtual_size, tx, ty)
+        tile = self._tiles.pop(key, None)
+        if tile is not None:
+            self._tiles[key] = tile
+            return tile
+
+        if self._immediate_tiles:
+            self._tiles[key] = tile = self._build_tile(tx, ty)
+            return tile
+
+        self._pending_tiles.pop(key, None)
+        self._pending_tiles[key] = None
+        if self._idle_source is None:
+            self._idle_source = gobject.idle_add(self._generate_tiles)
+        return self._build_tile(tx, ty, coarse=True)
+
+    @profiled('TiledImageView._generate_tiles')
+    def _generate_tiles(self, time_budget=0.01):
+        '''(internal) Idle callback generating the pending tiles, the most
+        recently requested first. Work for at most `time_budget` seconds
+        before giving control back to the main loop.'''
+        deadline = time.time() + time_budget
+        pending = self._pending_tiles
+        tiles = self._tiles
+        while len(pending) > 0 and time.time() < deadline:
+            key, _ = pending.popitem(last=True)
+            virtual_size, tx, ty = key
+            if virtual_size != self.virtual_size or key in tiles:
+                continue
+            tiles[key] = self._build_tile(tx, ty)
+            while len(tiles) > max(self._max_tiles, self._min_tiles):
+                tiles.popitem(last=False)
+
+            ox, oy = self._get_origin()
+            ts = self.tile_size
+            self.queue_draw_area(tx*ts - ox, ty*ts - oy, ts, ts)
+
+        if len(pending) > 0:
+            return True
+        self._idle_source = None
+        return False
+
+    @profiled('TiledImageView.on_expose_event', frame=True)
+    def on_expose_event(self, widget, event):
+        '''Draw the tiles which intersect the exposed area.'''
+        if self.pyramid is None:
+            return True
+
+        ts = self.tile_size
+        vw, vh = self.virtual_size
+        ox, oy = self._get_origin()
+        ea = event.area
+        x0 = max(0, ea.x + ox)
+        y0 = max(0, ea.y + oy)
+        x1 = min(vw, ea.x + ea.width + ox)
+        y1 = min(vh, ea.y + ea.height + oy)
+        if x1 <= x0 or y1 <= y0:
+            return True
+
+        # Make sure the cache can contain all the visible tiles (twice).
+        allocation = self.get_allocation()
+        self._min_tiles = \
+          2*(allocation.width // ts + 2)*(allocation.height // ts + 2)
+
+        gc = self.style.black_gc
+        for ty in range(y0 // ts, (y1 - 1) // ts + 1):
+            for tx in range(x0 // ts, (x1 - 1) // ts + 1):
+                tile = self._get_tile(tx, ty)
+                tile_x0 = max(x0, tx*ts)
+                tile_y0 = max(y0, ty*ts)
+                tile_x1 = min(x1, tx*ts + tile.get_width())
+                tile_y1 = min(y1, ty*ts + tile.get_height())
+                if tile_x1 <= tile_x0 or tile_y1 <= tile_y0:
+                    continue
+                self.window.draw_pixbuf(gc, tile,
+                                        tile_x0 - tx*ts, tile_y0 - ty*ts,
+                                        tile_x0 - ox, tile_y0 - oy,
+                                        tile_x1 - tile_x0, tile_y1 - tile_y0)
+        return True
+
+TiledImageView.set_set_scroll_adjustments_signal('set-scroll-adjustment')
@@ -88,13 +88,74 @@ class ImageAlbumRow(object):
         self.size = (width, height)
 
 class ImageAlbum(object):
-    def __init__(self, file_list, max_width=1200, border=(5, 5), **kwargs):
+    def __init__(self, file_list, max_width=1200, border=(5, 5),
+                 max_size=None):
         self.rows = []
         self.border = border
-        for row in lay_out_images(file_list, max_width=max_width,
-                                  border=border[0], **kwargs):
+        self.max_width = max_width
+        self.max_size = max_size
+
+        # Thumbnails indexed by FileListItem. They are kept across layouts so
+        # that the image sizes are obtained only once.
+        self.thumbnails = {}
+        self.lay_out(file_list)
+
+    def lay_out(self, file_list, max_width=None, max_size=None):
+        '''Pack the thumbnails for the items in `file_list` into rows. This
+        can be called again after the file list is re-sorted or when the
+        album width or thumbnail size change: thumbnails created by previous
+        calls are reused, together with the image sizes they cached.
+        '''
+        if max_width is not None:
+            self.max_width = max_width
+        if max_size is not None:
+            self.max_size = max_size
+        self.rows = []
+        self.ordered = get_thumbnails_in_order(file_list, self.thumbnails)
+        self._pack(self.ordered)
+
+    def _pack(self, thumbnails):
+        '''(internal) Pack the thumbnails in rows after the existing ones.'''
+        for row in pack_thumbnails(thumbnails, max_width=self.max_width,
+                                   border=self.border[0],
+                                   max_size=self.max_size):
             self.add(row)
 
+    def patch(self, file_list, modified_items=()):
+        '''Update the album after items were added to or removed from
+        `file_list`. `modified_items` are items whose file changed, for which
+        the image size has to be obtained again. Rows preceding the first
+        thumbnail which changed are kept, the following rows are packed again.
+        '''
+        thumbnails = self.thumbnails
+        for item in modified_items:
+            thumbnails.pop(item, None)
+        old_ordered = self.ordered
+        self.ordered = ordered = get_thumbnails_in_order(file_list, thumbnails)
+
+        # Forget the thumbnails of the items which have been removed.
+        if len(thumbnails) > len(ordered):
+            self.thumbnails = thumbnails = \
+              dict((tn.get_file_item(), tn) for tn in ordered)
+
+        # Find the first position where the layout changed.
+        first = 0
+        end = min(len(old_ordered), len(ordered))
+        while first < end and old_ordered[first] is ordered[first]:
+            first += 1
+
+        # Keep the rows which precede it. The last row is never kept, as it
+        # is not full and may accommodate new thumbnails.
+        num_kept = 0
+        num_rows = 0
+        for row in self.rows[:-1]:
+            if num_kept + len(row.images) > first:
+                break
+            num_kept += len(row.images)
+            num_rows += 1
+        del self.rows[num_rows:]
+        self._pack(ordered[num_kept:])
+
     def get_height(self):
         if len(self.rows) == 0:
             return 0.0
@@ -182,26 +243,40 @@ class ImageAlbum(object):
                     images.append(image)
         return images
 
-def lay_out_images(file_list, border=2, max_width=1200, max_size=None):
-    if max_size is None:
-        max_size = (400, 150)
-
-    # Find all images and subdirectories that we will have to display.
+def get_thumbnails_in_order(file_list, thumbnails):
+    '''Return the thumbnails for the items in `file_list`, in the order in
+    which they are laid out (subdirectories first). `thumbnails` is a
+    dictionary mapping FileListItem objects to their thumbnails. Thumbnails
+    found there are reused, while new thumbnails are added to it.
+    '''
     subdirs = []
     images = []
     for file_item in file_list:
+        thumbnail = thumbnails.get(file_item)
+        if thumbnail is None:
+            thumbnails[file_item] = thumbnail = \
+              (DirectoryThumbnail(file_item) if file_item.is_dir
+               else ImageThumbnail(file_item))
+
         # Deal with directories separately.
         if file_item.is_dir:
-            subdirs.append(DirectoryThumbnail(file_item))
+            subdirs.append(thumbnail)
         else:
-            # Filter files by extension.
-            images.append(ImageThumbnail(file_item))
+            images.append(thumbnail)
+    return subdirs + images
+
+def pack_thumbnails(thumbnails, border=2, max_width=1200, max_size=None):
+    '''Generate the rows for the given sequence of thumbnails.'''
+    if max_size is None:
+        max_size = (400, 150)
 
     # Create the image layout, row by row.
     row = ImageAlbumRow(max_width)
-    for image in itertools.chain(subdirs, images):
-        # Get the size of the image and compute the thumbnail size.
-        image.obtain_image_info()
+    for image in thumbnails:
+        # Get the size of the image (unless already known) and compute the
+        # thumbnail size.
+        if image.orig_size is None:
+            image.obtain_image_info()
         image.compute_size(max_size)
 
         # Try adding the image to the row, or send the old row via the call
@@ -213,3 +288,14 @@ def lay_out_images(file_list, border=2, max_width=1200, max_size=None):
 
     if not row.empty():
         yield row
+
+def lay_out_images(file_list, border=2, max_width=1200, max_size=None,
+                   thumbnails=None):
+    '''Generate the rows of thumbnails for the items in `file_list`.
+    `thumbnails` is an optional dictionary mapping FileListItem objects to
+    their thumbnails (see get_thumbnails_in_order).
+    '''
+    ordered = get_thumbnails_in_order(file_list,
+                                      {} if thumbnails is None else thumbnails)
+    return pack_thumbnails(ordered, border=border, max_width=max_width,
+                           max_size=max_size)
@@ -18,11 +18,17 @@ Module responsible of prioritising and carrying out the creation of thumbnails.
 The work is carried out by the Orchestrator object, which collects requests
 for thumbnail generation and sends them to a separate process. The work is
 prioritised such that the last thumbnail request is carried out first.
+
+Decoders may crash or hang on damaged files. The orchestrator watches the
+worker process: if it dies, or takes too long on one request, the request
+is marked as damaged and a new worker is started to carry out the requests
+which were still queued.
 '''
 
 import os
-from threading import Thread
-from multiprocessing import Process, Queue
+import time
+from threading import Thread, Lock
+from multiprocessing import Process, Pipe
 from collections import namedtuple
 try:
     from Queue import Empty
@@ -30,7 +36,12 @@ except ImportError:
     from queue import Empty
 
 from .backcaller import BackCaller
-from .thumbnailers import build_image_thumbnail, build_directory_thumbnail
+from .stats import OrchestratorStats
+from .forkserver import get_fork_server, ConnectionQueue
+from .formats import get_format_from_path, COST_HEAVY
+from .thumbnail_cache import get_thumbnail_cache
+from .decode_limits import get_decode_limits
+from .config import logger, SCALAR
 
 def comment(s): pass
 
@@ -39,6 +50,21 @@ def comment(s): pass
  THUMBNAIL_DAMAGED,
  THUMBNAIL_DONE) = range(3)
 
+def quantize_size(size, step=2**0.5, min_side=32):
+    '''Return the canonical size for a thumbnail which is shown with the
+    given size: the size scaled up, keeping the aspect ratio, so that its
+    largest side is min_side*step**n, for the smallest integer n. Sizes
+    which differ slightly (e.g. at different zoom levels) map to the same
+    canonical size, so that the same thumbnail can be reused.'''
+    width, height = size
+    largest = max(width, height, 1)
+    side = float(min_side)
+    while side < largest - 0.5:
+        side *= step
+    side = int(round(side))
+    scale = side/float(largest)
+    return (max(1, int(round(width*scale))), max(1, int(round(height*scale))))
+
 class Thumbnail(object):
     def __init__(self, file_name, size, state, request_id, data=None):
         self.file_name = file_name
@@ -47,27 +73,54 @@ class Thumbnail(object):
         self.request_id = request_id
         self.data = data
 
+        # Data of a previous thumbnail for the same file, but with a different
+        # size. This can be scaled and shown while the new one is loading.
+        self.placeholder = None
+
     def match(self, size):
         # TODO: For now we tolerate slight errors in the resize.
         return size[0] == self.size[0] or size[1] == self.size[1]
 
+    def covers(self, size, max_scale=2.0):
+        '''Whether this thumbnail is ready and can be scaled down to the
+        given size, by a factor not larger than `max_scale`.'''
+        return (self.state == THUMBNAIL_DONE and
+                max(size) <= max(self.size) <= max_scale*max(size))
+
 
 class Worker(Process):
-    def __init__(self, cmd_queue, out_queue):
+    def __init__(self, cmd_queue, out_queue, thumbnail_cache=None,
+                 decode_limits=None, resize_backend=None):
         super(Worker, self).__init__()
 
         # Queues used to coordinate work with other threads.
         self.cmd_queue = cmd_queue
         self.out_queue = out_queue
 
+        # Persistent thumbnail cache (see thumbnail_cache.py), if any.
+        self.thumbnail_cache = thumbnail_cache
+
+        # Limits on the resources used to decode images (see
+        # decode_limits.py), applied when the process starts.
+        self.decode_limits = decode_limits
+
+        # Name of the function used to scale images down (see
+        # thumbnailers.resize_backends) or None for the default.
+        self.resize_backend = resize_backend
+
         # Private datastructures always accessed from the same thread.
         self.local_queue = []
         self.idx_from_req = {}
         self.current_request_id = None
+        self.num_aborted = 0
 
     def run(self):
         '''The main worker loop.'''
 
+        # Import the image libraries now, in parallel with the construction
+        # of the GUI in the main process, rather than at the first request.
+        self.warm_up()
+
         while True:
             # Move all items from cmd_queue to local queue.
             # Block during get if the local queue is empty.
@@ -147,21 +200,49 @@ class Worker(Process):
                 assert args[0] == 'MAKETHUMB'
                 request_id, file_name, size = args[1:]
                 self.idx_from_req.pop(request_id)
+                timings = {'dequeued': time.time(),
+                           'queue_depth': len(self.local_queue)}
 
                 comment('Received MAKETHUMB command with ID {}'
                         .format(request_id))
                 self.current_request_id = request_id
+
+                # Tell the orchestrator which request we are working on, so
+                # that it can be marked as damaged if we crash or hang.
+                self.out_queue.put(('STARTED', request_id, file_name, size))
+                timings['decode_start'] = time.time()
                 state, data = \
                   self.make_thumb(file_name, size,
                                   check_cancelled=self.check_thumb_cancelled)
+                timings['decode_end'] = time.time()
                 if self.check_thumb_cancelled():
+                    self.num_aborted += 1
+                    self.out_queue.put(('ABORTED', request_id))
                     return
                 comment('MAKETHUMB processed: sending result')
+                timings['worker_aborted'] = self.num_aborted
+                timings['sent'] = time.time()
                 self.out_queue.put(('MAKETHUMB', file_name, size, request_id,
-                                    state, data))
+                                    state, data, timings))
                 return
 
+    def warm_up(self):
+        '''Import the modules needed to make thumbnails and apply the
+        decoding limits and the other thumbnailer settings.'''
+        from . import thumbnailers
+        if self.decode_limits is not None:
+            self.decode_limits.apply()
+        if self.resize_backend is not None:
+            thumbnailers.set_resize_backend(self.resize_backend)
+
     def make_thumb(self, file_name, size, **kwargs):
+        from .thumbnailers import build_image_thumbnail, \
+          build_directory_thumbnail
+        if self.thumbnail_cache is not None:
+            arr = self.thumbnail_cache.find(file_name, size)
+            if arr is not None:
+                return (THUMBNAIL_DONE, arr)
+
         if os.path.isdir(file_name):
             arr = build_directory_thumbnail(file_name, size, **kwargs)
         else:
@@ -175,34 +256,83 @@ def listener_main(orchestrator):
 
     The listener thread is responsible for taking the thumbnails produced by
     the worker process and putting them back into the orchestrator thumbnail
-    cache (by calling Orchestrator.thumbnail_read()).
+    cache (by calling Orchestrator.thumbnail_read()). It also checks
+    periodically that the worker process is alive and responsive.
     '''
 
     while True:
-        args = orchestrator.out_queue.get()
+        try:
+            args = orchestrator.out_queue.get(
+              timeout=orchestrator.poll_interval)
+        except Empty:
+            if orchestrator.check_worker():
+                continue
+            return
+        except (EOFError, IOError):
+            # The connection with the worker process was lost.
+            if orchestrator.restart_worker('worker process exited'):
+                continue
+            return
         out_item = args[0]
         if out_item == 'STOP':
             return
         if out_item == 'MAKETHUMB':
+            # The worker completed a request: it is working properly.
+            orchestrator.num_failed_starts = 0
             orchestrator.thumbnail_ready(*args[1:])
+        elif out_item == 'STARTED':
+            orchestrator.thumbnail_started(*args[1:])
+        elif out_item == 'ABORTED':
+            orchestrator.thumbnail_finished(*args[1:])
         else:
             raise ValueError('Listener received unknown output: {}'
                              .format(out_item))
 
 class Orchestrator(BackCaller):
-    def __init__(self, soft_limit=500, hard_limit=550):
+    # Interval (in seconds) between checks of the worker process.
+    poll_interval = 0.5
+
+    # Number of consecutive times the worker can die without working on any
+    # request before the orchestrator gives up restarting it.
+    max_failed_starts = 3
+
+    # Factor by which the timeout is extended for formats which are slow to
+    # decode (see formats.COST_HEAVY).
+    heavy_timeout_factor = 4
+
+    def __init__(self, soft_limit=500, hard_limit=550, worker_class=Worker,
+                 name='orchestrator', thumbnail_cache=None, timeout=None,
+                 decode_limits=None, resize_backend=None):
         super(Orchestrator, self).__init__(thumbnail_available=None)
+        self.stats = OrchestratorStats(name)
         self.thumbnails = {}
         self.request_id = 0
         self.thumbnail_soft_limit = soft_limit
         self.thumbnail_hard_limit = hard_limit
-        self.cmd_queue = Queue()
-        self.out_queue = Queue()
+        self.worker_class = worker_class
+        self.thumbnail_cache = thumbnail_cache
+        self.decode_limits = decode_limits
+        self.resize_backend = resize_backend
+
+        # Maximum time (in seconds) the worker can spend on one request. None
+        # or 0 means no limit.
+        self.timeout = timeout
+
+        # The request the worker is working on, as the tuple (request_id,
+        # file_name, size, start_time), or None.
+        self.current_request = None
+        self.num_failed_starts = 0
+
+        # Whether the orchestrator gave up restarting the worker. Thumbnails
+        # are then all marked as damaged.
+        self.worker_failed = False
+
+        # Lock protecting the worker and its queues, which are replaced when
+        # the worker is restarted by the listener thread.
+        self._worker_lock = Lock()
 
         # Separate process doing all the hard work.
-        self.worker = Worker(self.cmd_queue, self.out_queue)
-        self.worker.daemon = True
-        self.worker.start()
+        self.start_worker()
 
         # Thread listening to out_queue and calling back when items are
         # available.
@@ -210,26 +340,160 @@ class Orchestrator(BackCaller):
         t.daemon = True
         t.start()
 
-    def request_thumbnail(self, file_name, size):
-        '''Request a thumbnail with the given size in a non-blocking way.'''
+    def start_worker(self):
+        '''Start the worker process. The worker is forked from the fork
+        server, if this was started, otherwise from this process.'''
+        fork_server = get_fork_server()
+        if fork_server is not None:
+            try:
+                self.worker, self.cmd_queue, self.out_queue = \
+                  fork_server.spawn(self.worker_class,
+                                    thumbnail_cache=self.thumbnail_cache,
+                                    decode_limits=self.decode_limits,
+                                    resize_backend=self.resize_backend)
+                return
+            except (EOFError, IOError, OSError) as exc:
+                logger.error('Cannot start worker from the fork server: {}'
+                             .format(str(exc)))
+
+        # The worker sends its messages synchronously through a pipe, rather
+        # than through a multiprocessing.Queue, so that they are not lost if
+        # the worker crashes right after sending them.
+        conn, worker_conn = Pipe()
+        worker_queue = ConnectionQueue(worker_conn)
+        self.worker = self.worker_class(worker_queue, worker_queue,
+                                        thumbnail_cache=self.thumbnail_cache,
+                                        decode_limits=self.decode_limits,
+                                        resize_backend=self.resize_backend)
+        self.worker.daemon = True
+        self.worker.start()
+        worker_conn.close()
+        self.cmd_queue = ConnectionQueue(conn, threaded_put=True)
+        self.out_queue = ConnectionQueue(conn)
+
+    def check_worker(self):
+        '''Check that the worker is alive and is not taking too long on the
+        current request. Restart it if it is not. Return False if the worker
+        could not be restarted.'''
+        current = self.current_request
+        timeout = (self.get_timeout(current[1]) if current is not None
+                   else None)
+        if not self.worker.is_alive():
+            reason = 'worker process exited'
+        elif timeout and time.time() - current[3] > timeout:
+            reason = 'timeout after {} s'.format(timeout)
+        else:
+            return True
+        return self.restart_worker(reason)
+
+    def get_timeout(self, file_name):
+        '''Return the time the worker is given to make the thumbnail for the
+        given file. Formats which are slow to decode get more time.'''
+        if not self.timeout:
+            return self.timeout
+        fmt = get_format_from_path(file_name)
+        if fmt is not None and fmt.cost == COST_HEAVY:
+            return self.timeout*self.heavy_timeout_factor
+        return self.timeout
+
+    def restart_worker(self, reason):
+        '''Kill the worker and start a new one. The request the worker was
+        working on is marked as damaged and the other pending requests are
+        sent to the new worker. Return False if the worker keeps dying and
+        was not restarted: all the pending requests are then marked as
+        damaged.'''
+        with self._worker_lock:
+            current = self.current_request
+            self.current_request = None
+            self.worker.terminate()
+            self.worker.join(1.0)
+            # Release the connection and the sender thread of the old worker.
+            self.cmd_queue.close()
+            self.out_queue.close()
+
+            pending = sorted((tn for tn in list(self.thumbnails.values())
+                              if tn.state == THUMBNAIL_LOADING),
+                             key=lambda tn: tn.request_id)
+            if current is None:
+                self.num_failed_starts += 1
+                if self.num_failed_starts > self.max_failed_starts:
+                    logger.error('Thumbnail worker {!r} keeps failing ({}): '
+                                 'giving up'.format(self.stats.name, reason))
+                    self.worker_failed = True
+            else:
+                self.num_failed_starts = 0
+                logger.warn('Thumbnail worker {!r} failed on {} ({}): '
+                            'restarting it'.format(self.stats.name,
+                                                   current[1], reason))
+
+            if not self.worker_failed:
+                self.stats.record_restart()
+                self.start_worker()
+
+                # Re-submit the pending requests in their original order, so
+                # that the most recent is still carried out first.
+                failed_id = (current[0] if current is not None else None)
+                for tn in pending:
+                    if tn.request_id != failed_id:
+                        self.cmd_queue.put(('MAKETHUMB', tn.request_id,
+                                            tn.file_name, tn.size))
+
+        if self.worker_failed:
+            # Nobody is going to make the pending thumbnails: fail them, so
+            # that callers do not wait for them forever.
+            for tn in pending:
+                self.thumbnail_ready(tn.file_name, tn.size, tn.request_id,
+                                     THUMBNAIL_DAMAGED)
+            return False
+
+        if current is not None:
+            request_id, file_name, size, _ = current
+            self.thumbnail_ready(file_name, size, request_id,
+                                 THUMBNAIL_DAMAGED)
+        return True
+
+    def thumbnail_started(self, request_id, file_name, size):
+        '''Internal. Called when the worker starts working on a request.'''
+        self.current_request = (request_id, file_name, size, time.time())
+
+    def thumbnail_finished(self, request_id):
+        '''Internal. Called when the worker is done with a request, either
+        because it was cancelled or because it was completed.'''
+        current = self.current_request
+        if current is not None and current[0] == request_id:
+            self.current_request = None
+
+    def request_thumbnail(self, file_name, size, scalable=False):
+        '''Request a thumbnail with the given size in a non-blocking way.
+        If `scalable` is true, the caller scales the thumbnail to the size it
+        needs: the size is quantized (see quantize_size) and a thumbnail
+        bigger than needed may be returned.'''
 
         comment('Request thumbnail {} with size {}'.format(file_name, size))
+        if scalable:
+            size = quantize_size(size)
         tn = self.thumbnails.get(file_name)
         if tn is not None:
             # A thumbnail already exists. Unless it has the wrong size return
             # this.
-            if tn.state == THUMBNAIL_DAMAGED or tn.match(size):
+            if (tn.state == THUMBNAIL_DAMAGED or tn.match(size) or
+                (scalable and tn.covers(size))):
             #    (tn.state == THUMBNAIL_DONE and tn.size == size)):
                 comment('Returning cached thumbnail')
+                self.stats.record_cache_hit(tn.state == THUMBNAIL_LOADING)
                 return tn
 
             # If tn.state == THUMBNAIL_LOADING we re-submit the command to
             # ensure it gets a higher priority over the other requests.
             # This is important to ensure we render first the area of the
             # screen the user is looking at.
-            self.cmd_queue.put(('CANCEL', tn.request_id))
+            self._send(('CANCEL', tn.request_id))
+            self.stats.record_cancel(tn.request_id)
             comment('Replacing thumbnail {} != {}'.format(size, tn.size))
+            placeholder = (tn.data if tn.state == THUMBNAIL_DONE
+                           else tn.placeholder)
         else:
+            placeholder = None
             if len(self.thumbnails) >= self.thumbnail_hard_limit:
                 comment('Too many thumbnails ({}): removing old thumbnails...'
                         .format(len(self.thumbnails)))
@@ -241,40 +505,71 @@ class Orchestrator(BackCaller):
                     comment('Rm thumb {}'.format(file_name_to_remove))
                     self.thumbnails.pop(file_name_to_remove)
 
-        # Create or replace the thumbnail.
-        comment('Storing LOADING-thumbnail for {}'.format(file_name))
-        request_id = self.request_id
-        self.request_id += 1
-        self.thumbnails[file_name] = tn = \
-          Thumbnail(file_name, size, THUMBNAIL_LOADING, request_id)
+        # Create or replace the thumbnail and send a request for it. The
+        # lock ensures the request is not sent twice if the worker is being
+        # restarted.
+        with self._worker_lock:
+            request_id = self.request_id
+            self.request_id += 1
+            if self.worker_failed:
+                # There is no worker to make the thumbnail.
+                self.thumbnails[file_name] = tn = \
+                  Thumbnail(file_name, size, THUMBNAIL_DAMAGED, request_id)
+                return tn
+
+            comment('Storing LOADING-thumbnail for {}'.format(file_name))
+            self.thumbnails[file_name] = tn = \
+              Thumbnail(file_name, size, THUMBNAIL_LOADING, request_id)
+            tn.placeholder = placeholder
 
-        # Send a request for the thumbnail.
-        comment('Queuing MAKETHUMB command, request {}'.format(request_id))
-        self.cmd_queue.put(('MAKETHUMB', request_id, file_name, size))
+            comment('Queuing MAKETHUMB command, request {}'.format(request_id))
+            self.stats.record_request(request_id)
+            self.cmd_queue.put(('MAKETHUMB', request_id, file_name, size))
         return tn
 
-    def thumbnail_ready(self, file_name, size, request_id, state, data=None):
-        '''Internal. Used to provide thumbnail data, once it ready.'''
+    def _send(self, cmd):
+        with self._worker_lock:
+            self.cmd_queue.put(cmd)
+
+    def thumbnail_ready(self, file_name, size, request_id, state, data=None,
+                        timings=None):
+        '''Internal. Used to provide thumbnail data, once it ready.
+        `timings` are the timestamps recorded by the worker.'''
 
+        self.thumbnail_finished(request_id)
+        damaged = (state == THUMBNAIL_DAMAGED)
         tn = self.thumbnails.get(file_name)
         if tn is None:
             comment('Received thumbnail for unknown request {}'
                     .format(request_id))
+            self.stats.record_received(request_id, damaged, False, timings)
             return
         if request_id != tn.request_id:
             comment('request_id {} != {} for {}'
                     .format(request_id, tn.request_id, file_name))
             if size != tn.size:
                 comment('Size mismatch: discarding thumbnail')
+                self.stats.record_received(request_id, damaged, False,
+                                           timings)
                 return
 
         comment('Accepting thumbnail for {}'.format(file_name))
+        self.stats.record_received(request_id, damaged, True, timings)
         tn.state = state
         tn.data = data
 
         # Alert that a new thumbnail is now available.
         self.call('thumbnail_available', file_name, size, state, data)
 
+    def forget_thumbnail(self, file_name):
+        '''Remove the thumbnail for the given file from the cache (e.g. because
+        the file changed). Pending requests for it are cancelled.'''
+
+        tn = self.thumbnails.pop(file_name, None)
+        if tn is not None and tn.state == THUMBNAIL_LOADING:
+            self._send(('CANCEL', tn.request_id))
+            self.stats.record_cancel(tn.request_id)
+
     def clear_queue(self):
         '''Abort all the work in progress and clear the queue.'''
 
@@ -284,10 +579,40 @@ class Orchestrator(BackCaller):
         for tn in tn_to_remove:
             self.thumbnails.pop(tn)
 
-        self.cmd_queue.put(('CLEARQ',))
+        self.stats.record_clear()
+
+        self._send(('CLEARQ',))
+
+# Orchestrators started in advance (see prespawn_orchestrator).
+_prespawned = {}
+
+def prespawn_orchestrator(name, **kwargs):
+    '''Create an orchestrator in advance, so that its worker process starts
+    (and imports the image libraries) while the rest of the application is
+    being set up. The orchestrator is later obtained with get_orchestrator.
+    '''
+    if name not in _prespawned:
+        _prespawned[name] = Orchestrator(name=name, **kwargs)
+
+def get_orchestrator(name, **kwargs):
+    '''Return the orchestrator created in advance with the given name or, if
+    none is available, a new one created with the given arguments.'''
+    orchestrator = _prespawned.pop(name, None)
+    if orchestrator is None:
+        orchestrator = Orchestrator(name=name, **kwargs)
+    return orchestrator
+
+def get_browser_orchestrator_kwargs(config):
+    '''Return the keyword arguments used to create the orchestrator of the
+    browser. They are used both when the orchestrator is created in advance
+    and when it is not, and must therefore be the same.'''
+    return dict(thumbnail_cache=get_thumbnail_cache(config),
+                timeout=config.get('thumb.timeout', 30, SCALAR),
+                decode_limits=get_decode_limits(config),
+                resize_backend=config.get('thumb.resize_backend', None,
+                                          basestring))
 
 if __name__ == '__main__':
-    import time
 
     def got_it(*args):
         print('Got it ' + ', '.join(map(str, args)))
@@ -0,0 +1,89 @@
+# Copyright 2017 Matteo Franchin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Background decoding of the images the viewer is likely to show next.
+
+The Preloader uses its own Orchestrator, whose worker process decodes the
+images and scales them down to the size of the viewer window. Results are
+(array, orig_size) tuples, where orig_size is the size of the original
+image.
+'''
+
+from .orchestrator import Orchestrator, Worker, THUMBNAIL_DONE, \
+  THUMBNAIL_DAMAGED
+from .thumbnailers import build_scaled_image
+from .decode_limits import get_decode_limits
+from .config import SCALAR
+
+
+class PreloadWorker(Worker):
+    def make_thumb(self, file_name, size, **kwargs):
+        out = build_scaled_image(file_name, size)
+        state = (THUMBNAIL_DONE if out is not None else THUMBNAIL_DAMAGED)
+        return (state, out)
+
+
+class Preloader(object):
+    def __init__(self, max_images=8, timeout=None, decode_limits=None,
+                 resize_backend=None):
+        self.orchestrator = o = \
+          Orchestrator(soft_limit=max_images, hard_limit=max_images + 2,
+                       worker_class=PreloadWorker, name='preloader',
+                       timeout=timeout, decode_limits=decode_limits,
+                       resize_backend=resize_backend)
+        o.set_callback('thumbnail_available', self._on_image_available)
+        self.listeners = []
+
+    def add_listener(self, listener):
+        '''Add a function to call as listener(file_name, size, state, data)
+        when a preloaded image becomes available. Note that listeners are
+        called from a separate thread.'''
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def _on_image_available(self, *args):
+        for listener in list(self.listeners):
+            listener(*args)
+
+    def preload(self, image_paths, size):
+        '''Preload the given images, scaled to fit inside `size`. Images are
+        given in decreasing order of priority. Images which were being
+        preloaded and are not in `image_paths` are cancelled.
+        Return the Thumbnail objects (see orchestrator.py) for the images.
+        '''
+        o = self.orchestrator
+        o.clear_queue()
+
+        # The orchestrator deals with the most recent requests first.
+        tns = [o.request_thumbnail(image_path, size)
+               for image_path in reversed(image_paths)]
+        return tns[::-1]
+
+
+_preloader = None
+
+def get_preloader(config):
+    '''Return the Preloader shared by all the viewer tabs.'''
+    global _preloader
+    if _preloader is None:
+        max_images = config.get('viewer.preload_cache_size', 8, int)
+        timeout = config.get('thumb.timeout', 30, SCALAR)
+        _preloader = Preloader(
+          max_images=max_images, timeout=timeout,
+          decode_limits=get_decode_limits(config),
+          resize_backend=config.get('thumb.resize_backend', None, basestring))
+    return _preloader
@@ -0,0 +1,152 @@
+# Copyright 2017 Matteo Franchin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Opt-in profiling of the functions running in the GUI thread.
+
+Functions decorated with @profiled record the duration of each call when the
+profiler is enabled (see `--profile` in cli.py). Functions which draw a
+frame (expose event handlers) are flagged when they take longer than the
+frame budget. The whole session can also be profiled with cProfile.
+'''
+
+import time
+import logging
+import functools
+from collections import OrderedDict, deque
+
+from .stats import percentile
+
+logger = logging.getLogger('Immagine.profile')
+
+
+class Profiler(object):
+    def __init__(self, history=10000):
+        self.enabled = False
+        self.frame_budget = 1.0/60
+        self._history = history
+        self._durations = OrderedDict()
+        self._counters = OrderedDict()
+        self._cprofile = None
+
+        # Startup milestones: map names to seconds since the start.
+        self.startup = OrderedDict()
+
+    def enable(self, frame_budget=None, use_cprofile=False):
+        '''Start recording. `frame_budget` is the time (in seconds) above
+        which drawing a frame is reported as slow.'''
+        if frame_budget is not None:
+            self.frame_budget = frame_budget
+        if use_cprofile and self._cprofile is None:
+            import cProfile
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        logger.setLevel(logging.INFO)
+        self.enabled = True
+
+    def record(self, name, duration, frame=False):
+        '''Record one call to the function `name` taking `duration` seconds.
+        '''
+        durations = self._durations.get(name)
+        if durations is None:
+            self._durations[name] = durations = deque(maxlen=self._history)
+            self._counters[name] = [0, 0.0, 0]
+        durations.append(duration)
+        counters = self._counters[name]
+        counters[0] += 1
+        counters[1] += duration
+        if frame and duration > self.frame_budget:
+            counters[2] += 1
+            logger.warn('Slow frame: {} took {:.1f} ms (budget {:.1f} ms)'
+                        .format(name, 1000.0*duration,
+                                1000.0*self.frame_budget))
+
+    def mark_startup(self, name, last=False):
+        '''Record that the startup milestone `name` was reached. If `last` is
+        true, log the time taken to reach all the milestones so far. This is
+        done also when the profiler is disabled.'''
+        from . import start_time
+        self.startup[name] = time.time() - start_time
+        if last:
+            msg = ('Startup: ' +
+                   ' '.join('{}={:.3f}s'.format(milestone, t)
+                            for milestone, t in self.startup.items()))
+            (logger.info if self.enabled else logger.debug)(msg)
+
+    def get_summary(self):
+        '''Return a dictionary mapping the name of each profiled function to
+        its number of calls, total time, number of calls over the frame
+        budget and percentiles of the duration of the recent calls (in ms).
+        '''
+        summary = OrderedDict()
+        for name, durations in self._durations.items():
+            count, total, over_budget = self._counters[name]
+            values = sorted(1000.0*d for d in durations)
+            summary[name] = OrderedDict(
+              [('count', count),
+               ('total_ms', 1000.0*total),
+               ('over_budget', over_budget),
+               ('p50_ms', percentile(values, 50)),
+               ('p90_ms', percentile(values, 90)),
+               ('p99_ms', percentile(values, 99)),
+               ('max_ms', values[-1] if values else 0.0)])
+        return summary
+
+    def report(self):
+        '''Log the summary of the calls recorded so far.'''
+        for name, s in self.get_summary().items():
+            logger.info('{}: calls={} total={:.1f}ms over_budget={} '
+                        'p50={:.2f}ms p90={:.2f}ms p99={:.2f}ms max={:.2f}ms'
+                        .format(name, s['count'], s['total_ms'],
+                                s['over_budget'], s['p50_ms'], s['p90_ms'],
+                                s['p99_ms'], s['max_ms']))
+
+    def finish(self, cprofile_path=None):
+        '''Stop recording, log the summary and save the cProfile data (if
+        enabled) to the given path.'''
+        if not self.enabled:
+            return
+        self.enabled = False
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            if cprofile_path is not None:
+                self._cprofile.dump_stats(cprofile_path)
+                logger.info('cProfile data saved to {}'.format(cprofile_path))
+            self._cprofile = None
+        self.report()
+
+
+_profiler = Profiler()
+
+def get_profiler():
+    '''Return the profiler used by the @profiled functions.'''
+    return _profiler
+
+
+def profiled(name, frame=False):
+    '''Decorator recording the duration of the calls to the decorated
+    function under the given name, when the profiler is enabled. `frame`
+    tells whether the function draws a frame and should be checked against
+    the frame budget.'''
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _profiler.enabled:
+                return fn(*args, **kwargs)
+            t0 = time.time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _profiler.record(name, time.time() - t0, frame)
+        return wrapper
+    return decorator
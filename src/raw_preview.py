@@ -0,0 +1,227 @@
+# Copyright 2017 Matteo Franchin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Extraction of the JPEG previews embedded in camera RAW files.
+
+Demosaicing a RAW file is slow. Cameras however embed in their RAW files
+one or more JPEG previews, which are used to show the file. Most RAW formats
+are based on TIFF and the previews are found by walking the TIFF directories
+(IFDs). Fuji RAF files store the offset of the preview in their header.
+Other formats (e.g. Canon CR3) are handled with rawpy, if it is installed.
+'''
+
+import io
+import struct
+
+import PIL.Image
+
+# Tags of the TIFF directories.
+(TAG_COMPRESSION,
+ TAG_PHOTOMETRIC,
+ TAG_STRIP_OFFSETS,
+ TAG_ORIENTATION,
+ TAG_STRIP_BYTE_COUNTS,
+ TAG_SUB_IFDS,
+ TAG_JPEG_OFFSET,
+ TAG_JPEG_LENGTH,
+ TAG_EXIF_IFD) = (0x0103, 0x0106, 0x0111, 0x0112, 0x0117, 0x014a, 0x0201,
+                  0x0202, 0x8769)
+
+# Transpositions for the values of the EXIF orientation tag.
+_transpositions = {2: PIL.Image.FLIP_LEFT_RIGHT,
+                   3: PIL.Image.ROTATE_180,
+                   4: PIL.Image.FLIP_TOP_BOTTOM,
+                   5: PIL.Image.TRANSPOSE,
+                   6: PIL.Image.ROTATE_270,
+                   7: PIL.Image.TRANSVERSE,
+                   8: PIL.Image.ROTATE_90}
+
+# Limits protecting against damaged files.
+MAX_IFDS = 64
+MAX_IFD_ENTRIES = 1000
+MAX_PREVIEW_BYTES = 64*1024*1024
+
+
+def _read_ifd(f, endian, offset):
+    '''(internal) Read the TIFF directory at the given offset. Return a tuple
+    (tags, next_offset) where tags maps tag numbers to (type, count, value)
+    tuples.'''
+    f.seek(offset)
+    data = f.read(2)
+    if len(data) < 2:
+        return ({}, 0)
+    num_entries, = struct.unpack(endian + 'H', data)
+    if num_entries > MAX_IFD_ENTRIES:
+        return ({}, 0)
+    data = f.read(12*num_entries + 4)
+    if len(data) < 12*num_entries + 4:
+        return ({}, 0)
+
+    tags = {}
+    for i in range(num_entries):
+        entry = data[12*i:12*i + 12]
+        tag, typ, count = struct.unpack(endian + 'HHI', entry[:8])
+        if typ == 3 and count <= 2:
+            # SHORT values are stored in the first bytes of the field.
+            value, = struct.unpack(endian + 'H', entry[8:10])
+        else:
+            value, = struct.unpack(endian + 'I', entry[8:12])
+        tags[tag] = (typ, count, value)
+    next_offset, = struct.unpack(endian + 'I', data[-4:])
+    return (tags, next_offset)
+
+
+def _read_longs(f, endian, offset, count):
+    '''(internal) Read an array of `count` LONG values at the given offset.'''
+    f.seek(offset)
+    data = f.read(4*count)
+    return list(struct.unpack(endian + 'I'*(len(data)//4), data))
+
+
+def find_tiff_preview(f):
+    '''Return the tuple (offset, length, orientation) for the biggest JPEG
+    preview in the TIFF-based RAW file `f` or None if no preview is found.
+    '''
+    f.seek(0)
+    header = f.read(8)
+    if header[:2] == b'II':
+        endian = '<'
+    elif header[:2] == b'MM':
+        endian = '>'
+    else:
+        return None
+    first_ifd, = struct.unpack(endian + 'I', header[4:8])
+
+    orientation = 1
+    candidates = []
+    to_visit = [first_ifd]
+    visited = set()
+    while to_visit and len(visited) < MAX_IFDS:
+        offset = to_visit.pop()
+        if offset == 0 or offset in visited:
+            continue
+        visited.add(offset)
+        tags, next_offset = _read_ifd(f, endian, offset)
+        to_visit.append(next_offset)
+        if offset == first_ifd and TAG_ORIENTATION in tags:
+            orientation = tags[TAG_ORIENTATION][2]
+
+        # Previews are given either as a JPEG stream or as a JPEG compressed
+        # RGB (or YCbCr) image made of a single strip.
+        if TAG_JPEG_OFFSET in tags and TAG_JPEG_LENGTH in tags:
+            candidates.append((tags[TAG_JPEG_LENGTH][2],
+                               tags[TAG_JPEG_OFFSET][2]))
+        compression = tags.get(TAG_COMPRESSION, (0, 0, 0))[2]
+        photometric = tags.get(TAG_PHOTOMETRIC, (0, 0, 0))[2]
+        strips = tags.get(TAG_STRIP_OFFSETS)
+        if (compression in (6, 7) and photometric in (2, 6) and
+            strips is not None and strips[1] == 1 and
+            TAG_STRIP_BYTE_COUNTS in tags):
+            candidates.append((tags[TAG_STRIP_BYTE_COUNTS][2], strips[2]))
+
+        for tag in (TAG_SUB_IFDS, TAG_EXIF_IFD):
+            if tag in tags:
+                _, count, value = tags[tag]
+                to_visit.extend([value] if count == 1 else
+                                _read_longs(f, endian, value,
+                                            min(count, MAX_IFDS)))
+
+    for length, offset in sorted(candidates, reverse=True):
+        f.seek(offset)
+        if 0 < length <= MAX_PREVIEW_BYTES and f.read(2) == b'\xff\xd8':
+            return (offset, length, orientation)
+    return None
+
+
+def find_raf_preview(f):
+    '''Return the tuple (offset, length, orientation) for the JPEG preview
+    in the Fuji RAF file `f` or None if the file is not a RAF file.'''
+    f.seek(0)
+    header = f.read(92)
+    if not header.startswith(b'FUJIFILMCCD-RAW') or len(header) < 92:
+        return None
+    offset, length = struct.unpack('>II', header[84:92])
+    return (offset, length, 1)
+
+
+class _FileWindow(object):
+    '''(internal) Read-only file object giving access to the `length`
+    bytes starting at `offset` in the file `f`. PIL reads the preview through
+    this object only as needed: opening it reads just the JPEG header.'''
+
+    def __init__(self, f, offset, length):
+        self._f = f
+        self._offset = offset
+        self._length = length
+        self._pos = 0
+
+    def read(self, size=-1):
+        remaining = max(0, self._length - self._pos)
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        self._f.seek(self._offset + self._pos)
+        data = self._f.read(size)
+        self._pos += len(data)
+        return data
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self._pos
+        elif whence == 2:
+            pos += self._length
+        self._pos = max(0, pos)
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._f.close()
+
+
+def _extract_rawpy_preview(path):
+    '''(internal) Return the JPEG preview of the given RAW file, extracted
+    with rawpy, or None if rawpy is not installed or finds no preview.'''
+    try:
+        import rawpy
+    except ImportError:
+        return None
+    with rawpy.imread(path) as raw:
+        thumb = raw.extract_thumb()
+        if thumb.format == rawpy.ThumbFormat.JPEG:
+            return thumb.data
+    return None
+
+
+def open_raw_preview(path):
+    '''Opener for RAW files (see formats.py): return the biggest JPEG
+    preview as a PIL image, together with the transposition needed to orient
+    it. The preview is read from the RAW file only when the image is loaded.
+    '''
+    f = open(path, 'rb')
+    try:
+        found = find_raf_preview(f) or find_tiff_preview(f)
+    except:
+        f.close()
+        raise
+    if found is not None:
+        offset, length, orientation = found
+        if 0 < length <= MAX_PREVIEW_BYTES:
+            return (PIL.Image.open(_FileWindow(f, offset, length)),
+                    _transpositions.get(orientation))
+    f.close()
+
+    data = _extract_rawpy_preview(path)
+    if data is None:
+        raise IOError('No preview found in {}'.format(path))
+    return (PIL.Image.open(io.BytesIO(data)), None)
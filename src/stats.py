@@ -0,0 +1,228 @@
+# Copyright 2017 Matteo Franchin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Statistics about the thumbnail requests handled by the orchestrators.
+
+Every request goes through the following steps, each marked by a timestamp:
+requested (by the GUI), dequeued (by the worker), decode_start, decode_end,
+sent (by the worker), received (by the orchestrator) and drawn (by the GUI).
+The differences between timestamps tell where the time goes: waiting in the
+queue, decoding, inter-process communication or drawing.
+'''
+
+import json
+import time
+import logging
+import threading
+import weakref
+from collections import OrderedDict, deque
+
+logger = logging.getLogger('Immagine.stats')
+
+# All the OrchestratorStats objects alive.
+_all_stats = weakref.WeakSet()
+
+
+def percentile(sorted_values, p):
+    '''Return the p-th percentile (0 <= p <= 100) of the given sorted list,
+    interpolating between the closest values.'''
+    if len(sorted_values) == 0:
+        return 0.0
+    pos = (len(sorted_values) - 1)*p/100.0
+    lo = int(pos)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    lo_value, hi_value = (sorted_values[lo], sorted_values[hi])
+    return lo_value + (hi_value - lo_value)*(pos - lo)
+
+
+class OrchestratorStats(object):
+    '''Timestamps and counters for the requests of one Orchestrator. The
+    methods can be called from any thread.'''
+
+    # Latencies reported, as (name, start timestamp, end timestamp).
+    stages = (('queue', 'requested', 'dequeued'),
+              ('decode', 'decode_start', 'decode_end'),
+              ('ipc', 'sent', 'received'),
+              ('draw', 'received', 'drawn'),
+              ('total', 'requested', 'received'))
+
+    def __init__(self, name, history=1000):
+        self.name = name
+        self._lock = threading.Lock()
+
+        # Timestamps of the requests still being processed, of the requests
+        # processed but not yet drawn and of the most recent requests.
+        self._pending = {}
+        self._undrawn = OrderedDict()
+        self._history = deque(maxlen=history)
+
+        self.counters = OrderedDict((key, 0) for key in
+                                    ('requests', 'cache_hits', 'pending_hits',
+                                     'cancelled', 'cleared', 'discarded',
+                                     'damaged', 'completed', 'worker_aborted',
+                                     'restarts'))
+        self.max_queue_depth = 0
+        self.worker_queue_depth = 0
+        self.max_worker_queue_depth = 0
+        _all_stats.add(self)
+
+    def record_request(self, request_id):
+        '''Record that a thumbnail was requested to the worker.'''
+        with self._lock:
+            self.counters['requests'] += 1
+            self._pending[request_id] = {'requested': time.time()}
+            self.max_queue_depth = max(self.max_queue_depth,
+                                       len(self._pending))
+
+    def record_cache_hit(self, pending=False):
+        '''Record that a request was satisfied by the cache. `pending` tells
+        whether the cached thumbnail was still loading.'''
+        with self._lock:
+            self.counters['pending_hits' if pending else 'cache_hits'] += 1
+
+    def record_cancel(self, request_id):
+        '''Record the cancellation of the given request.'''
+        with self._lock:
+            if self._pending.pop(request_id, None) is not None:
+                self.counters['cancelled'] += 1
+
+    def record_clear(self):
+        '''Record the cancellation of all the pending requests.'''
+        with self._lock:
+            self.counters['cleared'] += len(self._pending)
+            self._pending.clear()
+
+    def record_restart(self):
+        '''Record that the worker process was restarted after a crash or a
+        timeout.'''
+        with self._lock:
+            self.counters['restarts'] += 1
+
+    def record_received(self, request_id, state_damaged, accepted,
+                        worker_timings=None):
+        '''Record the arrival of the result of a request. `worker_timings` is
+        the dictionary of timestamps sent by the worker.'''
+        now = time.time()
+        with self._lock:
+            timings = self._pending.pop(request_id, {})
+            if worker_timings is not None:
+                timings.update(worker_timings)
+                self.counters['worker_aborted'] = \
+                  timings.pop('worker_aborted', 0)
+                depth = timings.pop('queue_depth', 0)
+                self.worker_queue_depth = depth
+                self.max_worker_queue_depth = \
+                  max(self.max_worker_queue_depth, depth)
+            timings['received'] = now
+            self._history.append(timings)
+            if not accepted:
+                self.counters['discarded'] += 1
+                return
+            self.counters['damaged' if state_damaged else 'completed'] += 1
+            self._undrawn[request_id] = timings
+            while len(self._undrawn) > self._history.maxlen:
+                self._undrawn.popitem(last=False)
+
+    def record_drawn(self, request_id):
+        '''Record that the thumbnail for the given request was drawn. Only the
+        first time is recorded. This is called at every redraw and is cheap
+        for requests whose drawing was already recorded.'''
+        if request_id not in self._undrawn:
+            return
+        with self._lock:
+            timings = self._undrawn.pop(request_id, None)
+            if timings is not None:
+                timings['drawn'] = time.time()
+
+    def get_summary(self):
+        '''Return a dictionary summarizing the statistics: counters, cache hit
+        rate, queue depths and the percentiles of the latencies (in ms) of
+        the recent requests.'''
+        with self._lock:
+            records = list(self._history)
+            counters = OrderedDict(self.counters)
+            queue_depth = len(self._pending)
+
+        summary = OrderedDict()
+        summary['name'] = self.name
+        summary['counters'] = counters
+        lookups = (counters['requests'] + counters['cache_hits'] +
+                   counters['pending_hits'])
+        summary['cache_hit_rate'] = (counters['cache_hits']/float(lookups)
+                                     if lookups > 0 else 0.0)
+        summary['queue_depth'] = queue_depth
+        summary['max_queue_depth'] = self.max_queue_depth
+        summary['worker_queue_depth'] = self.worker_queue_depth
+        summary['max_worker_queue_depth'] = self.max_worker_queue_depth
+
+        latencies = OrderedDict()
+        for stage, start, end in self.stages:
+            values = sorted(1000.0*(r[end] - r[start]) for r in records
+                            if start in r and end in r)
+            latencies[stage] = OrderedDict(
+              [('count', len(values)),
+               ('p50', percentile(values, 50)),
+               ('p90', percentile(values, 90)),
+               ('p99', percentile(values, 99)),
+               ('max', values[-1] if values else 0.0)])
+        summary['latency_ms'] = latencies
+        return summary
+
+
+def format_summary(summary):
+    '''Return a one line description of a summary (see get_summary).'''
+    c = summary['counters']
+    latencies = ' '.join('{}={:.1f}'.format(stage, lat['p50'])
+                         for stage, lat in summary['latency_ms'].items())
+    return ('{}: queue={}/{} worker_queue={}/{} hit_rate={:.1%} done={} '
+            'damaged={} cancelled={} cleared={} discarded={} aborted={} '
+            'restarts={} p50_ms[{}]'
+            .format(summary['name'], summary['queue_depth'],
+                    summary['max_queue_depth'], summary['worker_queue_depth'],
+                    summary['max_worker_queue_depth'],
+                    summary['cache_hit_rate'], c['completed'], c['damaged'],
+                    c['cancelled'], c['cleared'], c['discarded'],
+                    c['worker_aborted'], c['restarts'], latencies))
+
+
+def get_all_summaries():
+    '''Return the summaries for all the orchestrators alive.'''
+    return sorted((stats.get_summary() for stats in list(_all_stats)),
+                  key=lambda summary: summary['name'])
+
+
+class StatsReporter(object):
+    '''Periodically log the statistics and/or dump them as JSON to a file.
+    Call report() to produce a report.'''
+
+    def __init__(self, log=True, json_path=None):
+        self.log = log
+        self.json_path = json_path
+        if log:
+            logger.setLevel(logging.INFO)
+
+    def report(self):
+        summaries = get_all_summaries()
+        if self.log:
+            for summary in summaries:
+                logger.info(format_summary(summary))
+        if self.json_path is not None:
+            try:
+                with open(self.json_path, 'w') as f:
+                    json.dump({'timestamp': time.time(),
+                               'orchestrators': summaries}, f, indent=2)
+            except (IOError, OSError) as exc:
+                logger.error('Cannot write statistics to {}: {}'
+                             .format(self.json_path, str(exc)))
+        return True
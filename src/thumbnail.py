@@ -15,7 +15,7 @@
 import os
 import math
 
-from .thumbnailers import open_image
+from .thumbnailers import get_image_size
 
 class ThumbnailBase(object):
     def __init__(self, file_list_item):
@@ -55,13 +55,15 @@ class ImageThumbnail(ThumbnailBase):
         super(ImageThumbnail, self).__init__(file_list_item)
 
     def obtain_image_info(self):
-        image = open_image(self.file_list_item.full_path)
+        try:
+            size = get_image_size(self.file_list_item.full_path)
+        except:
+            size = None
         orig_size = (100, 100)
-        if image is not None and min(image.size) >= 1:
-            orig_size = image.size
+        if size is not None and min(size) >= 1:
+            orig_size = size
         else:
             self.damaged = True
-        del image
         self.orig_size = orig_size
 
 class DirectoryThumbnail(ThumbnailBase):
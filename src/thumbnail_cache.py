@@ -0,0 +1,133 @@
+# Copyright 2017 Matteo Franchin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Persistent cache of thumbnails, stored as PNG files on disk.
+
+Thumbnails are stored for a few fixed sizes (bounding boxes), one directory
+per size. The modification time of each cached file is set to the one of
+the original file, so that checking whether a thumbnail is fresh only needs
+two stat() calls. The thumbnail of a directory is considered fresh as long
+as the modification time of the directory does not change.
+'''
+
+import os
+import hashlib
+
+from .file_utils import get_cache_dir, write_file_atomically
+from .config import logger, INT2, TupleTypeChecker
+
+
+class ThumbnailCache(object):
+    # Note that numpy and PIL are imported only when needed: this object is
+    # created in the GUI process, but only used by the worker processes.
+
+    def __init__(self, cache_dir, sizes=((512, 512),)):
+        self.cache_dir = cache_dir
+        self.sizes = sorted(tuple(size) for size in sizes)
+
+    def get_cache_path(self, path, size):
+        '''Return the path of the cached thumbnail for the given file and
+        size.'''
+        full_path = os.path.realpath(path)
+        if not isinstance(full_path, bytes):
+            full_path = full_path.encode('utf-8')
+        name = hashlib.md5(full_path).hexdigest() + '.png'
+        return os.path.join(self.cache_dir, '{}x{}'.format(*size), name)
+
+    def is_fresh(self, path, size, mtime=None):
+        '''Whether the cache has an up-to-date thumbnail for the given file
+        and size. `mtime` is the modification time of the file, if known.'''
+        try:
+            if mtime is None:
+                mtime = os.stat(path).st_mtime
+            cached_mtime = os.stat(self.get_cache_path(path, size)).st_mtime
+        except OSError:
+            return False
+        return abs(cached_mtime - mtime) < 0.01
+
+    def load(self, path, size):
+        '''Return the cached thumbnail (a numpy array) for the given file and
+        size or None if there is no up-to-date thumbnail.'''
+        if not self.is_fresh(path, size):
+            return None
+        import numpy
+        import PIL.Image
+        try:
+            image = PIL.Image.open(self.get_cache_path(path, size))
+            return numpy.array(image.convert('RGB'))
+        except Exception as exc:
+            logger.debug('Cannot load cached thumbnail for {}: {}'
+                         .format(path, str(exc)))
+            return None
+
+    def store(self, path, size, arr, mtime=None):
+        '''Store the thumbnail `arr` (a numpy array) for the given file and
+        size. The file is written atomically.'''
+        import PIL.Image
+        try:
+            if mtime is None:
+                mtime = os.stat(path).st_mtime
+            image = PIL.Image.fromarray(arr)
+            write_file_atomically(
+              self.get_cache_path(path, size),
+              lambda f: image.save(f, 'PNG', compress_level=1),
+              mode='wb', mtime=mtime)
+        except Exception as exc:
+            logger.error('Cannot store thumbnail for {}: {}'
+                         .format(path, str(exc)))
+            return False
+        return True
+
+    def find(self, path, size):
+        '''Return a thumbnail for the given file with exactly the given size,
+        obtained by downscaling the smallest cached thumbnail which is big
+        enough, or None if there is none.'''
+        width, height = size
+        for cache_size in self.sizes:
+            if cache_size[0] < width or cache_size[1] < height:
+                continue
+            arr = self.load(path, cache_size)
+            if arr is None:
+                continue
+
+            # The cached thumbnail must be big enough and have about the same
+            # aspect ratio, otherwise it would be distorted.
+            ch, cw = arr.shape[:2]
+            if (cw < width or ch < height or
+                abs(cw*height - ch*width) > 0.05*cw*height):
+                continue
+            if (cw, ch) == (width, height):
+                return arr
+            import numpy
+            import PIL.Image
+            image = PIL.Image.fromarray(arr).resize((width, height),
+                                                    PIL.Image.ANTIALIAS)
+            return numpy.array(image)
+        return None
+
+
+def get_default_cache_dir():
+    return get_cache_dir('thumbnails')
+
+
+def get_thumbnail_cache(config):
+    '''Return the ThumbnailCache configured in `config` or None if the
+    persistent cache is disabled.'''
+    if not config.get('thumb.disk_cache', True, bool):
+        return None
+    cache_dir = (config.get('thumb.cache_dir', None, basestring) or
+                 get_default_cache_dir())
+    sizes = config.get('thumb.cache_sizes', [[512, 512]],
+                       TupleTypeChecker(INT2))
+    return ThumbnailCache(os.path.expanduser(cache_dir), sizes)
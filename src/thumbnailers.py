@@ -13,36 +13,314 @@
 # limitations under the License.
 
 import os
+import math
+from collections import OrderedDict
+
 import numpy
 import PIL.Image
-import gtk
 
 from . import icons
 from .file_utils import pick_files
+from .formats import get_format_from_path, get_format_from_file
+from .decode_limits import DecodeLimits
 from .config import logger
 
-def open_image(file_name, load=False):
+# Limits used when decoding images (see set_decode_limits).
+_decode_limits = DecodeLimits()
+
+def set_decode_limits(limits):
+    '''Set the DecodeLimits used by the thumbnailers in this process.'''
+    global _decode_limits
+    _decode_limits = limits
+
+def _get_format(image_path):
+    '''(internal) Return the ImageFormat of the image. This is the format of
+    the file extension or, if the extension is unknown, the format
+    identified by the magic bytes of the file. Files whose extension does
+    not match their content (e.g. a HEIF image saved with a .jpg extension)
+    are dealt with when opening them fails (see _open), so that the files
+    are not read an extra time in the common case.'''
+    return (get_format_from_path(image_path) or
+            get_format_from_file(image_path))
+
+def _open(image_path):
+    '''(internal) Open the image with the opener of its format (see
+    formats.py). Return a tuple (image, transpose, custom) where transpose is
+    the transposition to apply to the image (or None) and custom is whether
+    the image was opened by a custom opener, rather than directly by PIL.
+    If this fails, the image is opened again as the format identified by its
+    magic bytes, if different.'''
+    fmt = _get_format(image_path)
     try:
-        img = PIL.Image.open(file_name)
+        return _open_as(image_path, fmt)
+    except Exception:
+        sniffed = get_format_from_file(image_path)
+        if sniffed is None or sniffed is fmt:
+            raise
+        return _open_as(image_path, sniffed)
+
+def _open_as(image_path, fmt):
+    '''(internal) Open the image as the given ImageFormat (see _open).'''
+    opener = (fmt.get_opener() if fmt is not None else None)
+    if opener is None:
+        return (PIL.Image.open(image_path), None, False)
+    image, transpose = opener(image_path)
+    return (image, transpose, True)
+
+# Transpositions swapping the width and the height of the images.
+_swapping_transpositions = (PIL.Image.ROTATE_90, PIL.Image.ROTATE_270,
+                            PIL.Image.TRANSPOSE, PIL.Image.TRANSVERSE)
+
+def _transposed_size(size, transpose):
+    '''(internal) Return the size of an image with the given size, after the
+    given transposition.'''
+    if transpose in _swapping_transpositions:
+        return (size[1], size[0])
+    return size
+
+def get_image_size(image_path):
+    '''Return the size of the image, as shown (i.e. after rotating it
+    according to its orientation), without decoding it. Raise
+    DecodeLimitError if the image is too big to be decoded.'''
+    fmt = _get_format(image_path)
+    size_getter = (fmt.get_size_getter() if fmt is not None else None)
+    if size_getter is not None:
+        try:
+            size = size_getter(image_path)
+        except Exception:
+            # The extension may not match the content: see _open.
+            size = None
+        if size is not None:
+            _decode_limits.check(size)
+            return size
+    image, transpose, _ = _open(image_path)
+    _decode_limits.check(image.size)
+    return _transposed_size(image.size, transpose)
+
+def open_image(file_name, load=False, size=None):
+    '''Open the image, or return None if it cannot be opened. If `size`
+    is given, the image is going to be scaled down to fit inside it (see
+    open_scalable_image).'''
+    try:
+        img = open_scalable_image(file_name, size)
         if load:
             img.load()
         return img
     except:
         return None
 
+def open_scalable_image(image_path, size=None):
+    '''Open an image which is going to be scaled down to fit inside `size`.
+    Huge images are reduced while being decoded, so that their pixels never
+    need to be all in memory at the same time: JPEG images are decoded at a
+    lower resolution and images stored in strips or tiles (e.g. TIFF scans)
+    are decoded one band at a time. Raise DecodeLimitError if the image is
+    too big to be decoded, or to be decoded at once when it cannot be
+    reduced while decoding. Images opened by the opener of their format (e.g.
+    RAW previews) are also rotated according to their orientation.'''
+    image, transpose, custom = _open(image_path)
+    _decode_limits.check(image.size)
+    if transpose is not None:
+        if size is not None:
+            image.draft(None, _transposed_size(size, transpose))
+        _decode_limits.check_full(image.size)
+        return image.transpose(transpose)
+
+    stream_pixels = _decode_limits.stream_pixels
+    width, height = image.size
+    if size is None or not stream_pixels or width*height <= stream_pixels:
+        _decode_limits.check_full(image.size)
+        return image
+
+    # Let the JPEG decoder do the reduction.
+    image.draft(None, size)
+    width, height = image.size
+    if (not custom and width*height > stream_pixels and
+        len(image.tile) > 1 and width > size[0] and height > size[1]):
+        return _decode_in_bands(image_path, image, size)
+    _decode_limits.check_full(image.size)
+    return image
+
+def _get_band_image(image_path, tiles, width, y0, y1):
+    '''(internal) Decode the rows from y0 to y1 of an image, given the
+    tiles which cover them.'''
+    band = PIL.Image.open(image_path)
+    band.tile = [(decoder, (bx0, by0 - y0, bx1, by1 - y0), offset, args)
+                 for decoder, (bx0, by0, bx1, by1), offset, args in tiles]
+    if hasattr(band, '_size'):
+        band._size = (width, y1 - y0)
+    else:
+        band.size = (width, y1 - y0)
+    band.load()
+    return band
+
+def _decode_in_bands(image_path, image, size):
+    '''(internal) Decode an image stored in multiple tiles one band of rows
+    at a time, scale down each band and return the scaled image.'''
+    width, height = image.size
+    scale = min(float(size[0])/width, float(size[1])/height)
+    out_size = (max(1, int(round(width*scale))),
+                max(1, int(round(height*scale))))
+    out = PIL.Image.new('RGB', out_size)
+
+    # Bands contain at least a few output rows and at most stream_pixels
+    # pixels (unless the tiles are taller than that).
+    min_rows = max(_decode_limits.stream_pixels//width,
+                   int(math.ceil(2.0/scale)))
+    tiles = sorted(image.tile, key=lambda tile: (tile[1][1], tile[1][0]))
+    idx = 0
+    y0 = 0
+    while idx < len(tiles):
+        band_tiles = []
+        y1 = y0
+        while idx < len(tiles) and (y1 - y0 < min_rows or
+                                    tiles[idx][1][1] < y1):
+            band_tiles.append(tiles[idx])
+            y1 = max(y1, tiles[idx][1][3])
+            idx += 1
+        y1 = min(y1, height)
+        out_y0 = int(round(y0*scale))
+        out_y1 = int(round(y1*scale))
+        if out_y1 > out_y0:
+            band = _get_band_image(image_path, band_tiles, width, y0, y1)
+            band = resize_image(to_resizable(band),
+                                (out_size[0], out_y1 - out_y0))
+            out.paste(to_rgb(band), (0, out_y0))
+        y0 = y1
+    return out
+
 def build_empty_thumbnail(size):
+    import gtk
     sx, sy = size
     pixbuf = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, False, 8, sx, sy)
     pixbuf.fill(0x7f7f7f7f)
     pixbuf.subpixbuf(1, 1, sx - 2, sy - 2).fill(0xffffffff)
     return pixbuf
 
+def build_empty_array(size):
+    '''Return the pixels of an empty thumbnail (white, with a grey border)
+    as a numpy array.'''
+    sx, sy = size
+    arr = numpy.empty((sy, sx, 3), numpy.uint8)
+    arr.fill(0x7f)
+    arr[1:sy - 1, 1:sx - 1] = 0xff
+    return arr
+
+def has_alpha(image):
+    '''Whether the image has an alpha channel or a transparent colour.'''
+    return (image.mode in ('RGBA', 'LA', 'PA', 'RGBa', 'La') or
+            (image.mode == 'P' and 'transparency' in image.info))
+
 def to_rgb(image, bg=(127, 127, 127)):
-    if image.mode != 'RGB':
+    '''Return the image in RGB mode. Transparent pixels are blended with the
+    background colour `bg`. This is best done after scaling the image down,
+    as it allocates a new image.'''
+    if image.mode == 'RGB':
+        return image
+    if not has_alpha(image):
+        return image.convert('RGB')
+    if image.mode != 'RGBA':
         image = image.convert('RGBA')
-        background = PIL.Image.new('RGBA', image.size, bg)
-        image = PIL.Image.alpha_composite(background, image).convert('RGB')
-    return image
+    out = PIL.Image.new('RGB', image.size, bg)
+    out.paste(image, None, image)
+    return out
+
+def to_resizable(image):
+    '''Return the image in a mode PIL can scale with filters other than
+    nearest neighbour, converting it only when necessary: grayscale and RGB
+    images, with or without alpha, are returned as they are.'''
+    mode = image.mode
+    if mode in ('L', 'RGB', 'RGBA'):
+        return image
+    if mode == '1':
+        return image.convert('L')
+    if has_alpha(image):
+        return image.convert('RGBA')
+    return image.convert('RGB')
+
+def fit_size(size, max_size):
+    '''Return the biggest size with the same aspect ratio as `size` which
+    fits inside `max_size`.'''
+    scale = min(float(max_size[0])/size[0], float(max_size[1])/size[1])
+    return (max(1, int(round(size[0]*scale))),
+            max(1, int(round(size[1]*scale))))
+
+def _reduce_array(arr, factor):
+    '''(internal) Reduce the size of an image (a numpy array) by an integer
+    factor, averaging blocks of factor x factor pixels.'''
+    height = arr.shape[0]//factor
+    width = arr.shape[1]//factor
+    blocks = arr[:height*factor, :width*factor].reshape(
+      (height, factor, width, factor) + arr.shape[2:])
+    total = blocks.sum(axis=(1, 3), dtype=numpy.uint32)
+    return ((total + factor*factor//2)//(factor*factor)).astype(numpy.uint8)
+
+def _area_weights(n_in, n_out):
+    '''(internal) Return the (n_out, n_in) matrix averaging n_in pixels into
+    n_out pixels, each weighted by how much it overlaps the output pixel.'''
+    edges = numpy.arange(n_out + 1)*(float(n_in)/n_out)
+    pixels = numpy.arange(n_in)
+    overlap = (numpy.minimum(edges[1:, None], pixels[None, :] + 1) -
+               numpy.maximum(edges[:-1, None], pixels[None, :]))
+    weights = numpy.clip(overlap, 0.0, None).astype(numpy.float32)
+    return weights/weights.sum(axis=1, keepdims=True)
+
+def resize_pil(image, size):
+    '''Resize with the Lanczos filter of PIL, in one step.'''
+    return image.resize(size, PIL.Image.LANCZOS)
+
+def resize_reduce(image, size):
+    '''Reduce the image by an integer factor with a box filter, then resize
+    it with the Lanczos filter. The reduced image is kept at least twice as
+    big as `size`, which preserves most of the quality of resize_pil at a
+    fraction of the cost.'''
+    factor = min(image.size[0]//size[0], image.size[1]//size[1])//2
+    if factor >= 2:
+        if hasattr(image, 'reduce'):
+            image = image.reduce(factor)
+        else:
+            image = PIL.Image.fromarray(
+              _reduce_array(numpy.asarray(to_rgb(image)), factor))
+    return image.resize(size, PIL.Image.LANCZOS)
+
+def resize_area(image, size):
+    '''Resize by averaging the pixels covered by each output pixel, using
+    numpy only. This does not depend on the filters available in PIL.'''
+    arr = numpy.asarray(to_rgb(image))
+    factor = min(arr.shape[1]//size[0], arr.shape[0]//size[1])
+    if factor >= 2:
+        arr = _reduce_array(arr, factor)
+    weights_y = _area_weights(arr.shape[0], size[1])
+    weights_x = _area_weights(arr.shape[1], size[0])
+    out = numpy.tensordot(weights_y, arr.astype(numpy.float32), axes=(1, 0))
+    out = numpy.tensordot(weights_x, out, axes=(1, 1))
+    out = numpy.clip(out.transpose(1, 0, 2) + 0.5, 0, 255)
+    return PIL.Image.fromarray(out.astype(numpy.uint8))
+
+# Functions used to scale images down, by name. See the resize_* benchmarks
+# for how they compare in speed and quality.
+resize_backends = OrderedDict([('pil', resize_pil),
+                               ('reduce', resize_reduce),
+                               ('area', resize_area)])
+_resize_backend = 'reduce'
+
+def set_resize_backend(name):
+    '''Set the function used by the thumbnailers in this process to scale
+    images down (one of the keys of resize_backends).'''
+    global _resize_backend
+    if name not in resize_backends:
+        logger.warn('Unknown resize backend {!r}: using {!r}'
+                    .format(name, _resize_backend))
+        return
+    _resize_backend = name
+
+def resize_image(image, size, backend=None):
+    '''Return the image resized to the given size, using the given resize
+    backend (the one selected with set_resize_backend by default) to scale
+    it down.'''
+    if size[0] >= image.size[0] or size[1] >= image.size[1]:
+        return image.resize(size, PIL.Image.LANCZOS)
+    return resize_backends[backend or _resize_backend](image, size)
 
 def _resize_image(image, new_size):
     new_x, new_y = new_size
@@ -51,14 +329,19 @@ def _resize_image(image, new_size):
         # Upscale.
         return image.resize(new_size, PIL.Image.LANCZOS)
     else:
-        # Downscale.
-        image.thumbnail(new_size)
-        return image
+        # Downscale, keeping the aspect ratio.
+        image.draft(None, new_size)
+        return resize_image(image, fit_size(image.size, new_size))
 
 def build_image_thumbnail(image_path, size):
     try:
-        image = PIL.Image.open(image_path)
-        image = _resize_image(image, size)
+        image = open_scalable_image(image_path, size)
+        image.draft(None, size)
+        image = _resize_image(to_resizable(image), size)
+    except MemoryError:
+        logger.warn('Out of memory decoding {} (see thumb.worker_memory_mb)'
+                    .format(image_path))
+        return None
     except:
         return None
 
@@ -66,6 +349,27 @@ def build_image_thumbnail(image_path, size):
         logger.debug('got {}, required {}'.format(image.size, size))
     return numpy.array(to_rgb(image))
 
+def build_scaled_image(image_path, max_size):
+    '''Decode the image and downscale it, if necessary, so that it fits
+    inside `max_size`. Images are never upscaled. Return a tuple
+    (array, orig_size) where orig_size is the size of the original image, or
+    None if the image cannot be decoded.
+    '''
+    try:
+        orig_size = get_image_size(image_path)
+        image = open_scalable_image(image_path, max_size)
+        if image.size[0] > max_size[0] or image.size[1] > max_size[1]:
+            image.draft(None, max_size)
+            image = resize_image(to_resizable(image),
+                                 fit_size(image.size, max_size))
+        return (numpy.array(to_rgb(image)), orig_size)
+    except MemoryError:
+        logger.warn('Out of memory decoding {} (see thumb.worker_memory_mb)'
+                    .format(image_path))
+        return None
+    except:
+        return None
+
 def build_directory_thumbnail(dir_path, size, **kwargs):
     kwargs.setdefault('show_hidden_files', False)
     num_picks = kwargs.setdefault('num_picks', 4)
@@ -76,14 +380,14 @@ def build_directory_thumbnail(dir_path, size, **kwargs):
                     else float(size[1])/ty)
     images = []
     for image_path in pick_files(dir_path, **kwargs):
-        orig_image = open_image(image_path, load=True)
+        orig_image = open_image(image_path, load=True, size=size)
         if orig_image is None:
             continue
 
         if min(orig_image.size) < 1:
             continue
 
-        images.append(to_rgb(orig_image))
+        images.append(orig_image)
         if len(images) == num_picks:
             break
 
@@ -104,7 +408,7 @@ def build_directory_thumbnail(dir_path, size, **kwargs):
         ((0, 50), (50, 50)),
         ((50, 50), (50, 50))]]
     layout = layouts[len(images)]
-    out = build_empty_thumbnail(size)
+    out = build_empty_array(size)
     for i, image in enumerate(images):
         dest_pos, dest_size = layout[i]
         dx = int(round(dest_size[0]*scale_factor))
@@ -126,14 +430,13 @@ def build_directory_thumbnail(dir_path, size, **kwargs):
         cut_image = image.crop((cut_pos[0], cut_pos[1],
                                 cut_pos[0] + cut_size[0],
                                 cut_pos[1] + cut_size[1]))
-        cut_image = _resize_image(cut_image, (dx, dy))
-        arr = numpy.array(cut_image)
+        cut_image = _resize_image(to_resizable(cut_image), (dx, dy))
+        arr = numpy.array(to_rgb(cut_image))
         if arr.ndim != 3 or arr.dtype != numpy.uint8 or arr.shape[-1] != 3:
             continue
-        cut_pixmap = \
-          gtk.gdk.pixbuf_new_from_array(arr, gtk.gdk.COLORSPACE_RGB, 8)
-        width = min(cut_pixmap.get_width(), size[0] - dpx)
-        height = min(cut_pixmap.get_height(), size[1] - dpy)
-        cut_pixmap.copy_area(0, 0, width, height, out, dpx, dpy)
+        width = min(arr.shape[1], size[0] - dpx)
+        height = min(arr.shape[0], size[1] - dpy)
+        if width > 0 and height > 0:
+            out[dpy:dpy + height, dpx:dpx + width] = arr[:height, :width]
 
-    return out.get_pixels_array().copy()
+    return out
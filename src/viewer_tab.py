@@ -12,15 +12,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import gobject
 import gtk
 
 from .base_tab import BaseTab
 from .config import Config, COLOR
+from .image_cache import ImagePyramid, get_image_cache
+from .preloader import get_preloader
+from .orchestrator import THUMBNAIL_LOADING, THUMBNAIL_DONE
+from .image_view import TiledImageView
+from .animation import get_animation_player
+from .profiling import profiled
 
 
 class ViewerTab(BaseTab):
     def __init__(self, image_path, file_list=None, file_index=None,
-                 config=None):
+                 config=None, thumbnail=None):
         toolbar_desc = \
          ((gtk.STOCK_ZOOM_IN, 'Zoom in', 'zoom_in'),
           (gtk.STOCK_ZOOM_FIT, 'Zoom to fit', 'zoom_fit'),
@@ -39,39 +46,47 @@ class ViewerTab(BaseTab):
                                         close_tab=None)
         self._config = config or Config()
         self.file_list = file_list
-        self.file_index = file_index
+        self.file_item = (file_list[file_index] if file_list is not None
+                          else None)
         self.max_zoom = 4.0        # Maximum zoom factor.
         self.min_zoom = 0.02       # Minimum zoom factor.
         self.zoom_increment = 1.5  # Zoom magnification when doing a "zoom in".
         self.image_path = image_path
-        self.image = image = gtk.Image()
         self.size = None
-        pixbuf = gtk.gdk.pixbuf_new_from_file(image_path)
-        image.set_from_pixbuf(pixbuf)
+        self.image_cache = get_image_cache(self._config)
+        self.preloader = get_preloader(self._config)
+        self.preloader.add_listener(self.on_preload_available)
+        self._waiting_for = None
 
-        eb = gtk.EventBox()
-        eb.add(image)
+        # Thumbnail (array of pixels) shown while the image is decoded.
+        self._thumbnail = thumbnail
+
+        # Player for the current image, if animated.
+        self._animation = None
+
+        # The image is drawn by a widget which only renders the visible tiles
+        # of the zoomed image.
+        max_tiles = self._config.get('viewer.max_tiles', 128, int)
+        self.view = view = TiledImageView(max_tiles=max_tiles)
 
         self.scrolled_window = sw = gtk.ScrolledWindow()
-        vp = gtk.Viewport()
-        vp.add(eb)
-        sw.add(vp)
+        sw.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+        sw.add(view)
 
-        # Set color in the viewport around the picture.
+        # Set color around the picture.
         color = self._config.get('viewer.bg_color', '#000', COLOR)
-        vp.modify_bg(gtk.STATE_NORMAL, gtk.gdk.Color(color))
-        eb.modify_bg(gtk.STATE_NORMAL, gtk.gdk.Color(color))
+        view.modify_bg(gtk.STATE_NORMAL, gtk.gdk.Color(color))
 
         self.pack_start(self.toolbar, expand=False)
         self.pack_start(sw)
 
-        eb.connect('size-allocate', self.on_size_allocate)
+        view.connect('size-allocate', self.on_size_allocate)
         self.close_button.connect('clicked', self.close_tab)
 
     def on_size_allocate(self, widget, allocation):
         if self.size == None:
             self.size = (allocation.width, allocation.height)
-            self.zoom_fit(None)
+            self.show_picture()
 
     def on_key_press_event(self, event):
         name = ''
@@ -97,6 +112,8 @@ class ViewerTab(BaseTab):
         return True
 
     def close_tab(self, action=None):
+        self._stop_animation()
+        self.preloader.remove_listener(self.on_preload_available)
         self.call('close_tab', self)
 
     def zoom_in(self, action=None):
@@ -106,15 +123,18 @@ class ViewerTab(BaseTab):
         self.zoom_by_factor(1.0 / self.zoom_increment)
 
     def zoom_by_factor(self, factor):
-        pixbuf = self.image.get_pixbuf()
-        new_width = int(pixbuf.get_width() * factor)
-        new_height = int(pixbuf.get_height() * factor)
+        width, height = self.view.virtual_size
+        new_width = int(width * factor)
+        new_height = int(height * factor)
         self.zoom_to_size(new_width, new_height)
 
+    @profiled('ViewerTab.zoom_to_size')
     def zoom_to_size(self, width, height, check_zoom_factor=True):
-        pixbuf = gtk.gdk.pixbuf_new_from_file(self.image_path)
-        pixbuf_width = pixbuf.get_width()
-        pixbuf_height = pixbuf.get_height()
+        # The image is decoded once and the zoom levels are derived from it.
+        # A preview (preloaded or decoded at reduced resolution) is used as
+        # long as it has enough resolution.
+        pixbuf_width, pixbuf_height = \
+          self.image_cache.get_size(self.image_path)
 
         if width / float(height) >= pixbuf_width / float(pixbuf_height):
             factor = height / float(pixbuf_height)
@@ -133,37 +153,163 @@ class ViewerTab(BaseTab):
                                   check_zoom_factor=False)
                 return
 
-        pixbuf = pixbuf.scale_simple(new_width, new_height,
-                                     gtk.gdk.INTERP_BILINEAR)
-        self.image.clear()
-        self.image.set_from_pixbuf(pixbuf)
+        pyramid = self.image_cache.get(self.image_path,
+                                       min_size=(new_width, new_height))
+        self._show(pyramid, new_width, new_height)
 
-    def zoom_fit(self, action=None):
+    def _get_fit_size(self):
+        '''(internal) Return the maximum size of an image fitting inside the
+        window or None if the window has not been allocated yet.'''
         rect = self.scrolled_window.get_allocation()
-        if rect.x < 0 or rect.y < 0 or rect.width < 1 or rect.height < 1:
-            return
+        if rect.x < 0 or rect.y < 0 or rect.width < 3 or rect.height < 3:
+            return None
 
         # TODO: Find a proper way of getting the maximum image size we can put
         # in the scrolled window.
-        self.zoom_to_size(rect.width - 2, rect.height - 2)
+        return (rect.width - 2, rect.height - 2)
+
+    def zoom_fit(self, action=None):
+        fit_size = self._get_fit_size()
+        if fit_size is not None:
+            self.zoom_to_size(*fit_size)
 
     def zoom_100(self, action=None):
-        pixbuf = gtk.gdk.pixbuf_new_from_file(self.image_path)
-        self.image.clear()
-        self.image.set_from_pixbuf(pixbuf)
+        pyramid = self.image_cache.get(self.image_path)
+        self._show(pyramid, *pyramid.size)
+
+    def _show(self, pyramid, width, height):
+        '''(internal) Show the image in `pyramid` with the given size.'''
+        animation = self._animation
+        if animation is not None and animation.image_path == self.image_path:
+            # The frames of the animation replace the image in the view.
+            self.view.set_virtual_size(width, height)
+            return
+        if self.view.pyramid is pyramid:
+            self.view.set_virtual_size(width, height)
+        else:
+            self.view.set_image(pyramid, (width, height))
+        self.image_cache.trim()
+
+        self._stop_animation()
+        self._animation = get_animation_player(self.image_path,
+                                               self.view.set_frame,
+                                               self._config)
+        if self._animation is not None:
+            self._animation.play()
+
+    def _stop_animation(self):
+        '''(internal) Stop playing the current animation, if any, and close
+        its file.'''
+        if self._animation is not None:
+            self._animation.stop()
+            self._animation = None
 
     def change_picture(self, delta_index):
-        idx = self.file_index + delta_index
+        if self.file_item is None:
+            return
+
+        # The file list may be re-sorted in place by the browser: use the
+        # current index of the item, rather than the one it had originally.
+        idx = self.file_item.index + delta_index
         while 0 <= idx < len(self.file_list):
             file_item = self.file_list[idx]
             if not file_item.is_dir:
+                self._stop_animation()
                 self.image_path = file_item.full_path
-                self.file_index = idx
+                self.file_item = file_item
                 self.update_title(self.image_path)
-                self.zoom_fit()
+                self.show_picture(direction=delta_index)
                 return
             idx += delta_index
 
+    def _get_neighbours(self, direction, count):
+        '''(internal) Return the paths of up to `count` images following the
+        current one in the given direction (+1 or -1).'''
+        paths = []
+        idx = self.file_item.index + direction
+        while len(paths) < count and 0 <= idx < len(self.file_list):
+            file_item = self.file_list[idx]
+            if not file_item.is_dir:
+                paths.append(file_item.full_path)
+            idx += direction
+        return paths
+
+    def show_picture(self, direction=1):
+        '''Show the current picture, fitted to the window. The picture is
+        taken from the preloader, if available. Also preload the next images
+        in the given direction and the previous images in the opposite
+        direction, cancelling the preloading of other images.'''
+        fit_size = self._get_fit_size()
+        if fit_size is None or self.file_item is None:
+            self.zoom_fit()
+            return
+
+        cfg = self._config
+        direction = (1 if direction >= 0 else -1)
+        ahead = self._get_neighbours(direction,
+                                     cfg.get('viewer.preload_ahead', 3, int))
+        behind = self._get_neighbours(-direction,
+                                      cfg.get('viewer.preload_behind', 1, int))
+        self._waiting_for = None
+        cached = self.image_cache.contains(self.image_path, fit_size)
+        thumbnail = self._thumbnail
+        self._thumbnail = None
+        if thumbnail is not None and not cached:
+            self._show_thumbnail(thumbnail, fit_size)
+
+        if cached or self.image_cache.can_decode_fast(self.image_path):
+            # No need to wait for the preloader: either the image is ready or
+            # it can be decoded quickly at the size required.
+            self.preloader.preload(ahead + behind, fit_size)
+            if thumbnail is None or cached:
+                self.zoom_fit()
+            else:
+                # Decode after the thumbnail has been drawn.
+                image_path = self.image_path
+                gobject.idle_add(self._fit_if_current, image_path)
+            return
+
+        tn = self.preloader.preload([self.image_path] + ahead + behind,
+                                    fit_size)[0]
+        if tn.state == THUMBNAIL_LOADING:
+            # Keep showing the previous picture until this one is ready.
+            self._waiting_for = self.image_path
+        else:
+            self._show_preloaded(self.image_path, tn.state, tn.data)
+
+    def _show_thumbnail(self, thumbnail, fit_size):
+        '''(internal) Show the given thumbnail upscaled to fit the window.'''
+        pixbuf = gtk.gdk.pixbuf_new_from_array(thumbnail,
+                                               gtk.gdk.COLORSPACE_RGB, 8)
+        tx, ty = (pixbuf.get_width(), pixbuf.get_height())
+        scale = min(fit_size[0]/float(tx), fit_size[1]/float(ty))
+        self.view.set_image(ImagePyramid(pixbuf),
+                            (int(tx*scale), int(ty*scale)))
+
+    def _fit_if_current(self, image_path):
+        '''(internal) Idle callback fitting the given image in the window,
+        unless the user moved to another image in the meantime.'''
+        if image_path == self.image_path:
+            self.zoom_fit()
+        return False
+
+    def _show_preloaded(self, image_path, state, data):
+        '''(internal) Show a preloaded picture.'''
+        if state == THUMBNAIL_DONE and data is not None:
+            array, orig_size = data
+            pixbuf = gtk.gdk.pixbuf_new_from_array(array,
+                                                   gtk.gdk.COLORSPACE_RGB, 8)
+            self.image_cache.put(image_path, ImagePyramid(pixbuf, orig_size))
+        self.zoom_fit()
+
+    def on_preload_available(self, image_path, size, state, data):
+        '''Called by the preloader (from a separate thread) when an image has
+        been preloaded.'''
+        with gtk.gdk.lock:
+            if image_path == self._waiting_for == self.image_path:
+                self._waiting_for = None
+                self._show_preloaded(image_path, state, data)
+
     def change_previous(self, *ignore):
         self.change_picture(-1)
 